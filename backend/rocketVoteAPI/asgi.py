@@ -14,14 +14,18 @@ from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
 from django.urls import path
 
-from voting.consumers import PollConsumer
-
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rocketVoteAPI.settings')
 
+# set up Django before importing consumers, they read settings at import time
+django_asgi_app = get_asgi_application()
+
+from voting.consumers import PollAdminConsumer, PollConsumer
+
 #TODO: Add host origin validator
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": django_asgi_app,
     "websocket": URLRouter([
+            path("ws/admin/<str:creation_id>/", PollAdminConsumer.as_asgi()),
             path("ws/<str:poll_id>/", PollConsumer.as_asgi()),
     ]),
 })
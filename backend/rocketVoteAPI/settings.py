@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'voting.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -97,6 +98,9 @@ DATABASES = {
     }
 }
 
+# Route create/vote/admin requests to the native asyncio views (voting/async_views.py)
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', '0') == '1'
+
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
@@ -147,9 +151,33 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Logging
+# https://docs.djangoproject.com/en/5.1/topics/logging/
+# The voting app logs to stderr, in every process (web, ingest worker, celery).
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'plain': {'format': '%(asctime)s %(levelname)s %(name)s: %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'plain'},
+    },
+    'loggers': {
+        'voting': {'handlers': ['console'], 'level': os.getenv('LOG_LEVEL', 'INFO'), 'propagate': False},
+    },
+}
+
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL','redis://redis:6379/1')
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND','redis://redis:6379/1')
 CELERY_IMPORTS = ('voting.tasks',)
+CELERY_BEAT_SCHEDULE = {
+    'sweep-expired-polls': {
+        'task': 'voting.tasks.sweep_polls',
+        'schedule': int(os.getenv('POLL_SWEEP_SECONDS', '60')),
+    },
+}
 
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
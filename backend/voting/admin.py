@@ -1,6 +1,7 @@
 from django.contrib import admin
-from .models import PollTemplate
+from .models import ArchivedPoll, PollTemplate
 
 # Register your models here.
 
 admin.site.register(PollTemplate)
+admin.site.register(ArchivedPoll)
@@ -0,0 +1,139 @@
+import os
+import time
+from datetime import datetime, timezone
+
+from django.db import IntegrityError, transaction
+
+from .expiry import DEADLINES_KEY, delete_seconds
+from .keys import changes_key, creation_key, poll_keys, timeline_key, version_key, votes_key
+from .models import ArchivedBallot, ArchivedPoll
+from .poll_cache import publish_poll_invalidation
+from .utils import get_poll_counts, get_poll_from_creation_id, option_overlap_report
+from .vote_engine import TIMELINE_RESOLUTIONS, decode_ballot, decode_timeline
+
+# Revealed polls can't change any more, so ARCHIVE_AFTER_SECONDS after the
+# reveal the sweeper copies metadata, final counts, vote timeline and ballots
+# to Postgres and frees their Redis keys. The views read archived polls from
+# there instead.
+ARCHIVE_QUEUE_KEY = 'poll_archive_queue'
+ARCHIVE_AFTER_SECONDS = int(os.getenv('ARCHIVE_AFTER_SECONDS', '300'))
+ARCHIVE_BATCH = int(os.getenv('ARCHIVE_BATCH', '5000'))
+# polls archived per sweep, the next sweeps pick up the rest of a backlog
+ARCHIVE_POLLS_PER_SWEEP = int(os.getenv('ARCHIVE_POLLS_PER_SWEEP', '20'))
+
+
+def queue_poll_archive(redis_conn, creation_id):
+    """Works with sync and async clients"""
+    return redis_conn.zadd(ARCHIVE_QUEUE_KEY, {creation_id: int(time.time()) + ARCHIVE_AFTER_SECONDS})
+
+
+def archive_poll(redis_conn, creation_id):
+    """Move one revealed poll from Redis to the archive tables. Returns the ArchivedPoll, or None if there was nothing to move."""
+    poll_id, poll = get_poll_from_creation_id(redis_conn, creation_id)
+    if poll is None or poll['revealed'] != '1':
+        redis_conn.zrem(ARCHIVE_QUEUE_KEY, creation_id)
+        return None
+
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.get(version_key(poll_id))
+    pipe.zrange(changes_key(poll_id), 0, -1, withscores=True)
+    pipe.zscore(DEADLINES_KEY, creation_id)
+    for resolution in TIMELINE_RESOLUTIONS:
+        pipe.hgetall(timeline_key(poll_id, resolution))
+    version, changes, deadline, *timelines = pipe.execute()
+    voter_versions = {voter.decode('utf-8'): int(score) for voter, score in changes}
+
+    try:
+        with transaction.atomic():
+            archived = ArchivedPoll.objects.create(
+                poll_id=poll_id,
+                creation_id=creation_id,
+                metadata=poll,
+                counts=get_poll_counts(redis_conn, poll_id, poll['options']) or {},
+                version=int(version or 0),
+                timeline={resolution: decode_timeline(buckets) for resolution, buckets in zip(TIMELINE_RESOLUTIONS, timelines)},
+                expires_at=datetime.fromtimestamp(deadline or time.time() + delete_seconds, timezone.utc),
+            )
+            ballots = []
+            for voter, votes in redis_conn.hscan_iter(votes_key(poll_id), count=ARCHIVE_BATCH):
+                voter = voter.decode('utf-8')
+                ballots.append(ArchivedBallot(
+                    poll=archived, voter=voter, votes=decode_ballot(votes, poll['options']), version=voter_versions.get(voter, 0)
+                ))
+                if len(ballots) >= ARCHIVE_BATCH:
+                    ArchivedBallot.objects.bulk_create(ballots)
+                    ballots = []
+            ArchivedBallot.objects.bulk_create(ballots)
+    except IntegrityError:
+        # archived by an earlier run that died before freeing the keys
+        archived = ArchivedPoll.objects.get(creation_id=creation_id)
+
+    # committed before the keys go, so readers always find the poll in one place or the other
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.unlink(*poll_keys(poll_id, poll['options']))
+    pipe.unlink(creation_key(creation_id))
+    pipe.zrem(ARCHIVE_QUEUE_KEY, creation_id)
+    pipe.execute()
+    publish_poll_invalidation(redis_conn, poll_id)
+    return archived
+
+
+def archive_due_polls(redis_conn, now=None, limit=ARCHIVE_POLLS_PER_SWEEP):
+    """
+    Archive up to `limit` of the polls revealed more than ARCHIVE_AFTER_SECONDS ago,
+    oldest first, so one sweep can't run into the next. Returns how many were archived.
+    """
+    due = redis_conn.zrangebyscore(ARCHIVE_QUEUE_KEY, '-inf', now or time.time(), start=0, num=limit)
+    return sum(archive_poll(redis_conn, creation_id.decode('utf-8')) is not None for creation_id in due)
+
+
+def delete_expired_archives(now=None):
+    """Archived polls past their deadline, ballots included (one DELETE per table)"""
+    now = datetime.fromtimestamp(now or time.time(), timezone.utc)
+    return ArchivedPoll.objects.filter(expires_at__lte=now).delete()[1].get('voting.ArchivedPoll', 0)
+
+
+def archived_results(archived, query):
+    """The poll_admin GET body for an archived poll, for the query from parse_results_query"""
+    response = {
+        'metadata': archived.metadata,
+        'version': archived.version,
+        'counts': archived.counts,
+    }
+    ballots = archived.ballots.order_by('id')
+    if query['mode'] == 'full':
+        response['votes'] = dict(ballots.values_list('voter', 'votes'))
+    elif query['mode'] == 'since':
+        response['votes'] = dict(ballots.filter(version__gt=query['since']).values_list('voter', 'votes'))
+    elif query['mode'] == 'page':
+        # ballot ids stand in for the HSCAN cursor, 0 still means done
+        page = list(ballots.filter(id__gt=query['cursor']).values_list('id', 'voter', 'votes')[:query['count']])
+        response['cursor'] = page[-1][0] if len(page) == query['count'] else 0
+        response['votes'] = {voter: votes for _, voter, votes in page}
+    return response
+
+
+def archived_option_voters(archived, option, cursor, count):
+    """
+    The get_option_voters_page of an archived poll: the voters of option among the
+    next count ballots after cursor. Ballot ids stand in for the SSCAN cursor, and
+    like SSCAN's COUNT, count bounds the work, not the voters returned.
+    """
+    page = list(archived.ballots.filter(id__gt=cursor).order_by('id').values_list('id', 'voter', 'votes')[:count])
+    cursor = page[-1][0] if len(page) == count else 0
+    return cursor, sorted(voter for _, voter, votes in page if option in votes)
+
+
+def archived_option_overlap(archived):
+    """The get_option_overlap body of an archived poll, counted over its ballots in one pass"""
+    options = archived.metadata['options']
+    index = {option: i for i, option in enumerate(options)}
+    voters = [0] * len(options)
+    both_counts = {(a, b): 0 for a in range(len(options)) for b in range(a + 1, len(options))}
+    for votes in archived.ballots.values_list('votes', flat=True).iterator(chunk_size=ARCHIVE_BATCH):
+        picked = sorted({index[option] for option in votes if option in index})
+        for i, a in enumerate(picked):
+            voters[a] += 1
+            for b in picked[i + 1:]:
+                both_counts[(a, b)] += 1
+    return option_overlap_report(options, voters, both_counts)
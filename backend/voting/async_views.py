@@ -0,0 +1,220 @@
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from nanoid import generate
+
+from voting.auth import is_authenticated_async
+
+from .poll_cache import aget_cached_poll, aget_cached_poll_id, poll_cache, publish_poll_invalidation
+from .redis_pool import get_async_redis_connection, get_redis_connection
+from .archive import queue_poll_archive
+from .consumers import admin_group_name
+from .export import EXPORT_CONTENT_TYPES, archived_ballot_pages, ballot_pages, encode_export
+from .expiry import delete_seconds, schedule_poll_expiry, unrevealed_delete_seconds
+from .fanout import LOCAL_FANOUT, publish_reveal
+from .ingest import STREAM_INGESTION, aenqueue_ballot, aget_ingestion_lag, drain_poll
+from .keys import creation_key, metadata_key
+from .models import ArchivedPoll
+from .responses import admin_response, archived_admin_response, archived_poll_response, cast_response, checks_version_first, open_poll_response, parse_ballot, poll_closed_response, revealed_poll_response, undrained_reveal_response, version_not_modified
+from .snapshot import aget_snapshot, snapshot_response, store_snapshot
+from .utils import aget_poll_counts, aget_poll_from_creation_id, aget_poll_results, aget_poll_version, aget_poll_votes_page, aset_poll_revealed, get_voter_id, make_poll_metadata, parse_results_query, poll_body_error, poll_revealed_event, vote_cast_event
+from .vote_engine import VOTE_OK, acast_ballot, aread_changes
+
+logger = logging.getLogger(__name__)
+
+# Native asyncio versions of the hot views in views.py, routed instead of them
+# when ASYNC_VIEWS=1 so requests never go through the sync-to-async thread pool.
+
+@csrf_exempt
+@is_authenticated_async
+async def create(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+    try:
+        poll_body = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON payload'}, status=400)
+
+    error = poll_body_error(poll_body)
+    if error:
+        return JsonResponse({'error': error}, status=400)
+
+    creation_id = generate()
+    new_poll_id = generate(size=8)  # for shareable URL
+
+    poll_metadata = make_poll_metadata({**poll_body, 'anonymous': poll_body.get('anonymous', 0)})
+
+    try:
+        redis_conn = get_async_redis_connection()
+        async with redis_conn.pipeline(transaction=False) as pipe:
+            pipe.hset(metadata_key(new_poll_id), mapping=poll_metadata)
+            pipe.set(creation_key(creation_id), new_poll_id)
+            await pipe.execute()
+        await schedule_poll_expiry(redis_conn, creation_id, new_poll_id, unrevealed_delete_seconds)
+    except Exception as e:
+        return JsonResponse({'error': f'Failed to save poll data: {str(e)}'}, status=500)
+
+    return JsonResponse(
+        {
+            'poll_id': new_poll_id,
+            'redirect_url': f'/create/{creation_id}'
+        },
+        status=201
+    )
+
+@csrf_exempt
+@is_authenticated_async
+async def cast_vote(request, poll_id):
+    if request.method not in ['PATCH', 'GET']:
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+    redis_conn = get_async_redis_connection()
+
+    if request.method == 'GET':
+        # revealed polls are answered with their snapshot, from this worker's memory after the first read
+        snapshot = poll_cache.get_snapshot(poll_id)
+        if snapshot is not None:
+            return snapshot_response(request, snapshot)
+        poll = await aget_cached_poll(redis_conn, poll_id)
+        if poll is None:
+            archived = await ArchivedPoll.objects.filter(poll_id=poll_id).afirst()
+            if archived is None:
+                return poll_closed_response()
+            return archived_poll_response(request, archived)
+        if poll['revealed'] != '1':
+            return open_poll_response(request, poll)
+        snapshot = await aget_snapshot(redis_conn, poll_id)
+        if snapshot is not None:
+            return snapshot_response(request, snapshot)
+        return revealed_poll_response(poll, await aget_poll_counts(redis_conn, poll_id, poll['options']))
+
+    try:
+        poll = await aget_cached_poll(redis_conn, poll_id)
+    except:
+        return JsonResponse({'error':'An unexpected error has occurred'}, status=500)
+
+    ballot, error_response = parse_ballot(request, poll)
+    if error_response:
+        return error_response
+
+    voter_id = get_voter_id(poll, poll_id, request.user['email'])
+
+    try:
+        if STREAM_INGESTION:
+            status = await aenqueue_ballot(redis_conn, poll_id, voter_id, ballot['votes'], poll['options'])
+        else:
+            status, previous = await acast_ballot(redis_conn, poll_id, voter_id, ballot['votes'], poll['options'])
+    except Exception as e:
+        return JsonResponse({'error': f'Failed to save poll data: {str(e)}'}, status=500)
+
+    if status == VOTE_OK and not STREAM_INGESTION:
+        # live delta for the admin page, the vote itself is already stored
+        try:
+            await get_channel_layer().group_send(
+                admin_group_name(poll_id),
+                vote_cast_event(voter_id, ballot['votes'], previous)
+            )
+        except Exception as e:
+            logger.warning('Failed to publish vote to poll admins: %s', e)
+
+    return cast_response(status)
+
+@csrf_exempt
+@is_authenticated_async
+async def poll_admin(request, creation_id):
+    redis_conn = get_async_redis_connection()
+    if request.method == "GET":
+        query, error = parse_results_query(request.GET)
+        if error:
+            return JsonResponse({'error': error}, status=400)
+
+        if checks_version_first(request):
+            poll_id = await aget_cached_poll_id(redis_conn, creation_id)
+            response = version_not_modified(request, await aget_poll_version(redis_conn, poll_id) if poll_id else None)
+            if response is not None:
+                return response
+
+        poll_id, poll = await aget_poll_from_creation_id(redis_conn, creation_id)
+        if poll is None:
+            archived = await ArchivedPoll.objects.filter(creation_id=creation_id).afirst()
+            if archived is None:
+                return JsonResponse({'error': 'Invalid creation ID'}, status=400)
+            return await sync_to_async(archived_admin_response)(request, archived, query)
+
+        version, counts, votes = await aread_changes(redis_conn, poll_id, poll['options'], query['since'])
+        cursor = None
+        if query['mode'] == 'full':
+            votes = (await aget_poll_results(redis_conn, poll_id, poll['options']))[0]
+        elif query['mode'] == 'page':
+            cursor, votes = await aget_poll_votes_page(redis_conn, poll_id, poll['options'], query['cursor'], query['count'])
+        ingestion = await aget_ingestion_lag(redis_conn, poll_id) if STREAM_INGESTION else None
+        return admin_response(query, poll, version, counts, votes, cursor, ingestion)
+    elif request.method == "PATCH":
+        poll_id, poll = await aget_poll_from_creation_id(redis_conn, creation_id)
+        if poll is None:
+            return JsonResponse({'error': 'Invalid creation ID'}, status=400)
+
+        poll['revealed'] = '1'
+
+        try:
+            await aset_poll_revealed(redis_conn, poll_id)
+            await publish_poll_invalidation(redis_conn, poll_id)
+            # the apply script is only registered on the sync client, and draining blocks anyway
+            if STREAM_INGESTION and not await sync_to_async(drain_poll)(get_redis_connection(), poll_id, poll['options']):
+                return undrained_reveal_response()
+            # counts are final once revealed is set, votes are refused from here on
+            version, counts, _ = await aread_changes(redis_conn, poll_id, poll['options'])
+            await store_snapshot(redis_conn, poll_id, poll, counts, version)
+
+            #schedule auto delete, replaces the unrevealed deadline
+            await schedule_poll_expiry(redis_conn, creation_id, poll_id, delete_seconds, poll['options'])
+            await queue_poll_archive(redis_conn, creation_id)
+
+            # send revealed event with the results to participants, so they don't all refetch
+            event = poll_revealed_event(poll_id, poll, counts)
+            if LOCAL_FANOUT:
+                await publish_reveal(redis_conn, poll_id, event['frame'])
+            else:
+                await get_channel_layer().group_send(f'poll_{poll_id}', event)
+        except Exception as e:
+            return JsonResponse({'error': f'Failed to update poll data: {str(e)}'}, status=500)
+
+        return JsonResponse({'message':'Poll results revealed'}, status=200)
+
+    return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+@csrf_exempt
+@is_authenticated_async
+async def export_results(request, creation_id):
+    """
+    Every ballot of the poll as ?format=csv (default) or ndjson, streamed one
+    HSCAN page at a time. Routed in both view modes: under ASGI a sync view
+    would have its streaming content collected into a list before sending.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_CONTENT_TYPES:
+        return JsonResponse({'error': 'format must be csv or ndjson'}, status=400)
+
+    redis_conn = get_async_redis_connection()
+    poll_id, poll = await aget_poll_from_creation_id(redis_conn, creation_id)
+    if poll is not None:
+        options, pages = poll['options'], ballot_pages(redis_conn, poll_id, poll['options'])
+    else:
+        archived = await ArchivedPoll.objects.filter(creation_id=creation_id).afirst()
+        if archived is None:
+            return JsonResponse({'error': 'Invalid creation ID'}, status=400)
+        poll_id, options, pages = archived.poll_id, archived.metadata['options'], archived_ballot_pages(archived)
+
+    response = StreamingHttpResponse(encode_export(pages, options, export_format), content_type=EXPORT_CONTENT_TYPES[export_format])
+    response['Content-Disposition'] = f'attachment; filename="{poll_id}.{export_format}"'
+    # nginx would otherwise buffer the export to disk before passing it on
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,61 +1,233 @@
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.http import HttpResponseForbidden, HttpResponseBadRequest, HttpResponseRedirect, JsonResponse
 import jwt
 import requests
+from collections import OrderedDict
 from functools import wraps
 from datetime import datetime
+import hashlib
 import json
+import logging
 import redis
 import os
 import msal
+import threading
+import time
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# parsed keys are served from memory for this long before the process looks for newer ones
+KEY_CACHE_SECONDS = int(os.getenv('JWKS_KEY_CACHE_SECONDS', '3600'))
+TOKEN_CACHE_SIZE = int(os.getenv('VERIFIED_TOKEN_CACHE_SIZE', '10000'))
+# where the signing keys come from, Entra ID's discovery endpoint unless overridden (bench_e2e serves its own)
+JWKS_URL = os.getenv('ENTRA_JWKS_URL', '')
+# a fetched JWKS is shared through Redis and refetched after this long
+JWKS_REFRESH_SECONDS = int(os.getenv('JWKS_REFRESH_SECONDS', str(24*60*60)))
+JWKS_FETCH_TIMEOUT = float(os.getenv('JWKS_FETCH_TIMEOUT', '5'))
+# after a failed refresh, the stale keys are served this long before trying again
+JWKS_RETRY_SECONDS = int(os.getenv('JWKS_RETRY_SECONDS', '30'))
+# tokens signed with a kid we don't know refetch the JWKS at most once per this, across all processes
+JWKS_UNKNOWN_KID_SECONDS = int(os.getenv('JWKS_UNKNOWN_KID_SECONDS', '60'))
+
+# Redis (db 4) keys shared by every process
+JWKS_CACHE_KEY = 'jwks_cache'               # last good JWKS document, kept after it goes stale
+JWKS_FRESH_KEY = 'jwks_fresh'               # exists while that document is younger than JWKS_REFRESH_SECONDS
+JWKS_LOCK_KEY = 'jwks_refresh_lock'         # held by the one process fetching from Entra ID
+JWKS_UNKNOWN_KID_KEY = 'jwks_unknown_kid'   # rate limits refetches for unknown kids
+
+def _has_key(jwks, kid):
+    """Whether a JWKS document holds kid, or with kid None whether there is a document"""
+    return jwks is not None and (kid is None or any(key['kid'] == kid for key in jwks['keys']))
+
+RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
 class AzureADTokenVerifier:
+    """
+    Keys are refreshed single flight and stale-while-revalidate: one thread per
+    process refreshes while the others keep verifying with the keys they have,
+    and of all processes only the holder of JWKS_LOCK_KEY fetches from Entra ID;
+    the rest pick its result up from Redis. Only a process without any keys, or
+    a token with an unknown kid, waits for a refresh.
+    """
     def __init__(self):
         self.tenant_id = settings.MICROSOFT_AUTH['TENANT_ID']
         self.client_id = settings.MICROSOFT_AUTH['CLIENT_ID']
+        self.jwks_url = JWKS_URL or f'https://login.microsoftonline.com/{self.tenant_id}/discovery/v2.0/keys'
         self._redis_client = redis.StrictRedis(host='redis', port=6379, db=4)
+        self._release_lock = self._redis_client.register_script(RELEASE_LOCK_LUA)
         self.local_jwks_file = 'local_jwks.json'
 
+        # parsed public keys by kid, and when to look for newer ones
+        self._keys = {}
+        self._keys_fresh_until = 0
+        # sha256(token) -> decoded claims, evicted LRU and on token expiry
+        self._verified = OrderedDict()
+        self._lock = threading.Lock()
+        # held by the thread refreshing; _refreshes counts finished refreshes
+        self._refresh_lock = threading.Lock()
+        self._refreshes = 0
+        self._background_refresh = None
+
     def get_jwks(self):
-        """Fetch JSON Web Key Set from Redis cache or Microsoft's endpoint"""
-        cached_jwks = self._redis_client.get('jwks_cache')
-        if cached_jwks:
-            return json.loads(cached_jwks)
+        """The JWKS document, refreshed first if it is due"""
+        jwks, fresh = self._read_shared()
+        if jwks is None or not fresh:
+            self.refresh()
+            jwks, _ = self._read_shared()
+        return jwks or self._read_local()
 
-        try:
-            jwks_url = f'https://login.microsoftonline.com/{self.tenant_id}/discovery/v2.0/keys'
-            response = requests.get(jwks_url)
-            jwks = response.json()
-            
-            # Cache the JWKS in Redis
-            self._redis_client.setex('jwks_cache', 86400, json.dumps(jwks))  # Cache for 24 hours
+    def get_key(self, kid):
+        """Get the appropriate key from JWKS based on the key ID, parsing each key at most once per refresh"""
+        key = self._keys.get(kid)
+        if key is not None:
+            if self._keys_fresh_until < time.monotonic():
+                self._refresh_in_background()
+            return key
+
+        self.refresh(kid)
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+        raise ValueError(f'Key ID {kid} not found in JWKS')
 
-            # Update local failover file
-            with open(self.local_jwks_file, 'w') as f:
-                json.dump(jwks, f)
+    def cache_keys(self, jwks, fresh_for=KEY_CACHE_SECONDS):
+        """Parse every key of a JWKS document into the in-memory key cache"""
+        keys = {
+            key['kid']: jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(key))
+            for key in jwks['keys']
+        }
+        with self._lock:
+            self._keys = keys
+            self._keys_fresh_until = time.monotonic() + fresh_for
 
-            return jwks
-        except Exception as e:
-            # Use local failover if available
-            if os.path.exists(self.local_jwks_file):
-                with open(self.local_jwks_file, 'r') as f:
-                    return json.load(f)
-            raise RuntimeError(f"Failed to fetch JWKS: {str(e)}")
+    def refresh(self, kid=None):
+        """
+        Bring the in-memory keys up to date, or make them hold kid. Threads that
+        arrive while another one refreshes wait for it rather than refreshing again.
+        """
+        seen = self._refreshes
+        with self._refresh_lock:
+            if self._refreshes != seen and (kid is None or kid in self._keys):
+                return
+            try:
+                self._refresh(kid)
+            except Exception as e:
+                logger.warning('JWKS refresh failed: %s', e)
+                if not self._keys:
+                    local = self._read_local()
+                    if local is not None:
+                        self.cache_keys(local, JWKS_RETRY_SECONDS)
+                else:
+                    self._keys_fresh_until = time.monotonic() + JWKS_RETRY_SECONDS
+            finally:
+                self._refreshes += 1
+
+    def _refresh(self, kid):
+        jwks, fresh = self._read_shared()
+        if fresh and _has_key(jwks, kid):
+            # another process has fetched it
+            self.cache_keys(jwks)
+            return
+
+        token = os.urandom(16).hex()
+        lock_seconds = int(JWKS_FETCH_TIMEOUT * 2) + 1
+        if self._redis_client.set(JWKS_LOCK_KEY, token, nx=True, ex=lock_seconds):
+            try:
+                if jwks is not None and not _has_key(jwks, kid) and not self._redis_client.set(
+                        JWKS_UNKNOWN_KID_KEY, 1, nx=True, ex=JWKS_UNKNOWN_KID_SECONDS):
+                    # a refetch for an unknown kid went out lately, so this one is most likely forged
+                    if not self._keys:
+                        self.cache_keys(jwks, JWKS_RETRY_SECONDS)
+                    return
+                self.cache_keys(self._fetch())
+                return
+            except Exception as e:
+                logger.warning('Failed to fetch JWKS: %s', e)
+            finally:
+                self._release_lock(keys=[JWKS_LOCK_KEY], args=[token])
+        else:
+            # another process is fetching, take its result
+            deadline = time.monotonic() + lock_seconds
+            while time.monotonic() < deadline and self._redis_client.exists(JWKS_LOCK_KEY):
+                time.sleep(0.05)
+            jwks, fresh = self._read_shared()
+            if fresh:
+                self.cache_keys(jwks)
+                return
+
+        # keep going with what there is, and try again later
+        fallback = jwks or (None if self._keys else self._read_local())
+        if fallback is not None:
+            self.cache_keys(fallback, JWKS_RETRY_SECONDS)
+        else:
+            self._keys_fresh_until = time.monotonic() + JWKS_RETRY_SECONDS
+
+    def _refresh_in_background(self):
+        if self._refresh_lock.locked():
+            return
+        with self._lock:
+            if self._background_refresh is not None and self._background_refresh.is_alive():
+                return
+            self._background_refresh = threading.Thread(target=self.refresh, name='jwks-refresh', daemon=True)
+            self._background_refresh.start()
+
+    def _read_shared(self):
+        """(jwks or None, fresh) from Redis"""
+        pipe = self._redis_client.pipeline(transaction=False)
+        pipe.get(JWKS_CACHE_KEY)
+        pipe.exists(JWKS_FRESH_KEY)
+        jwks, fresh = pipe.execute()
+        return (json.loads(jwks) if jwks else None), bool(fresh)
+
+    def _fetch(self):
+        """Fetch the JWKS from Entra ID and share it, only ever called with JWKS_LOCK_KEY held"""
+        response = requests.get(self.jwks_url, timeout=JWKS_FETCH_TIMEOUT)
+        response.raise_for_status()
+        jwks = response.json()
+        if not jwks.get('keys'):
+            raise ValueError('no keys in the JWKS response')
+
+        pipe = self._redis_client.pipeline(transaction=False)
+        pipe.set(JWKS_CACHE_KEY, json.dumps(jwks))
+        pipe.set(JWKS_FRESH_KEY, 1, ex=JWKS_REFRESH_SECONDS)
+        pipe.execute()
+        self._write_local(jwks)
+        return jwks
+
+    def _read_local(self):
+        """The failover copy written by the last successful fetch of this host"""
+        try:
+            with open(self.local_jwks_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
 
-    def get_key(self, kid):
-        """Get the appropriate key from JWKS based on the key ID"""
-        jwks = self.get_jwks()
-        for key in jwks['keys']:
-            if key['kid'] == kid:
-                return jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(key))
-        raise ValueError(f'Key ID {kid} not found in JWKS')
+    def _write_local(self, jwks):
+        try:
+            partial = f'{self.local_jwks_file}.{os.getpid()}'
+            with open(partial, 'w') as f:
+                json.dump(jwks, f)
+            os.replace(partial, self.local_jwks_file)
+        except OSError as e:
+            logger.warning('Failed to update %s: %s', self.local_jwks_file, e)
 
     def verify_access(self, token):
         """Verify if the user has the required role or group access"""
         is_valid, decoded = self.verify_token(token)
         if not is_valid:
             return False, decoded
+        return self.check_access(decoded)
 
+    def check_access(self, decoded):
+        """Check the role or group claims of an already verified token"""
         required_identifier = settings.ENTRA_APP_ACCESS_IDENTIFIER
 
         roles = decoded.get('roles', [])
@@ -68,11 +240,37 @@ class AzureADTokenVerifier:
 
         return False, "User does not have required access"
 
+    def cached_claims(self, token):
+        """Return the claims of an already verified, unexpired token or None"""
+        token_hash = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            decoded = self._verified.get(token_hash)
+            if decoded is None:
+                return None
+            if decoded.get('exp', 0) > time.time():
+                self._verified.move_to_end(token_hash)
+                return decoded
+            del self._verified[token_hash]
+            return None
+
     def verify_token(self, token):
         """
         Verify the Azure AD JWT token
         Returns (True, decoded_token) if valid, (False, error_message) if invalid
         """
+        decoded = self.cached_claims(token)
+        if decoded is not None:
+            metrics.inc('rocketvote_token_cache_total', (('result', 'hit'),))
+            return True, decoded
+        metrics.inc('rocketvote_token_cache_total', (('result', 'miss'),))
+
+        started = time.perf_counter()
+        is_valid, result = self._verify_uncached(token)
+        metrics.observe('rocketvote_token_verify_seconds', time.perf_counter() - started, (('valid', int(is_valid)),))
+        return is_valid, result
+
+    def _verify_uncached(self, token):
+        token_hash = hashlib.sha256(token.encode()).digest()
         try:
             header = jwt.get_unverified_header(token)
             kid = header.get('kid')
@@ -103,6 +301,11 @@ class AzureADTokenVerifier:
             if not decoded.get('sub'):
                 return False, "Missing subject claim"
 
+            with self._lock:
+                self._verified[token_hash] = decoded
+                if len(self._verified) > TOKEN_CACHE_SIZE:
+                    self._verified.popitem(last=False)
+
             return True, decoded
 
         except jwt.ExpiredSignatureError:
@@ -115,7 +318,9 @@ class AzureADTokenVerifier:
             return False, f"Invalid token: {str(e)}"
         except Exception as e:
             return False, f"Token verification failed: {str(e)}"
-        
+
+verifier = AzureADTokenVerifier()
+
 def oauth_callback(request):
     code = request.GET.get('code')
     return_path = request.GET.get('state', '/')
@@ -145,13 +350,11 @@ def oauth_callback(request):
         if not id_token or not access_token:
             return HttpResponseBadRequest("Missing required tokens from Azure AD")
 
-        verifier = AzureADTokenVerifier()
-        
         is_valid, decoded_token = verifier.verify_token(id_token)
         if not is_valid:
             return HttpResponseBadRequest(f"ID token verification failed: {decoded_token}")
             
-        has_access, access_result = verifier.verify_access(id_token)
+        has_access, access_result = verifier.check_access(decoded_token)
         if not has_access:
             return HttpResponseForbidden(f"Access denied: {access_result}")
 
@@ -188,13 +391,11 @@ def is_authenticated(view_func):
         if not id_token or not access_token:
             return HttpResponseForbidden('Missing required tokens')
 
-        verifier = AzureADTokenVerifier()
-        
         is_valid, result = verifier.verify_token(id_token)
         if not is_valid:
             return HttpResponseForbidden(f'Invalid ID token: {result}')
             
-        has_access, access_result = verifier.verify_access(id_token)
+        has_access, access_result = verifier.check_access(result)
         if not has_access:
             return HttpResponseForbidden(f'Access denied: {access_result}')
 
@@ -210,6 +411,56 @@ def is_authenticated(view_func):
 
     return wrapper
 
+async def averify_id_token(id_token):
+    """
+    Verify an ID token and its access claims from async code.
+    Returns (True, decoded_token) or (False, error_message)
+    """
+    result = verifier.cached_claims(id_token)
+    if result is not None:
+        metrics.inc('rocketvote_token_cache_total', (('result', 'hit'),))
+    else:
+        is_valid, result = await sync_to_async(verifier.verify_token, thread_sensitive=False)(id_token)
+        if not is_valid:
+            return False, f'Invalid ID token: {result}'
+
+    has_access, access_result = verifier.check_access(result)
+    if not has_access:
+        return False, f'Access denied: {access_result}'
+
+    return True, result
+
+async def averify_session(id_token, access_token):
+    """
+    The checks of is_authenticated, for async views and sockets: both tokens
+    present, the ID token valid and granting access. Returns (True, decoded_token)
+    or (False, error_message)
+    """
+    if not id_token or not access_token:
+        return False, 'Missing required tokens'
+    return await averify_id_token(id_token)
+
+def is_authenticated_async(view_func):
+    """Async version of is_authenticated; only cache misses leave the event loop"""
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        access_token = request.COOKIES.get('access_token')
+        is_valid, result = await averify_session(request.COOKIES.get('auth_token'), access_token)
+        if not is_valid:
+            return HttpResponseForbidden(result)
+
+        request.user = {
+            'name': result.get('name'),
+            'email': result.get('preferred_username'),
+            'object_id': result.get('oid'),
+        }
+        request.azure_user = result
+        request.access_token = access_token
+
+        return await view_func(request, *args, **kwargs)
+
+    return wrapper
+
 def verify_auth(request):
     id_token = request.COOKIES.get('auth_token')
     access_token = request.COOKIES.get('access_token')
@@ -220,8 +471,6 @@ def verify_auth(request):
             'error': 'Missing required tokens'
         }, status=401)
 
-    verifier = AzureADTokenVerifier()
-    
     is_valid, result = verifier.verify_token(id_token)
     if not is_valid:
         return JsonResponse({
@@ -229,7 +478,7 @@ def verify_auth(request):
             'error': result
         }, status=401)
         
-    has_access, access_result = verifier.verify_access(id_token)
+    has_access, access_result = verifier.check_access(result)
     if not has_access:
         return JsonResponse({
             'authenticated': False,
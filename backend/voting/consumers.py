@@ -1,32 +1,150 @@
-import json
+import asyncio
+import os
+import time
+from http.cookies import SimpleCookie
+
+import orjson
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from .auth import averify_session
+from .fanout import LOCAL_FANOUT, local_fanout, poll_revealed_frame
+from .metrics import metrics
+from .presence import presence
+from .redis_pool import get_async_redis_connection
+from .utils import aget_poll_counts, aget_poll_from_creation_id, aget_poll_results
+
+ADMIN_UPDATES_PER_SECOND = float(os.getenv('ADMIN_UPDATES_PER_SECOND', '4'))
+
+def admin_group_name(poll_id):
+    return f'poll_admin_{poll_id}'
+
 class PollConsumer(AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(args, kwargs)
         self.room_group_name = None
         self.poll_id = None
+        self.accepted = False
 
     async def connect(self):
         self.poll_id = self.scope['url_route']['kwargs']['poll_id']
         self.room_group_name = f'poll_{self.poll_id}'
 
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        if LOCAL_FANOUT:
+            await local_fanout.add(self.poll_id, self)
+        else:
+            await self.channel_layer.group_add(
+                self.room_group_name,
+                self.channel_name
+            )
 
         await self.accept()
+        self.accepted = True
+        metrics.gauge_add('rocketvote_websockets', (('consumer', 'participant'),), 1)
+        presence.add(self.poll_id)
 
     async def disconnect(self, close_code):
+        if self.accepted:
+            metrics.gauge_add('rocketvote_websockets', (('consumer', 'participant'),), -1)
+            presence.discard(self.poll_id)
+        if LOCAL_FANOUT:
+            await local_fanout.discard(self.poll_id, self)
+            return
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
     async def poll_revealed(self, event):
-        await self.send(text_data=json.dumps({
-            'poll_id': self.poll_id,
-            'results_revealed': True
-        }))
+        # events from workers that predate the serialized frame carry the results
+        frame = event.get('frame') or poll_revealed_frame(self.poll_id, event.get('results'))
+        await self.send(text_data=frame)
+
+class PollAdminConsumer(AsyncWebsocketConsumer):
+    """
+    Live results for the poll admin page. Sends the full results once on connect,
+    then coalesces the vote_cast events published by cast_vote and flushes the
+    changed ballots, with the current counts, at most ADMIN_UPDATES_PER_SECOND
+    times per second. Counts are re-read per flush (one small ZREVRANGE) rather
+    than summed from events, so a vote seen by both snapshot and delta is not
+    counted twice.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.room_group_name = None
+        self.poll_id = None
+        self.options = None
+        self.pending_votes = {}
+        self.flush_task = None
+        self.last_flush = 0.0
+        self.accepted = False
+
+    async def connect(self):
+        cookies = SimpleCookie()
+        cookies.load(dict(self.scope['headers']).get(b'cookie', b'').decode())
+        # the same credentials GET /create/<creation_id> wants
+        is_valid, _ = await averify_session(
+            *(cookies[name].value if name in cookies else None for name in ('auth_token', 'access_token'))
+        )
+        if not is_valid:
+            await self.close()
+            return
+
+        redis_conn = get_async_redis_connection()
+        creation_id = self.scope['url_route']['kwargs']['creation_id']
+        poll = await aget_poll_from_creation_id(redis_conn, creation_id)
+        if poll[1] is None:
+            await self.close()
+            return
+
+        self.poll_id, metadata = poll
+        self.options = metadata['options']
+        self.room_group_name = admin_group_name(self.poll_id)
+        await self.channel_layer.group_add(
+            self.room_group_name,
+            self.channel_name
+        )
+        await self.accept()
+        self.accepted = True
+        metrics.gauge_add('rocketvote_websockets', (('consumer', 'admin'),), 1)
+
+        # joined the group before reading, so no vote falls between snapshot and deltas
+        votes, counts = await aget_poll_results(redis_conn, self.poll_id, self.options)
+        await self.send(text_data=orjson.dumps({
+            'type': 'snapshot',
+            'metadata': metadata,
+            'votes': votes,
+            'counts': counts,
+        }).decode('utf-8'))
+
+    async def disconnect(self, close_code):
+        if self.accepted:
+            metrics.gauge_add('rocketvote_websockets', (('consumer', 'admin'),), -1)
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        if self.room_group_name is not None:
+            await self.channel_layer.group_discard(
+                self.room_group_name,
+                self.channel_name
+            )
+
+    async def vote_cast(self, event):
+        self.pending_votes[event['voter']] = event['votes']
+
+        if self.flush_task is None:
+            delay = max(0.0, self.last_flush + 1 / ADMIN_UPDATES_PER_SECOND - time.monotonic())
+            self.flush_task = asyncio.create_task(self.flush(delay))
+
+    async def flush(self, delay):
+        await asyncio.sleep(delay)
+        votes = self.pending_votes
+        self.pending_votes = {}
+        self.flush_task = None
+        self.last_flush = time.monotonic()
+
+        counts = await aget_poll_counts(get_async_redis_connection(), self.poll_id, self.options)
 
+        await self.send(text_data=orjson.dumps({
+            'type': 'delta',
+            'counts': counts,
+            'votes': votes,
+        }).decode('utf-8'))
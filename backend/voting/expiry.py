@@ -0,0 +1,81 @@
+import json
+import os
+import time
+
+from .keys import creation_key, metadata_key, poll_keys
+from .poll_cache import INVALIDATION_CHANNEL, poll_cache
+
+# Polls are deleted by sweep_expired_polls, which celery beat runs every
+# POLL_SWEEP_SECONDS (CELERY_BEAT_SCHEDULE). It reads the due entries of one
+# sorted set of deadlines (creation_id scored by unix time), so each tick costs
+# what expires in it, not what is outstanding. Every key also gets a native TTL
+# EXPIRY_GRACE_SECONDS past its deadline, which only fires if the sweeper has
+# stopped running.
+DEADLINES_KEY = 'poll_deadlines'
+
+delete_seconds = int(os.getenv('AUTO_DELETE_DAYS', '10'))*24*60*60
+unrevealed_delete_seconds = int(os.getenv('AUTO_DELETE_UNREVEALED_DAYS', '30'))*24*60*60
+EXPIRY_GRACE_SECONDS = int(os.getenv('EXPIRY_GRACE_SECONDS', str(24*60*60)))
+POLL_SWEEP_BATCH = int(os.getenv('POLL_SWEEP_BATCH', '500'))
+
+
+def schedule_poll_expiry(redis_conn, creation_id, poll_id, seconds, options=()):
+    """
+    (Re)set the deadline of a poll to `seconds` from now, along with the TTL of
+    its keys. Pass the poll's options once votes may exist, so the option sets
+    get a TTL too. Works with sync and async clients.
+    """
+    pipe = redis_conn.pipeline(transaction=False)
+    queue_poll_expiry(pipe, creation_id, poll_id, seconds, options)
+    return pipe.execute()
+
+
+def queue_poll_expiry(pipe, creation_id, poll_id, seconds, options=()):
+    """The commands of schedule_poll_expiry, added to a pipeline the caller executes"""
+    deadline = int(time.time()) + seconds
+    pipe.zadd(DEADLINES_KEY, {creation_id: deadline})
+    for key in [creation_key(creation_id), *poll_keys(poll_id, options)]:
+        pipe.expireat(key, deadline + EXPIRY_GRACE_SECONDS)
+
+
+def delete_polls(redis_conn, creation_ids):
+    """UNLINK every key of the given polls in one pipelined round trip after two lookups. Returns the deleted poll ids."""
+    pipe = redis_conn.pipeline(transaction=False)
+    for creation_id in creation_ids:
+        pipe.get(creation_key(creation_id))
+    poll_ids = [poll_id.decode('utf-8') if poll_id else None for poll_id in pipe.execute()]
+
+    pipe = redis_conn.pipeline(transaction=False)
+    for poll_id in poll_ids:
+        if poll_id:
+            pipe.hget(metadata_key(poll_id), 'options')
+    # string (pre-hash) metadata answers WRONGTYPE, such polls predate the option sets
+    options = iter(pipe.execute(raise_on_error=False))
+
+    deleted = []
+    pipe = redis_conn.pipeline(transaction=False)
+    for creation_id, poll_id in zip(creation_ids, poll_ids):
+        if poll_id:
+            poll_options = next(options)
+            poll_options = json.loads(poll_options) if isinstance(poll_options, bytes) else []
+            pipe.unlink(*poll_keys(poll_id, poll_options))
+            pipe.publish(INVALIDATION_CHANNEL, poll_id)
+            deleted.append(poll_id)
+        pipe.unlink(creation_key(creation_id))
+    pipe.zrem(DEADLINES_KEY, *creation_ids)
+    pipe.execute()
+
+    for poll_id in deleted:
+        poll_cache.invalidate(poll_id)
+    return deleted
+
+
+def sweep_expired_polls(redis_conn, now=None, batch=POLL_SWEEP_BATCH):
+    """Delete every poll whose deadline has passed, `batch` polls per round trip. Returns how many were deleted."""
+    now = now or time.time()
+    swept = 0
+    while True:
+        due = [creation_id.decode('utf-8') for creation_id in redis_conn.zrangebyscore(DEADLINES_KEY, '-inf', now, start=0, num=batch)]
+        if not due:
+            return swept
+        swept += len(delete_polls(redis_conn, due))
@@ -0,0 +1,67 @@
+import csv
+import json
+import os
+
+from .keys import votes_key
+from .vote_engine import decode_ballot
+
+# Ballots per HSCAN call (and per database fetch for archived polls) when
+# exporting. Every page is encoded and sent before the next one is read, so an
+# export holds one page in memory whatever the size of the poll.
+EXPORT_BATCH = int(os.getenv('EXPORT_BATCH', '1000'))
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+async def ballot_pages(redis_conn, poll_id, options):
+    """[(voter, votes)] per HSCAN page of {poll_id}:votes, async client"""
+    cursor = 0
+    while True:
+        cursor, votes = await redis_conn.hscan(votes_key(poll_id), cursor, count=EXPORT_BATCH)
+        if votes:
+            yield [(voter.decode('utf-8'), decode_ballot(ballot, options)) for voter, ballot in votes.items()]
+        if cursor == 0:
+            return
+
+
+async def archived_ballot_pages(archived):
+    """[(voter, votes)] pages of an archived poll, read through a database cursor"""
+    page = []
+    # values(), not values_list(): the latter runs its query on the event loop thread under aiterator()
+    async for ballot in archived.ballots.order_by('id').values('voter', 'votes').aiterator(chunk_size=EXPORT_BATCH):
+        page.append((ballot['voter'], ballot['votes']))
+        if len(page) >= EXPORT_BATCH:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+class _Echo:
+    """csv.writer target that hands the formatted row back instead of buffering it"""
+
+    def write(self, value):
+        return value
+
+
+async def encode_export(pages, options, export_format):
+    """
+    Bytes chunks, one per page:
+      csv     a voter column, then one column per option, 1 where the ballot has it
+      ndjson  {"voter": ..., "votes": [...]} per line
+    """
+    if export_format == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(['voter', *options]).encode('utf-8')
+        async for page in pages:
+            yield ''.join(
+                writer.writerow([voter, *('1' if option in votes else '0' for option in options)])
+                for voter, votes in page
+            ).encode('utf-8')
+    else:
+        async for page in pages:
+            yield ''.join(
+                json.dumps({'voter': voter, 'votes': votes}) + '\n' for voter, votes in page
+            ).encode('utf-8')
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import os
+
+import orjson
+import redis.asyncio
+
+from .redis_pool import REDIS_URL
+
+logger = logging.getLogger(__name__)
+
+# How the reveal reaches participant sockets:
+#   group  one group_send to poll_<poll_id>, channels_redis pushes a message
+#          through Redis for every socket in the group
+#   local  every worker process subscribes once to the poll's reveal channel,
+#          for as long as it holds sockets of that poll, and writes the one
+#          published frame to its own sockets
+REVEAL_FANOUT = os.getenv('REVEAL_FANOUT', 'group')
+LOCAL_FANOUT = REVEAL_FANOUT == 'local'
+
+
+def reveal_channel(poll_id):
+    return f'poll_reveal:{poll_id}'
+
+
+def poll_revealed_frame(poll_id, results):
+    """The text frame participant sockets get on reveal"""
+    return orjson.dumps({
+        'poll_id': poll_id,
+        'results_revealed': True,
+        'results': results,
+    }).decode('utf-8')
+
+
+def publish_reveal(redis_conn, poll_id, frame):
+    """
+    Send the reveal frame (poll_revealed_event's) to every worker holding sockets
+    of the poll. Works with sync and async clients, cluster ones included: PUBLISH
+    goes by name, as the async cluster client has no publish(), and any node
+    broadcasts it to the rest.
+    """
+    return redis_conn.execute_command('PUBLISH', reveal_channel(poll_id), frame)
+
+
+class LocalFanout:
+    """
+    The sockets of this worker process by poll, and one pub/sub connection
+    subscribed to the reveal channel of each of those polls. Lives in the
+    event loop of the ASGI server, all methods must be called from there.
+    """
+
+    def __init__(self):
+        self._sockets = {}
+        self._pubsub = None
+        self._reader = None
+
+    async def add(self, poll_id, consumer):
+        sockets = self._sockets.get(poll_id)
+        if sockets is None:
+            sockets = self._sockets[poll_id] = set()
+            await self._subscribe(poll_id)
+        sockets.add(consumer)
+
+    async def discard(self, poll_id, consumer):
+        sockets = self._sockets.get(poll_id)
+        if sockets is None:
+            return
+        sockets.discard(consumer)
+        if not sockets:
+            del self._sockets[poll_id]
+            try:
+                await self._pubsub.unsubscribe(reveal_channel(poll_id))
+            except Exception as e:
+                # the reader reconnects and only resubscribes to polls with sockets
+                logger.warning('Reveal fan-out unsubscribe failed: %s', e)
+
+    async def _subscribe(self, poll_id):
+        if self._pubsub is None:
+            # a node of its own: the cluster clients have no async pub/sub
+            self._pubsub = redis.asyncio.Redis.from_url(REDIS_URL).pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(reveal_channel(poll_id))
+        if self._reader is None:
+            self._reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+                if message is not None:
+                    await self._deliver(message['channel'].decode('utf-8'), message['data'].decode('utf-8'))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning('Reveal fan-out listener failed: %s', e)
+                await asyncio.sleep(1)
+                try:
+                    if not await self._resubscribe():
+                        return
+                except Exception as e:
+                    # the next get_message fails too and retries
+                    logger.warning('Reveal fan-out resubscribe failed: %s', e)
+
+    async def _resubscribe(self):
+        """New pub/sub connection for the polls that still have sockets. Returns False (and stops reading) if there are none."""
+        try:
+            await self._pubsub.aclose()
+        except Exception:
+            pass
+        self._pubsub = redis.asyncio.Redis.from_url(REDIS_URL).pubsub(ignore_subscribe_messages=True)
+        if not self._sockets:
+            self._reader = None
+            return False
+        await self._pubsub.subscribe(*(reveal_channel(poll_id) for poll_id in self._sockets))
+        return True
+
+    async def _deliver(self, channel, frame):
+        poll_id = channel.removeprefix(reveal_channel(''))
+        sockets = list(self._sockets.get(poll_id, ()))
+        # concurrently, so one slow client doesn't hold up the rest
+        await asyncio.gather(*(consumer.send(text_data=frame) for consumer in sockets), return_exceptions=True)
+
+
+local_fanout = LocalFanout()
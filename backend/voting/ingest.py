@@ -0,0 +1,271 @@
+import os
+import time
+
+import redis
+
+from .keys import ballots_stream_key, metadata_key, poll_keys
+from .redis_pool import REDIS_CLUSTER, LazyScript
+from .vote_engine import BALLOT_LUA, POLL_CLOSED, VOTE_OK, decode_ballot, encode_ballot
+
+# With VOTE_INGESTION_MODE=stream, cast_vote only validates the ballot and
+# appends it to the poll's stream, and the ingest_votes command applies the
+# stream in batches through a consumer group:
+#   - at least once: entries are acked (and deleted) in the same script that
+#     applies them, entries of a dead consumer are claimed after
+#     INGEST_CLAIM_IDLE_MS
+#   - last write wins: the id of the last entry applied for a voter is kept in
+#     the applied hash, older entries (redeliveries) are skipped
+STREAM_INGESTION = os.getenv('VOTE_INGESTION_MODE', 'direct') == 'stream'
+INGEST_GROUP = 'ingest'
+INGEST_BATCH = int(os.getenv('INGEST_BATCH', '500'))
+INGEST_CLAIM_IDLE_MS = int(os.getenv('INGEST_CLAIM_IDLE_MS', '30000'))
+# poll ids whose ballots stream has entries, for the workers to walk. Every
+# enqueue adds its poll, workers remove the ones that stayed empty for
+# INGEST_IDLE_SECONDS (release_stream).
+STREAMS_KEY = 'ballot_streams'
+INGEST_IDLE_SECONDS = float(os.getenv('INGEST_IDLE_SECONDS', '5'))
+# On a cluster STREAMS_KEY is in another slot than the poll, so enqueues add
+# the poll after the script and workers look for streams missed by an enqueue
+# that died in between, every INGEST_DISCOVER_SECONDS (discover_streams).
+INGEST_DISCOVER_SECONDS = float(os.getenv('INGEST_DISCOVER_SECONDS', '60'))
+
+# KEYS: metadata, ballots stream, STREAMS_KEY (left out on a cluster)
+# ARGV: consumer group, voter_id, encoded ballot, poll_id
+#
+# Refuses ballots for missing or revealed polls, like CAST_VOTE_LUA, then
+# queues the ballot and registers the stream. Returns {status, entry id}.
+ENQUEUE_BALLOT_LUA = """
+local revealed = redis.call('HGET', KEYS[1], 'revealed')
+if not revealed or revealed == '1' then
+    return {0, ''}
+end
+
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    redis.call('XGROUP', 'CREATE', KEYS[2], ARGV[1], '0', 'MKSTREAM')
+    local expire_at = redis.call('PEXPIRETIME', KEYS[1])
+    if expire_at > 0 then
+        redis.call('PEXPIREAT', KEYS[2], expire_at)
+    end
+end
+
+local id = redis.call('XADD', KEYS[2], '*', 'voter', ARGV[2], 'ballot', ARGV[3])
+if KEYS[3] then
+    redis.call('SADD', KEYS[3], ARGV[4])
+end
+return {1, id}
+"""
+
+# KEYS: ballots stream, STREAMS_KEY
+# ARGV: poll_id
+#
+# Deregisters the stream if it is empty. Applied entries are deleted with
+# their ack, so an empty stream has nothing in flight either.
+RELEASE_STREAM_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 and redis.call('XLEN', KEYS[1]) > 0 then
+    return 0
+end
+redis.call('SREM', KEYS[2], ARGV[1])
+return 1
+"""
+
+# ARGV after N: consumer group, then entry id, voter_id, encoded ballot for every entry
+#
+# Applies the entries that are newer than the last one applied for their
+# voter, timed by their entry id (when the ballot was queued), then acks and
+# deletes all of them. Doesn't look at revealed: the
+# ballots were accepted before the reveal, which drains the stream (drain_poll).
+# Returns voter, ballot, previous ballot for every entry applied.
+APPLY_BALLOTS_LUA = BALLOT_LUA + """
+local stream = KEYS[6 + option_count]
+local applied = KEYS[7 + option_count]
+local group = ARGV[2]
+
+local function newer(id, last)
+    local id_ms, id_seq = string.match(id, '(%d+)-(%d+)')
+    local last_ms, last_seq = string.match(last, '(%d+)-(%d+)')
+    if id_ms ~= last_ms then
+        return tonumber(id_ms) > tonumber(last_ms)
+    end
+    return tonumber(id_seq) > tonumber(last_seq)
+end
+
+local results = {}
+local ids = {}
+for i = 3, #ARGV, 3 do
+    local id, voter, ballot = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+    local last = redis.call('HGET', applied, voter)
+    if not last or newer(id, last) then
+        table.insert(results, voter)
+        table.insert(results, ballot)
+        table.insert(results, apply_ballot(voter, ballot, math.floor(tonumber(string.match(id, '^(%d+)')) / 1000)))
+        redis.call('HSET', applied, voter, id)
+    end
+    table.insert(ids, id)
+end
+
+if #ids > 0 then
+    redis.call('XACK', stream, group, unpack(ids))
+    redis.call('XDEL', stream, unpack(ids))
+end
+if expire_at > 0 and redis.call('PTTL', applied) == -1 then
+    redis.call('PEXPIREAT', applied, expire_at)
+end
+
+return results
+"""
+
+_enqueue_script = LazyScript(ENQUEUE_BALLOT_LUA)
+_async_enqueue_script = LazyScript(ENQUEUE_BALLOT_LUA)
+_apply_script = LazyScript(APPLY_BALLOTS_LUA)
+_release_script = LazyScript(RELEASE_STREAM_LUA)
+
+
+def _enqueue_keys(poll_id):
+    keys = [metadata_key(poll_id), ballots_stream_key(poll_id)]
+    return keys if REDIS_CLUSTER else keys + [STREAMS_KEY]
+
+
+def enqueue_ballot(redis_conn, poll_id, voter_id, votes, options):
+    """Queue voter_id's ballot for the ingest worker. Returns VOTE_OK or POLL_CLOSED."""
+    status, _ = _enqueue_script(
+        keys=_enqueue_keys(poll_id),
+        args=[INGEST_GROUP, voter_id, encode_ballot(votes, options), poll_id],
+        client=redis_conn,
+    )
+    if status and REDIS_CLUSTER:
+        redis_conn.sadd(STREAMS_KEY, poll_id)
+    return VOTE_OK if status else POLL_CLOSED
+
+
+async def aenqueue_ballot(redis_conn, poll_id, voter_id, votes, options):
+    status, _ = await _async_enqueue_script(
+        keys=_enqueue_keys(poll_id),
+        args=[INGEST_GROUP, voter_id, encode_ballot(votes, options), poll_id],
+        client=redis_conn,
+    )
+    if status and REDIS_CLUSTER:
+        await redis_conn.sadd(STREAMS_KEY, poll_id)
+    return VOTE_OK if status else POLL_CLOSED
+
+
+def release_stream(redis_conn, poll_id):
+    """Stop walking poll_id's stream if it is empty, the next enqueue adds it back. Returns True if it was."""
+    stream = ballots_stream_key(poll_id)
+    if not REDIS_CLUSTER:
+        return bool(_release_script(keys=[stream, STREAMS_KEY], args=[poll_id], client=redis_conn))
+    # enqueues add the entry before the poll, so removing before looking can't lose one
+    redis_conn.srem(STREAMS_KEY, poll_id)
+    if redis_conn.xlen(stream):
+        redis_conn.sadd(STREAMS_KEY, poll_id)
+        return False
+    return True
+
+
+def discover_streams(redis_conn):
+    """Register the ballots streams that have entries but are missing from STREAMS_KEY. Returns their poll ids."""
+    registered = {poll_id.decode('utf-8') for poll_id in redis_conn.smembers(STREAMS_KEY)}
+    missing = []
+    for key in redis_conn.scan_iter(match='{*}:ballots', count=1000, _type='stream'):
+        poll_id = key.decode('utf-8')[1:-len('}:ballots')]
+        if poll_id not in registered and redis_conn.xlen(key):
+            missing.append(poll_id)
+    if missing:
+        redis_conn.sadd(STREAMS_KEY, *missing)
+    return missing
+
+
+def apply_entries(redis_conn, poll_id, options, entries):
+    """Apply (entry id, fields) stream entries. Returns [(voter, votes, previous votes)] for the ones that won."""
+    args = [len(options), INGEST_GROUP]
+    for entry_id, fields in entries:
+        args += [entry_id, fields[b'voter'], fields[b'ballot']]
+    results = _apply_script(keys=poll_keys(poll_id, options), args=args, client=redis_conn)
+    return [
+        (results[i].decode('utf-8'), decode_ballot(results[i + 1], options), decode_ballot(results[i + 2], options))
+        for i in range(0, len(results), 3)
+    ]
+
+
+def ingest_poll(redis_conn, poll_id, options, consumer, batch=INGEST_BATCH, claim_idle_ms=INGEST_CLAIM_IDLE_MS):
+    """
+    Apply one batch of poll_id's stream as `consumer`: entries a dead consumer
+    left unacked for claim_idle_ms first, then new ones. Returns (entries
+    consumed, what apply_entries returns): superseded entries are consumed
+    without being applied.
+    """
+    stream = ballots_stream_key(poll_id)
+    _, entries, *_ = redis_conn.xautoclaim(stream, INGEST_GROUP, consumer, claim_idle_ms, count=batch)
+    if len(entries) < batch:
+        for _, new_entries in redis_conn.xreadgroup(INGEST_GROUP, consumer, {stream: '>'}, count=batch - len(entries)):
+            entries += new_entries
+    # a claimed entry deleted meanwhile comes back without fields
+    entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+    if not entries:
+        return 0, []
+    return len(entries), apply_entries(redis_conn, poll_id, options, entries)
+
+
+def drain_poll(redis_conn, poll_id, options, timeout=2.0):
+    """
+    Apply whatever is left in poll_id's stream, after the reveal has stopped new
+    ballots. Batches other workers hold get `timeout` seconds to be applied,
+    then are taken over: an entry applied twice is skipped the second time.
+    Returns True once the stream is empty.
+    """
+    consumer = f'drain-{os.getpid()}'
+    stream = ballots_stream_key(poll_id)
+    deadline = time.monotonic() + timeout
+    joined = False
+    while redis_conn.xlen(stream):
+        claim_idle_ms = 0 if time.monotonic() > deadline else INGEST_CLAIM_IDLE_MS
+        joined = True
+        if ingest_poll(redis_conn, poll_id, options, consumer, claim_idle_ms=claim_idle_ms)[0]:
+            continue
+        if not claim_idle_ms:
+            # nothing to claim but the stream isn't empty: an entry is being added or deleted right now
+            return False
+        time.sleep(0.05)
+
+    if joined:
+        # reading made this process a consumer of the group, it has nothing pending any more
+        try:
+            redis_conn.xgroup_delconsumer(stream, INGEST_GROUP, consumer)
+        except redis.ResponseError:
+            # the poll expired meanwhile (NOGROUP)
+            pass
+    return True
+
+
+def _ingestion_lag(backlog, pending, oldest):
+    oldest_seconds = round(time.time() - int(oldest[0][0].split(b'-')[0]) / 1000, 3) if oldest else 0
+    return {
+        'backlog': backlog,
+        'in_flight': pending['pending'] if pending else 0,
+        'oldest_seconds': max(oldest_seconds, 0),
+    }
+
+
+def _ingestion_lag_pipeline(redis_conn, poll_id):
+    # applied entries are deleted, so the stream only holds what is left to apply
+    stream = ballots_stream_key(poll_id)
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.xlen(stream)
+    pipe.xpending(stream, INGEST_GROUP)
+    pipe.xrange(stream, count=1)
+    return pipe
+
+
+def get_ingestion_lag(redis_conn, poll_id):
+    """Ballots queued for poll_id, how many a worker is applying, and the age of the oldest"""
+    try:
+        return _ingestion_lag(*_ingestion_lag_pipeline(redis_conn, poll_id).execute())
+    except redis.ResponseError:
+        # no stream yet (NOGROUP)
+        return _ingestion_lag(0, None, [])
+
+
+async def aget_ingestion_lag(redis_conn, poll_id):
+    try:
+        return _ingestion_lag(*await _ingestion_lag_pipeline(redis_conn, poll_id).execute())
+    except redis.ResponseError:
+        return _ingestion_lag(0, None, [])
@@ -0,0 +1,72 @@
+# Redis key layout. Every key of a poll carries the poll id as a cluster hash
+# tag ({poll_id}), so they all hash to the same slot and the multi-key vote
+# scripts and pipelines stay legal on Redis Cluster. The creation id key only
+# ever takes part in single-key commands, it gets its own tag.
+
+def metadata_key(poll_id):
+    return f'{{{poll_id}}}:metadata'
+
+def votes_key(poll_id):
+    return f'{{{poll_id}}}:votes'
+
+def count_key(poll_id):
+    return f'{{{poll_id}}}:count'
+
+def version_key(poll_id):
+    return f'{{{poll_id}}}:version'
+
+def changes_key(poll_id):
+    return f'{{{poll_id}}}:changes'
+
+def option_voters_key(poll_id, index):
+    """Set of the voter ids whose current ballot includes the option at index"""
+    return f'{{{poll_id}}}:voters:{index}'
+
+def legacy_option_voters_key(poll_id, option):
+    """Option set keyed by the option text, before ballots were index encoded"""
+    return f'{{{poll_id}}}:opt:{option}'
+
+def ballots_stream_key(poll_id):
+    """Ballots waiting for the ingest worker, when VOTE_INGESTION_MODE=stream"""
+    return f'{{{poll_id}}}:ballots'
+
+def applied_key(poll_id):
+    """voter -> id of the last stream entry applied for them"""
+    return f'{{{poll_id}}}:applied'
+
+def snapshot_key(poll_id):
+    """The participant GET body of a revealed poll, serialized once on reveal (see snapshot.py)"""
+    return f'{{{poll_id}}}:snapshot'
+
+def presence_key(poll_id):
+    """worker id -> participant sockets it holds, refreshed by every worker's heartbeat (see presence.py)"""
+    return f'{{{poll_id}}}:presence'
+
+def timeline_key(poll_id, resolution):
+    """bucket start (unix seconds) -> ballots cast in it, resolution 'second' or 'minute'"""
+    return f'{{{poll_id}}}:timeline:{resolution}'
+
+def creation_key(creation_id):
+    return f'{{{creation_id}}}:poll_id'
+
+def templates_generation_key(user_id):
+    """Bumped on every template write of the user, see template_cache.py"""
+    return f'{{templates:{user_id}}}:generation'
+
+def templates_cache_key(user_id):
+    """search query -> cached templates response"""
+    return f'{{templates:{user_id}}}:cache'
+
+def poll_keys(poll_id, options=()):
+    """Every key holding data of the poll, all in one slot. The vote scripts rely on this order."""
+    return [
+        metadata_key(poll_id), votes_key(poll_id), count_key(poll_id), version_key(poll_id), changes_key(poll_id),
+        *(option_voters_key(poll_id, index) for index in range(len(options))),
+        ballots_stream_key(poll_id), applied_key(poll_id), snapshot_key(poll_id), presence_key(poll_id),
+        timeline_key(poll_id, 'second'), timeline_key(poll_id, 'minute'),
+    ]
+
+def tagged_key(legacy_key):
+    """'<id>:rest' (the layout before hash tags) -> '{<id>}:rest'. Ids are nanoids, they never contain ':'."""
+    key_id, _, rest = legacy_key.partition(':')
+    return f'{{{key_id}}}:{rest}'
@@ -0,0 +1,120 @@
+"""Helpers shared by the benchmark management commands."""
+import json
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+import redis
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.conf import settings
+
+from voting import auth
+
+# the /metrics bearer token of the workers the benchmarks start, it is only served with one
+BENCH_METRICS_TOKEN = 'bench-metrics'
+
+
+def make_signing_key(kid='bench-kid'):
+    """Return (private_key, jwks) for a throwaway RS256 key"""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    public_jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    return private_key, {'keys': [{**public_jwk, 'kid': kid, 'use': 'sig'}]}
+
+
+def mint_token(private_key, kid='bench-kid', **claims):
+    now = int(time.time())
+    payload = {
+        'iss': f"https://login.microsoftonline.com/{settings.MICROSOFT_AUTH['TENANT_ID']}/v2.0",
+        'aud': settings.MICROSOFT_AUTH['CLIENT_ID'],
+        'sub': 'bench-subject',
+        'oid': 'bench-oid',
+        'name': 'Bench User',
+        'preferred_username': 'bench@example.com',
+        'roles': [settings.ENTRA_APP_ACCESS_IDENTIFIER],
+        'iat': now,
+        'nbf': now,
+        'exp': now + 3600,
+        **claims,
+    }
+    return jwt.encode(payload, private_key, algorithm='RS256', headers={'kid': kid})
+
+
+def summarize(latencies, elapsed):
+    """Throughput and latency percentiles (ms) for a list of per-request seconds"""
+    latencies = sorted(latencies)
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': quantiles[49] * 1000,
+        'p95': quantiles[94] * 1000,
+        'p99': quantiles[98] * 1000,
+    }
+
+
+def install_jwks(jwks):
+    """
+    Put jwks in the verifier's Redis cache, marked fresh so no worker goes to
+    Entra ID for newer keys, or with None empty it so the first one has to.
+    Returns a function that puts back what was there.
+    """
+    jwks_redis = redis.StrictRedis(host='redis', port=6379, db=4)
+    keys = (auth.JWKS_CACHE_KEY, auth.JWKS_FRESH_KEY, auth.JWKS_UNKNOWN_KID_KEY)
+    previous = [(key, jwks_redis.get(key), jwks_redis.pttl(key)) for key in keys]
+    jwks_redis.delete(*keys)
+    if jwks is not None:
+        jwks_redis.set(auth.JWKS_CACHE_KEY, json.dumps(jwks))
+        jwks_redis.set(auth.JWKS_FRESH_KEY, 1, ex=auth.JWKS_REFRESH_SECONDS)
+
+    def restore():
+        for key, value, ttl in previous:
+            if value is None:
+                jwks_redis.delete(key)
+            else:
+                jwks_redis.set(key, value, px=ttl if ttl > 0 else None)
+
+    return restore
+
+
+class JwksStandIn:
+    """
+    Serves a JWKS document over HTTP in a thread, standing in for Entra ID's
+    discovery endpoint. jwks can be swapped to rotate keys, delay slows every
+    answer down and failing answers 503.
+    """
+
+    def __init__(self, jwks, delay=0.0):
+        stand_in = self
+        self.jwks = jwks
+        self.delay = delay
+        self.failing = False
+        self.fetches = 0
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stand_in._lock:
+                    stand_in.fetches += 1
+                time.sleep(stand_in.delay)
+                if stand_in.failing:
+                    self.send_error(503)
+                    return
+                body = json.dumps(stand_in.jwks).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/{settings.MICROSOFT_AUTH["TENANT_ID"]}/discovery/v2.0/keys'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,57 @@
+import random
+import time
+
+import redis
+from django.core.management.base import BaseCommand
+from nanoid import generate
+
+from voting.archive import archive_poll
+from voting.expiry import DEADLINES_KEY, delete_seconds, schedule_poll_expiry
+from voting.keys import creation_key, metadata_key, poll_keys
+from voting.models import ArchivedPoll
+from voting.redis_pool import get_redis_connection
+from voting.utils import make_poll_metadata, set_poll_revealed
+from voting.vote_engine import cast_ballot
+
+
+class Command(BaseCommand):
+    help = 'Fill and reveal a poll, archive it to the database and report the Redis memory freed and the archive time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--voters', type=int, default=10000)
+        parser.add_argument('--options', type=int, default=4)
+        parser.add_argument('--redis-url', default=None, help='defaults to the app connection pool')
+
+    def handle(self, *args, **options):
+        redis_conn = redis.Redis.from_url(options['redis_url']) if options['redis_url'] else get_redis_connection()
+        poll_id = f'bench-{generate(size=8)}'
+        creation_id = f'bench-{generate(size=8)}'
+        poll_options = [f'option {i}' for i in range(options['options'])]
+        redis_conn.hset(metadata_key(poll_id), mapping=make_poll_metadata({
+            'description': 'bench', 'type': 'bench', 'revealed': '0',
+            'multi_selection': '0', 'anonymous': '0', 'options': poll_options,
+        }))
+        redis_conn.set(creation_key(creation_id), poll_id)
+        for v in range(options['voters']):
+            cast_ballot(redis_conn, poll_id, f'voter{v}@example.com', [random.choice(poll_options)], poll_options)
+        set_poll_revealed(redis_conn, poll_id)
+        schedule_poll_expiry(redis_conn, creation_id, poll_id, delete_seconds, poll_options)
+
+        keys = [creation_key(creation_id), *poll_keys(poll_id, poll_options)]
+        poll_bytes = sum(redis_conn.memory_usage(key, samples=0) or 0 for key in keys)
+        used_before = redis_conn.info('memory')['used_memory']
+
+        started = time.perf_counter()
+        archived = archive_poll(redis_conn, creation_id)
+        elapsed = time.perf_counter() - started
+
+        used_after = redis_conn.info('memory')['used_memory']
+        try:
+            self.stdout.write(
+                f"{options['voters']} voters | archived {archived.ballots.count()} ballots in {elapsed * 1000:,.0f} ms | "
+                f"poll keys {poll_bytes:,} bytes ({poll_bytes / options['voters']:.1f} bytes/voter) | "
+                f"used_memory {used_before - used_after:+,} bytes freed"
+            )
+        finally:
+            ArchivedPoll.objects.filter(creation_id=creation_id).delete()
+            redis_conn.zrem(DEADLINES_KEY, creation_id)
@@ -0,0 +1,83 @@
+import json
+import statistics
+import time
+
+import jwt
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from voting import auth
+
+from ._bench import make_signing_key, mint_token
+
+
+class UncachedVerifier(auth.AzureADTokenVerifier):
+    """Mimics the old per-request verifier: JWKS parsed and keys rebuilt on every lookup, no token cache"""
+
+    def __init__(self, jwks):
+        super().__init__()
+        self._jwks = json.dumps(jwks)
+
+    def get_jwks(self):
+        return json.loads(self._jwks)
+
+    def get_key(self, kid):
+        for key in self.get_jwks()['keys']:
+            if key['kid'] == kid:
+                return jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(key))
+        raise ValueError(f'Key ID {kid} not found in JWKS')
+
+    def verify_token(self, token):
+        self._verified.clear()
+        return super().verify_token(token)
+
+    def check_access(self, decoded):
+        # the old decorator verified the token a second time here
+        is_valid, decoded = self.verify_token(self._token)
+        return super().check_access(decoded)
+
+
+class Command(BaseCommand):
+    help = 'Measure the per-request overhead of the is_authenticated decorator'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        private_key, jwks = make_signing_key()
+        token = mint_token(private_key)
+
+        request = RequestFactory().get('/auth/user')
+        request.COOKIES = {'auth_token': token, 'access_token': 'bench'}
+        view = auth.is_authenticated(lambda request: HttpResponse())
+
+        original = auth.verifier
+        try:
+            uncached = UncachedVerifier(jwks)
+            uncached._token = token
+            auth.verifier = uncached
+            self.report('uncached (previous behaviour, Redis time excluded)', view, request, options['requests'])
+
+            cached = auth.AzureADTokenVerifier()
+            cached.cache_keys(jwks)
+            auth.verifier = cached
+            self.report('key cache, token verified once', view, request, 1)
+            self.report('key + verified token cache', view, request, options['requests'])
+        finally:
+            auth.verifier = original
+
+    def report(self, label, view, request, count):
+        latencies = []
+        for _ in range(count):
+            start = time.perf_counter()
+            response = view(request)
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.content
+
+        latencies.sort()
+        p99 = statistics.quantiles(latencies, n=100)[98] if count > 1 else latencies[0]
+        self.stdout.write(
+            f'{label:>52}: mean {statistics.fmean(latencies) * 1e6:,.1f} us | '
+            f'p50 {statistics.median(latencies) * 1e6:,.1f} us | p99 {p99 * 1e6:,.1f} us'
+        )
@@ -0,0 +1,80 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ._bench import BENCH_METRICS_TOKEN, install_jwks, make_signing_key, mint_token, summarize
+from .bench_e2e import Command as E2ECommand
+from .loadtest_views import Command as LoadTestCommand, HttpClient
+
+
+class Command(BaseCommand):
+    help = 'Start a Uvicorn worker and compare creating N polls one POST /create at a time against one POST /create/bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--polls', type=int, nargs='+', default=[10, 50, 100])
+        parser.add_argument('--rounds', type=int, default=20, help='batches per size and path')
+        parser.add_argument('--port', type=int, default=8768)
+
+    def handle(self, *args, **options):
+        private_key, jwks = make_signing_key()
+        cookie = f'auth_token={mint_token(private_key)}; access_token=bench'
+
+        # the verifier reads the JWKS from its Redis cache before going to Entra ID
+        restore_jwks = install_jwks(jwks)
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'rocketVoteAPI.asgi:application',
+             '--port', str(options['port']), '--workers', '1', '--log-level', 'warning'],
+            env={**os.environ, 'METRICS_TOKEN': BENCH_METRICS_TOKEN},
+        )
+        try:
+            LoadTestCommand().wait_for_port(options['port'])
+            asyncio.run(self.drive(cookie, options))
+        finally:
+            server.terminate()
+            server.wait()
+            restore_jwks()
+
+    async def drive(self, cookie, options):
+        port = options['port']
+        client = HttpClient('127.0.0.1', port, cookie)
+        scrape = E2ECommand().scrape_round_trips
+        try:
+            # token verification and imports out of the way
+            await client.request('GET', '/auth/user')
+            for count in options['polls']:
+                bodies = [
+                    {'type': 'workshop', 'description': f'question {n}', 'revealed': '0',
+                     'multi_selection': '0', 'options': ['yes', 'no', 'maybe']}
+                    for n in range(count)
+                ]
+                for name, create in (('sequential', self.sequential), ('bulk', self.bulk)):
+                    round_trips = await scrape(port)
+                    latencies = []
+                    started = time.perf_counter()
+                    for _ in range(options['rounds']):
+                        t = time.perf_counter()
+                        await create(client, bodies)
+                        latencies.append(time.perf_counter() - t)
+                    stats = summarize(latencies, time.perf_counter() - started)
+                    round_trips = (await scrape(port) - round_trips) / options['rounds']
+                    self.stdout.write(
+                        f"{count:>4} polls, {name:>10}: p50 {stats['p50']:8.2f} ms | p95 {stats['p95']:8.2f} ms | "
+                        f"{stats['p50'] / count:6.3f} ms/poll | {round_trips:6.1f} Redis round trips per batch"
+                    )
+        finally:
+            await client.close()
+
+    async def sequential(self, client, bodies):
+        for body in bodies:
+            status, response = await client.request('POST', '/create', body)
+            if status != 201:
+                raise CommandError(f'create failed: {status} {response[:200]}')
+
+    async def bulk(self, client, bodies):
+        status, response = await client.request('POST', '/create/bulk', {'polls': bodies})
+        if status != 201:
+            raise CommandError(f'bulk create failed: {status} {response[:200]}')
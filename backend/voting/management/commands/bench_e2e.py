@@ -0,0 +1,225 @@
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from voting.redis_pool import REDIS_URL
+
+from ._bench import BENCH_METRICS_TOKEN, JwksStandIn, install_jwks, make_signing_key, mint_token, summarize
+from .loadtest_views import Command as LoadTestCommand, HttpClient
+
+SCENARIOS = ('create', 'vote storm', 'admin refresh', 'reveal', 'participant refetch')
+
+
+class Command(BaseCommand):
+    help = (
+        'Offline end-to-end benchmark: start a Uvicorn worker against a local JWKS stand-in and Redis, '
+        'run create, vote storm, admin refresh, reveal and participant refetch, and report throughput, '
+        'latency percentiles and Redis operations per scenario'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--polls', type=int, default=50)
+        parser.add_argument('--voters', type=int, default=1000, help='distinct identities, each with its own token')
+        parser.add_argument('--votes', type=int, default=10000)
+        parser.add_argument('--refreshes', type=int, default=20, help='admin GETs per poll')
+        parser.add_argument('--refetches', type=int, default=5000)
+        parser.add_argument('--concurrency', type=int, default=100)
+        parser.add_argument('--mode', choices=['sync', 'async'], default='sync')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--port', type=int, default=8767)
+        parser.add_argument('--output', help='write the results as JSON, for --compare on a later run')
+        parser.add_argument('--compare', help='JSON written by an earlier --output run to diff against')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        private_key, jwks = make_signing_key()
+        cookies = [
+            f"auth_token={mint_token(private_key, preferred_username=f'voter{v}@example.com', oid=f'voter-{v}')}; access_token=bench"
+            for v in range(options['voters'])
+        ]
+        stand_in = JwksStandIn(jwks)
+
+        # empty, so the worker fetches the keys from the stand-in like it would from Entra ID
+        restore_jwks = install_jwks(None)
+
+        # its own directory, so the worker's JWKS failover file doesn't replace the real one
+        workdir = tempfile.TemporaryDirectory()
+        env = {
+            **os.environ,
+            'ASYNC_VIEWS': '1' if options['mode'] == 'async' else '0',
+            'ENTRA_JWKS_URL': stand_in.url,
+            'METRICS_TOKEN': BENCH_METRICS_TOKEN,
+        }
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'rocketVoteAPI.asgi:application',
+             '--app-dir', str(settings.BASE_DIR), '--port', str(options['port']),
+             '--workers', '1', '--log-level', 'warning'],
+            env=env, cwd=workdir.name,
+        )
+        try:
+            LoadTestCommand().wait_for_port(options['port'])
+            results = asyncio.run(self.drive(cookies, rng, options))
+        finally:
+            server.terminate()
+            server.wait()
+            workdir.cleanup()
+            stand_in.close()
+            restore_jwks()
+
+        report = {
+            'commit': self.commit(),
+            'options': {name: options[name] for name in ('polls', 'voters', 'votes', 'refreshes', 'refetches', 'concurrency', 'mode', 'seed')},
+            'jwks_fetches': stand_in.fetches,
+            'scenarios': results,
+        }
+        self.stdout.write(f"commit {report['commit']}, {options['mode']} views, {stand_in.fetches} JWKS fetch(es)")
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            if baseline['options'] != report['options']:
+                self.stderr.write(f"{options['compare']} was run with other options: {baseline['options']}")
+            self.stdout.write(f"compared with commit {baseline['commit']}")
+        for name in SCENARIOS:
+            self.write_row(name, results[name], baseline['scenarios'].get(name) if baseline else None)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+    async def drive(self, cookies, rng, options):
+        port, concurrency = options['port'], options['concurrency']
+        results = {}
+
+        # one request first, so the JWKS fetch and import-time work aren't billed to the create scenario
+        client = HttpClient('127.0.0.1', port, cookies[0])
+        status, body = await client.request('GET', '/auth/user')
+        await client.close()
+        if status != 200:
+            raise CommandError(f'Warm-up request failed: {status} {body[:200]}')
+
+        creates = [
+            ('POST', '/create', {
+                'type': 'bench', 'description': f'bench {p}', 'revealed': '0',
+                'multi_selection': '1' if p % 2 else '0', 'options': ['a', 'b', 'c', 'd'],
+            }, cookies[p % len(cookies)])
+            for p in range(options['polls'])
+        ]
+        results['create'], responses = await self.scenario(port, creates, concurrency, 201)
+        if results['create']['errors']:
+            raise CommandError(f"{results['create']['errors']} poll(s) could not be created: {next(r for r in responses if r[0] != 201)}")
+        polls = [json.loads(body) for _, body in responses]
+        poll_ids = [poll['poll_id'] for poll in polls]
+        admin_paths = [poll['redirect_url'] for poll in polls]
+
+        votes = []
+        for _ in range(options['votes']):
+            p = rng.randrange(len(poll_ids))
+            # odd polls are multiple choice, see creates
+            ballot = rng.sample('abcd', rng.randint(1, 2) if p % 2 else 1)
+            votes.append(('PATCH', f'/{poll_ids[p]}', {'votes': ballot}, rng.choice(cookies)))
+        # 202 with STREAM_INGESTION=1
+        results['vote storm'], _ = await self.scenario(port, votes, concurrency, (200, 202))
+
+        refreshes = [('GET', path, None, cookies[0]) for path in admin_paths for _ in range(options['refreshes'])]
+        rng.shuffle(refreshes)
+        results['admin refresh'], _ = await self.scenario(port, refreshes, concurrency, 200)
+
+        reveals = [('PATCH', path, None, cookies[0]) for path in admin_paths]
+        results['reveal'], _ = await self.scenario(port, reveals, concurrency, 200)
+
+        refetches = [('GET', f'/{rng.choice(poll_ids)}', None, rng.choice(cookies)) for _ in range(options['refetches'])]
+        results['participant refetch'], _ = await self.scenario(port, refetches, concurrency, 200)
+        return results
+
+    async def scenario(self, port, requests, concurrency, expected):
+        """Run (method, path, body, cookie) requests over `concurrency` keep-alive connections"""
+        expected = expected if isinstance(expected, tuple) else (expected,)
+        redis_before = await self.scrape_round_trips(port)
+        commands_before = self.redis_commands()
+
+        responses = [None] * len(requests)
+        latencies = []
+        errors = 0
+        remaining = iter(enumerate(requests))
+
+        async def worker():
+            nonlocal errors
+            client = HttpClient('127.0.0.1', port, '')
+            try:
+                for i, (method, path, body, cookie) in remaining:
+                    start = time.perf_counter()
+                    responses[i] = await client.request(method, path, body, cookie)
+                    latencies.append(time.perf_counter() - start)
+                    errors += responses[i][0] not in expected
+            finally:
+                await client.close()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, len(requests)))))
+        stats = summarize(latencies, time.perf_counter() - started)
+
+        round_trips = await self.scrape_round_trips(port) - redis_before
+        commands_after = self.redis_commands()
+        stats['errors'] = errors
+        stats['redis_round_trips'] = round_trips / len(requests)
+        stats['redis_commands'] = (
+            (commands_after - commands_before) / len(requests)
+            if commands_before is not None and commands_after is not None else None
+        )
+        return stats, responses
+
+    async def scrape_round_trips(self, port):
+        """Redis round trips made by every view so far, from the worker's /metrics (the scrape itself left out)"""
+        client = HttpClient('127.0.0.1', port, '')
+        try:
+            status, body = await client.request('GET', '/metrics', headers={'Authorization': f'Bearer {BENCH_METRICS_TOKEN}'})
+        finally:
+            await client.close()
+        if status != 200:
+            raise CommandError(f'/metrics answered {status}')
+        total = 0.0
+        for line in body.decode('utf-8').splitlines():
+            if line.startswith('rocketvote_view_redis_round_trips_sum{') and 'view="metrics"' not in line:
+                total += float(line.rpartition(' ')[2])
+        return total
+
+    def redis_commands(self):
+        """Commands processed by the Redis server, None where INFO isn't available"""
+        try:
+            return redis.Redis.from_url(REDIS_URL).info('stats')['total_commands_processed']
+        except (redis.RedisError, KeyError):
+            return None
+
+    def commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return 'unknown'
+
+    def write_row(self, name, stats, baseline):
+        commands = f"{stats['redis_commands']:5.1f}" if stats['redis_commands'] is not None else '  n/a'
+        row = (
+            f"{name:>19}: {stats['requests']:6,} req | {stats['rps']:8,.0f} req/s | "
+            f"p50 {stats['p50']:6.2f} ms | p95 {stats['p95']:6.2f} ms | p99 {stats['p99']:6.2f} ms | "
+            f"redis {stats['redis_round_trips']:4.1f} round trips, {commands} commands/req | {stats['errors']} errors"
+        )
+        if baseline:
+            deltas = ', '.join(
+                f"{key} {(stats[key] - baseline[key]) / baseline[key] * 100:+.0f}%"
+                for key in ('rps', 'p50', 'p99', 'redis_round_trips')
+                if baseline.get(key)
+            )
+            row += f' | vs baseline: {deltas}'
+        self.stdout.write(row)
@@ -0,0 +1,101 @@
+import json
+import random
+import statistics
+import time
+
+import redis
+from django.core.management.base import BaseCommand
+from nanoid import generate
+
+from voting.keys import changes_key, count_key, legacy_option_voters_key, metadata_key, option_voters_key, poll_keys, version_key, votes_key
+from voting.redis_pool import get_redis_connection
+from voting.utils import HASH_METADATA_VERSION, get_poll, get_poll_results, make_poll_metadata
+
+
+def text_poll_results(redis_conn, poll_id):
+    """The admin read before the index encoding: ballots and counts stored as option texts"""
+    votes = redis_conn.hgetall(votes_key(poll_id))
+    counts = redis_conn.zrevrange(count_key(poll_id), 0, -1, withscores=True)
+    return [
+        {voter.decode('utf-8'): ballot.decode('utf-8').split('-:-') for voter, ballot in votes.items()},
+        {option.decode('utf-8'): int(score) for option, score in counts},
+    ]
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill a poll in the text ballot layout, migrate it to the index encoding and report '
+        'Redis bytes per voter (MEMORY USAGE) and the admin GET time before and after'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--voters', type=int, default=10000)
+        parser.add_argument('--options', type=int, default=4)
+        parser.add_argument('--picks', type=int, default=1, help='options chosen on each ballot')
+        parser.add_argument('--label-length', type=int, default=40, help='characters per option text')
+        parser.add_argument('--repeat', type=int, default=20, help='admin reads timed per layout')
+        parser.add_argument('--redis-url', default=None, help='defaults to the app connection pool')
+
+    def handle(self, *args, **options):
+        redis_conn = redis.Redis.from_url(options['redis_url']) if options['redis_url'] else get_redis_connection()
+        poll_id = f'bench-{generate(size=8)}'
+        poll_options = [f'option {i} '.ljust(options['label_length'], 'x') for i in range(options['options'])]
+        metadata = make_poll_metadata({
+            'description': 'bench', 'type': 'bench', 'revealed': '0',
+            'multi_selection': '1', 'anonymous': '0', 'options': poll_options,
+        })
+        metadata['v'] = HASH_METADATA_VERSION
+        redis_conn.hset(metadata_key(poll_id), mapping=metadata)
+        self.fill_text_layout(redis_conn, poll_id, poll_options, options)
+
+        text_keys = [votes_key(poll_id), count_key(poll_id), *(legacy_option_voters_key(poll_id, option) for option in poll_options)]
+        index_keys = [votes_key(poll_id), count_key(poll_id), *(option_voters_key(poll_id, i) for i in range(len(poll_options)))]
+        try:
+            before = self.measure(redis_conn, text_keys, options, lambda: self.admin_read(redis_conn, poll_id, text_poll_results))
+
+            started = time.perf_counter()
+            get_poll(redis_conn, poll_id)
+            migrated = time.perf_counter() - started
+
+            after = self.measure(redis_conn, index_keys, options, lambda: self.admin_read(
+                redis_conn, poll_id, lambda conn, pid: get_poll_results(conn, pid, poll_options)
+            ))
+
+            self.stdout.write(f"{options['voters']} voters, {options['options']} options of {options['label_length']} chars, {options['picks']} per ballot")
+            for name, (bytes_per_voter, p50, size) in (('text', before), ('index', after)):
+                self.stdout.write(
+                    f'{name:>6}: {bytes_per_voter:7.1f} bytes/voter | admin GET p50 {p50 * 1000:7.2f} ms | body {size:,} bytes'
+                )
+            self.stdout.write(f'migration of the poll: {migrated * 1000:,.1f} ms')
+        finally:
+            redis_conn.delete(*poll_keys(poll_id, poll_options), *text_keys)
+
+    def fill_text_layout(self, redis_conn, poll_id, poll_options, options):
+        pipe = redis_conn.pipeline(transaction=False)
+        for v in range(options['voters']):
+            voter_id = f'voter{v}@example.com'
+            votes = random.sample(poll_options, options['picks'])
+            pipe.hset(votes_key(poll_id), voter_id, '-:-'.join(votes))
+            for option in votes:
+                pipe.zincrby(count_key(poll_id), 1, option)
+                pipe.sadd(legacy_option_voters_key(poll_id, option), voter_id)
+            pipe.incr(version_key(poll_id))
+            pipe.zadd(changes_key(poll_id), {voter_id: v + 1})
+            if len(pipe) >= 5000:
+                pipe.execute()
+        pipe.execute()
+
+    def admin_read(self, redis_conn, poll_id, results):
+        """Redis reads and the JSON body of a full poll_admin GET"""
+        version = redis_conn.get(version_key(poll_id))
+        votes, counts = results(redis_conn, poll_id)
+        return json.dumps({'version': int(version or 0), 'counts': counts, 'votes': votes})
+
+    def measure(self, redis_conn, keys, options, read):
+        used = sum(redis_conn.memory_usage(key, samples=0) or 0 for key in keys)
+        timings = []
+        for _ in range(options['repeat']):
+            started = time.perf_counter()
+            body = read()
+            timings.append(time.perf_counter() - started)
+        return used / options['voters'], statistics.median(timings), len(body)
@@ -0,0 +1,110 @@
+import os
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from voting import auth
+
+from ._bench import JwksStandIn, install_jwks, make_signing_key, mint_token, summarize
+
+
+class Command(BaseCommand):
+    help = (
+        'Offline check of the JWKS refresher: verifiers standing in for worker processes verify tokens '
+        'from many threads against a slow local JWKS stand-in, through a cold start, an expired JWKS, a key '
+        'rotation, tokens with made-up kids and a stand-in outage, and report the fetches each one cost'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4, help='verifiers, each with its own in-memory keys')
+        parser.add_argument('--threads', type=int, default=16, help='concurrent verifications per verifier')
+        parser.add_argument('--delay', type=float, default=0.5, help='seconds the stand-in takes to answer')
+
+    def handle(self, *args, **options):
+        private_key, jwks = make_signing_key()
+        stand_in = JwksStandIn(jwks, delay=options['delay'])
+        restore_jwks = install_jwks(None)
+        workdir = tempfile.TemporaryDirectory()
+        verifiers = []
+        for n in range(options['processes']):
+            verifier = auth.AzureADTokenVerifier()
+            verifier.jwks_url = stand_in.url
+            verifier.local_jwks_file = os.path.join(workdir.name, f'local_jwks_{n}.json')
+            verifiers.append(verifier)
+        try:
+            self.run(verifiers, stand_in, private_key, jwks, options)
+        finally:
+            stand_in.close()
+            workdir.cleanup()
+            restore_jwks()
+
+    def run(self, verifiers, stand_in, private_key, jwks, options):
+        def tokens(key, kid):
+            return [
+                [mint_token(key, kid=kid, sub=f'subject-{p}-{t}-{time.monotonic_ns()}') for t in range(options['threads'])]
+                for p in range(len(verifiers))
+            ]
+
+        self.scenario('cold start', verifiers, stand_in, tokens(private_key, 'bench-kid'), expect_valid=True)
+
+        # every process's keys and the shared JWKS past their refresh time: served stale, refetched once behind them
+        self.expire(verifiers)
+        self.scenario('expired JWKS', verifiers, stand_in, tokens(private_key, 'bench-kid'), expect_valid=True)
+
+        # Entra ID signs with a new key before anything here is due a refresh
+        rotated_key, rotated = make_signing_key(kid='rotated-kid')
+        stand_in.jwks = {'keys': jwks['keys'] + rotated['keys']}
+        self.scenario('key rotation', verifiers, stand_in, tokens(rotated_key, 'rotated-kid'), expect_valid=True)
+
+        # a second unknown kid right after the rotation falls within the rate limit: no fetch
+        forged_key, _ = make_signing_key(kid='forged-kid')
+        self.scenario('made-up kids', verifiers, stand_in, tokens(forged_key, 'forged-kid'), expect_valid=False)
+
+        stand_in.failing = True
+        self.expire(verifiers)
+        self.scenario('stand-in down', verifiers, stand_in, tokens(rotated_key, 'rotated-kid'), expect_valid=True)
+        stand_in.failing = False
+
+    def expire(self, verifiers):
+        verifiers[0]._redis_client.delete(auth.JWKS_FRESH_KEY)
+        for verifier in verifiers:
+            verifier._keys_fresh_until = 0
+
+    def scenario(self, name, verifiers, stand_in, tokens, expect_valid):
+        fetches = stand_in.fetches
+        latencies = []
+        unexpected = 0
+        barrier = threading.Barrier(sum(len(batch) for batch in tokens))
+
+        def verify(verifier, token):
+            nonlocal unexpected
+            barrier.wait()
+            start = time.perf_counter()
+            is_valid, _ = verifier.verify_token(token)
+            latencies.append(time.perf_counter() - start)
+            unexpected += is_valid != expect_valid
+
+        threads = [
+            threading.Thread(target=verify, args=(verifier, token))
+            for verifier, batch in zip(verifiers, tokens) for token in batch
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        # refreshes still running behind stale keys count towards this scenario
+        for verifier in verifiers:
+            if verifier._background_refresh is not None:
+                verifier._background_refresh.join()
+
+        stats = summarize(latencies, elapsed)
+        self.stdout.write(
+            f"{name:>14}: {stats['requests']:4} verifications | p50 {stats['p50']:7.2f} ms | p99 {stats['p99']:7.2f} ms | "
+            f"{stand_in.fetches - fetches} JWKS fetch(es) | {unexpected} unexpected result(s)"
+        )
+        if unexpected:
+            raise CommandError(f'{name}: {unexpected} token(s) {"rejected" if expect_valid else "accepted"}')
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from voting.keys import snapshot_key
+from voting.redis_pool import get_redis_connection
+from voting.snapshot import store_snapshot
+from voting.utils import get_poll
+from voting.vote_engine import cast_ballot, read_changes
+
+from ._bench import install_jwks, make_signing_key, mint_token, summarize
+from .loadtest_views import Command as LoadTestCommand, HttpClient
+
+
+class Command(BaseCommand):
+    help = (
+        'Reveal a poll on Uvicorn workers and measure the participant refetch burst that follows, '
+        'answered from the result snapshot (plain and gzipped) and built per request as before'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--participants', type=int, default=5000)
+        parser.add_argument('--options', type=int, default=10)
+        parser.add_argument('--concurrency', type=int, default=200)
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--mode', choices=['sync', 'async'], default='sync')
+        parser.add_argument('--port', type=int, default=8769)
+
+    def handle(self, *args, **options):
+        private_key, jwks = make_signing_key()
+        cookies = [
+            f"auth_token={mint_token(private_key, preferred_username=f'participant{n}@example.com')}; access_token=bench"
+            for n in range(options['participants'])
+        ]
+
+        # the verifier reads the JWKS from its Redis cache before going to Entra ID
+        restore_jwks = install_jwks(jwks)
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'rocketVoteAPI.asgi:application',
+             '--port', str(options['port']), '--workers', str(options['workers']), '--log-level', 'warning'],
+            env={**os.environ, 'ASYNC_VIEWS': '1' if options['mode'] == 'async' else '0'},
+        )
+        try:
+            LoadTestCommand().wait_for_port(options['port'])
+            asyncio.run(self.drive(cookies, options))
+        finally:
+            server.terminate()
+            server.wait()
+            restore_jwks()
+
+    async def drive(self, cookies, options):
+        port = options['port']
+        poll_options = [f'option {n}' for n in range(options['options'])]
+        client = HttpClient('127.0.0.1', port, cookies[0])
+        status, body = await client.request('POST', '/create', {
+            'type': 'bench', 'description': 'bench', 'revealed': '0',
+            'multi_selection': '1', 'options': poll_options,
+        })
+        await client.close()
+        if status != 201:
+            raise CommandError(f'Could not create the bench poll: {status} {body[:200]}')
+        body = json.loads(body)
+        poll_id, admin_path = body['poll_id'], body['redirect_url']
+
+        redis_conn = get_redis_connection()
+        for n in range(options['participants']):
+            cast_ballot(redis_conn, poll_id, f'participant{n}@example.com', poll_options[n % len(poll_options)::3], poll_options)
+
+        # every token verified once up front, so each burst pays the same (cached) auth cost
+        await self.burst(port, cookies, '/auth/user', {}, options['concurrency'])
+
+        # a new connection, the first one has idled out by now
+        client = HttpClient('127.0.0.1', port, cookies[0])
+        status, _ = await client.request('PATCH', admin_path)
+        await client.close()
+        if status != 200:
+            raise CommandError(f'Reveal failed: {status}')
+
+        # without its snapshot the poll is answered the way polls revealed before snapshots are
+        redis_conn.delete(snapshot_key(poll_id))
+        stats = await self.burst(port, cookies, f'/{poll_id}', {}, options['concurrency'])
+        self.report('built per request', stats)
+
+        poll = get_poll(redis_conn, poll_id)
+        version, counts, _ = read_changes(redis_conn, poll_id, poll['options'])
+        store_snapshot(redis_conn, poll_id, poll, counts, version)
+        for name, headers in (('snapshot', {}), ('snapshot, gzip', {'Accept-Encoding': 'gzip'})):
+            self.report(name, await self.burst(port, cookies, f'/{poll_id}', headers, options['concurrency']))
+
+    async def burst(self, port, cookies, path, headers, concurrency):
+        """One GET of path per cookie, over `concurrency` keep-alive connections"""
+        latencies = []
+        sizes = []
+        errors = 0
+        remaining = iter(cookies)
+
+        async def worker():
+            nonlocal errors
+            client = HttpClient('127.0.0.1', port, '')
+            try:
+                for cookie in remaining:
+                    start = time.perf_counter()
+                    status, body = await client.request('GET', path, cookie=cookie, headers=headers)
+                    latencies.append(time.perf_counter() - start)
+                    sizes.append(len(body))
+                    errors += status != 200
+            finally:
+                await client.close()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return {**summarize(latencies, time.perf_counter() - started), 'errors': errors, 'bytes': sum(sizes) / len(sizes)}
+
+    def report(self, name, stats):
+        self.stdout.write(
+            f"{name:>18}: {stats['rps']:8,.0f} responses/s | p50 {stats['p50']:6.2f} ms | p95 {stats['p95']:6.2f} ms | "
+            f"p99 {stats['p99']:6.2f} ms | {stats['bytes']:5.0f} bytes/response | {stats['errors']} errors"
+        )
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from websockets.asyncio.client import connect
+
+from ._bench import install_jwks, make_signing_key, mint_token
+from .loadtest_views import Command as LoadTestCommand, HttpClient
+
+
+class Command(BaseCommand):
+    help = (
+        'Start Uvicorn workers in each reveal fan-out mode, open N participant sockets on a poll, '
+        'reveal it and report the time until the last socket got the results'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, nargs='+', default=[1000, 5000, 20000])
+        parser.add_argument('--mode', choices=['group', 'local', 'both'], default='both')
+        parser.add_argument('--workers', type=int, default=2)
+        parser.add_argument('--connect-concurrency', type=int, default=500)
+        parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for the last delivery')
+        parser.add_argument('--port', type=int, default=8766)
+
+    def handle(self, *args, **options):
+        # a socket is a descriptor here and one in the server
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        if max(options['sockets']) + 100 > hard:
+            self.stderr.write(f'open file limit is {hard}, the larger runs will fail to connect every socket')
+
+        private_key, jwks = make_signing_key()
+        cookie = f'auth_token={mint_token(private_key)}; access_token=bench'
+
+        # the verifier reads the JWKS from its Redis cache before going to Entra ID
+        restore_jwks = install_jwks(jwks)
+        try:
+            modes = ['group', 'local'] if options['mode'] == 'both' else [options['mode']]
+            for mode in modes:
+                self.run_mode(mode, cookie, options)
+        finally:
+            restore_jwks()
+
+    def run_mode(self, mode, cookie, options):
+        env = {**os.environ, 'REVEAL_FANOUT': mode}
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'rocketVoteAPI.asgi:application',
+             '--port', str(options['port']), '--workers', str(options['workers']),
+             '--log-level', 'warning', '--backlog', '4096'],
+            env=env,
+        )
+        try:
+            LoadTestCommand().wait_for_port(options['port'])
+            for sockets in options['sockets']:
+                result = asyncio.run(self.reveal(cookie, sockets, options))
+                self.stdout.write(
+                    f"{mode:>5} fan-out, {options['workers']} workers, {sockets:>6,} sockets: "
+                    f"reveal request {result['request']:7.1f} ms | first {result['first']:7.1f} ms | "
+                    f"p50 {result['p50']:7.1f} ms | last {result['last']:7.1f} ms | "
+                    f"{result['missed']} missed, {result['failed']} failed to connect"
+                )
+        finally:
+            server.terminate()
+            server.wait()
+
+    async def reveal(self, cookie, count, options):
+        client = HttpClient('127.0.0.1', options['port'], cookie)
+        status, body = await client.request('POST', '/create', {
+            'type': 'bench', 'description': 'bench', 'revealed': '0',
+            'multi_selection': '0', 'options': ['a', 'b'],
+        })
+        await client.close()
+        if status != 201:
+            raise CommandError(f'Could not create the bench poll: {status} {body[:200]}')
+        body = json.loads(body)
+        poll_id, creation_id = body['poll_id'], body['redirect_url'].split('/')[-1]
+
+        connected = asyncio.Semaphore(options['connect_concurrency'])
+        ready = []
+        received = []
+        failed = 0
+
+        async def participant(all_ready):
+            nonlocal failed
+            try:
+                async with connected:
+                    websocket = await connect(f"ws://127.0.0.1:{options['port']}/ws/{poll_id}/", open_timeout=30)
+            except Exception:
+                failed += 1
+                return
+            ready.append(websocket)
+            async with websocket:
+                await all_ready.wait()
+                try:
+                    await asyncio.wait_for(websocket.recv(), options['timeout'])
+                    received.append(time.perf_counter())
+                except (asyncio.TimeoutError, Exception):
+                    pass
+
+        all_ready = asyncio.Event()
+        tasks = [asyncio.create_task(participant(all_ready)) for _ in range(count)]
+        while len(ready) + failed < count:
+            await asyncio.sleep(0.05)
+        all_ready.set()
+
+        # a new connection, the first one may have idled out while the sockets connected
+        client = HttpClient('127.0.0.1', options['port'], cookie)
+        started = time.perf_counter()
+        status, _ = await client.request('PATCH', f'/create/{creation_id}')
+        request_ms = (time.perf_counter() - started) * 1000
+        await client.close()
+        if status != 200:
+            raise CommandError(f'Reveal failed: {status}')
+        await asyncio.gather(*tasks)
+
+        delays = sorted((at - started) * 1000 for at in received) or [0.0]
+        return {
+            'request': request_ms,
+            'first': delays[0],
+            'p50': statistics.median(delays),
+            'last': delays[-1],
+            'missed': len(ready) - len(received),
+            'failed': failed,
+        }
@@ -0,0 +1,49 @@
+import random
+
+import redis
+from django.core.management.base import BaseCommand
+from nanoid import generate
+
+from voting.redis_pool import get_redis_connection
+from voting.keys import changes_key, count_key, metadata_key, option_voters_key, poll_keys, votes_key
+from voting.utils import make_poll_metadata
+from voting.vote_engine import cast_ballot
+
+
+class Command(BaseCommand):
+    help = 'Fill a poll with voters and report the Redis memory used per voter by each of its keys (MEMORY USAGE)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--voters', type=int, default=10000)
+        parser.add_argument('--options', type=int, default=4)
+        parser.add_argument('--picks', type=int, default=1, help='options chosen on each ballot')
+        parser.add_argument('--anonymous', action='store_true', help='use sha256 voter ids instead of emails')
+        parser.add_argument('--redis-url', default=None, help='defaults to the app connection pool')
+
+    def handle(self, *args, **options):
+        redis_conn = redis.Redis.from_url(options['redis_url']) if options['redis_url'] else get_redis_connection()
+        poll_id = f'bench-{generate(size=8)}'
+        poll_options = [f'option {i}' for i in range(options['options'])]
+        redis_conn.hset(metadata_key(poll_id), mapping=make_poll_metadata({
+            'description': 'bench', 'type': 'bench', 'revealed': '0',
+            'multi_selection': '1', 'anonymous': '1' if options['anonymous'] else '0', 'options': poll_options,
+        }))
+
+        for v in range(options['voters']):
+            voter_id = f'{v:064x}' if options['anonymous'] else f'voter{v}@example.com'
+            cast_ballot(redis_conn, poll_id, voter_id, random.sample(poll_options, options['picks']), poll_options)
+
+        keys = {
+            'votes': [votes_key(poll_id)],
+            'count': [count_key(poll_id)],
+            'changes': [changes_key(poll_id)],
+            'option sets': [option_voters_key(poll_id, index) for index in range(len(poll_options))],
+        }
+        try:
+            for name, group in keys.items():
+                used = sum(redis_conn.memory_usage(key, samples=0) or 0 for key in group)
+                self.stdout.write(
+                    f"{name:>12}: {used:>12,} bytes | {used / options['voters']:7.1f} bytes/voter"
+                )
+        finally:
+            redis_conn.delete(*poll_keys(poll_id, poll_options))
@@ -0,0 +1,70 @@
+import random
+import time
+
+import redis
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from voting.keys import templates_cache_key, templates_generation_key
+from voting.models import PollTemplate
+from voting.redis_pool import get_redis_connection
+from voting.template_cache import get_cached_templates, search_templates
+
+from ._bench import summarize
+
+WORDS = ['retro', 'standup', 'planning', 'lunch', 'offsite', 'estimate', 'demo', 'review', 'hiring', 'budget']
+
+
+class Command(BaseCommand):
+    help = 'Fill PollTemplate and compare the templates GET (list and search) straight from the database and through the per-user cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--templates', type=int, default=100000)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--redis-url', default=None, help='defaults to the app connection pool')
+
+    def handle(self, *args, **options):
+        redis_conn = redis.Redis.from_url(options['redis_url']) if options['redis_url'] else get_redis_connection()
+        users = [f'bench-user-{u}' for u in range(options['users'])]
+        self.fill(users, options['templates'])
+        try:
+            self.stdout.write(f"{options['templates']:,} templates across {len(users):,} users on {connection.vendor}")
+            for name, query in (('list', lambda: ''), ('search', lambda: random.choice(WORDS)[:4])):
+                sample = [(random.choice(users), query()) for _ in range(options['requests'])]
+                self.report(f'{name} database', sample, search_templates)
+                # the first pass fills the cache, the second one reads it
+                self.report(f'{name} cache fill', sample, lambda user, q: get_cached_templates(redis_conn, user, q))
+                self.report(f'{name} cache hit', sample, lambda user, q: get_cached_templates(redis_conn, user, q))
+
+            user = random.choice(users)
+            self.stdout.write('search plan:')
+            self.stdout.write(PollTemplate.objects.filter(created_by=user, title__icontains='retr').order_by('title')[:12].explain())
+        finally:
+            PollTemplate.objects.filter(created_by__startswith='bench-user-').delete()
+            redis_conn.delete(*[templates_cache_key(user) for user in users], *[templates_generation_key(user) for user in users])
+
+    def fill(self, users, count):
+        batch = []
+        for n in range(count):
+            batch.append(PollTemplate(
+                title=f'{random.choice(WORDS)} {random.choice(WORDS)} {n}',
+                template='{"type": "bench", "options": ["a", "b"]}',
+                created_by=users[n % len(users)],
+            ))
+            if len(batch) >= 5000:
+                PollTemplate.objects.bulk_create(batch)
+                batch = []
+        PollTemplate.objects.bulk_create(batch)
+
+    def report(self, name, sample, read):
+        latencies = []
+        started = time.perf_counter()
+        for user, query in sample:
+            t = time.perf_counter()
+            read(user, query)
+            latencies.append(time.perf_counter() - t)
+        stats = summarize(latencies, time.perf_counter() - started)
+        self.stdout.write(
+            f"{name:>18}: {stats['rps']:9,.0f} req/s | p50 {stats['p50']:6.2f} ms | p95 {stats['p95']:6.2f} ms | p99 {stats['p99']:6.2f} ms"
+        )
@@ -0,0 +1,96 @@
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+from django.core.management.base import BaseCommand
+from nanoid import generate
+
+from voting.poll_cache import get_cached_poll
+from voting.redis_pool import get_redis_connection
+from voting.keys import count_key, metadata_key, poll_keys, votes_key
+from voting.utils import get_poll, make_poll_metadata, vote_fields
+from voting.vote_engine import cast_ballot
+
+
+def legacy_cast(redis_conn, poll_id, voter_id, votes):
+    """The pre-script vote path: one round trip per command, not atomic."""
+    get_poll(redis_conn, poll_id)
+    poll_votes_key = votes_key(poll_id)
+    poll_count_key = count_key(poll_id)
+    prev_votes = redis_conn.hget(poll_votes_key, voter_id)
+    if prev_votes:
+        for option in prev_votes.decode('utf-8').split('-:-'):
+            redis_conn.zincrby(poll_count_key, -1, option)
+    redis_conn.hset(poll_votes_key, voter_id, '-:-'.join(votes))
+    for option in votes:
+        redis_conn.zincrby(poll_count_key, 1, option)
+
+
+def script_cast(redis_conn, poll_id, voter_id, votes):
+    poll = get_poll(redis_conn, poll_id, vote_fields)
+    cast_ballot(redis_conn, poll_id, voter_id, votes, poll['options'])
+
+
+def cached_cast(redis_conn, poll_id, voter_id, votes):
+    """What cast_vote does now: metadata from the worker cache, then the script"""
+    poll = get_cached_poll(redis_conn, poll_id)
+    cast_ballot(redis_conn, poll_id, voter_id, votes, poll['options'])
+
+
+casts = {'legacy': legacy_cast, 'script': script_cast, 'cached': cached_cast}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the vote path (legacy per-command vs. atomic script vs. script with cached metadata) under concurrent voters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--voters', type=int, default=2000)
+        parser.add_argument('--concurrency', type=int, default=200)
+        parser.add_argument('--options', type=int, default=4)
+        parser.add_argument('--revotes', type=int, default=1, help='extra ballots cast by every voter')
+        parser.add_argument('--mode', choices=[*casts, 'all'], default='all')
+        parser.add_argument('--redis-url', default=None, help='defaults to the app connection pool')
+
+    def handle(self, *args, **options):
+        redis_conn = redis.Redis.from_url(options['redis_url']) if options['redis_url'] else get_redis_connection()
+        modes = list(casts) if options['mode'] == 'all' else [options['mode']]
+        for mode in modes:
+            self.run(redis_conn, mode, casts[mode], options)
+
+    def run(self, redis_conn, mode, cast, options):
+        poll_id = f'bench-{generate(size=8)}'
+        poll_options = [f'option {i}' for i in range(options['options'])]
+        redis_conn.hset(metadata_key(poll_id), mapping=make_poll_metadata({
+            'description': 'bench', 'type': 'bench', 'revealed': '0',
+            'multi_selection': '0', 'anonymous': '0', 'options': poll_options,
+        }))
+
+        ballots = [
+            (f'voter{v}@example.com', [random.choice(poll_options)])
+            for _ in range(options['revotes'] + 1)
+            for v in range(options['voters'])
+        ]
+        random.shuffle(ballots)
+
+        def timed(ballot):
+            start = time.perf_counter()
+            cast(redis_conn, poll_id, *ballot)
+            return time.perf_counter() - start
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            latencies = sorted(executor.map(timed, ballots))
+        elapsed = time.perf_counter() - started
+
+        total = sum(int(score) for _, score in redis_conn.zrange(count_key(poll_id), 0, -1, withscores=True))
+        redis_conn.delete(*poll_keys(poll_id, poll_options))
+
+        quantiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f"{mode:>7}: {len(ballots)} ballots, {options['concurrency']} threads | "
+            f"{len(ballots) / elapsed:,.0f} votes/s | "
+            f"p50 {quantiles[49] * 1000:.2f} ms | p99 {quantiles[98] * 1000:.2f} ms | "
+            f"counted {total}/{options['voters']}"
+        )
@@ -0,0 +1,103 @@
+import logging
+import os
+import socket
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from voting.consumers import admin_group_name
+from voting.ingest import (
+    INGEST_BATCH, INGEST_DISCOVER_SECONDS, INGEST_IDLE_SECONDS, STREAM_INGESTION, STREAMS_KEY, discover_streams,
+    ingest_poll, release_stream,
+)
+from voting.keys import ballots_stream_key
+from voting.poll_cache import get_cached_poll
+from voting.redis_pool import REDIS_CLUSTER, get_redis_connection
+from voting.utils import vote_cast_event
+
+
+logger = logging.getLogger(__name__)
+
+
+async def publish(poll_id, applied):
+    channel_layer = get_channel_layer()
+    for voter_id, votes, previous in applied:
+        await channel_layer.group_send(admin_group_name(poll_id), vote_cast_event(voter_id, votes, previous))
+
+
+class Command(BaseCommand):
+    help = (
+        'Apply the ballots queued by cast_vote when VOTE_INGESTION_MODE=stream. '
+        'Run as many as needed, they share the work through a consumer group.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=INGEST_BATCH, help='entries applied per poll and script call')
+        parser.add_argument('--idle', type=float, default=0.05, help='seconds to sleep when no stream has anything')
+        parser.add_argument('--once', action='store_true', help='stop when every stream is empty')
+
+    def handle(self, *args, **options):
+        if not STREAM_INGESTION:
+            # cast_vote stores ballots itself, nothing will ever be queued
+            self.stdout.write('VOTE_INGESTION_MODE is not stream, no ballots to ingest')
+            return
+
+        redis_conn = get_redis_connection()
+        consumer = f'{socket.gethostname()}-{os.getpid()}'
+        self.stdout.write(f'Ingesting ballots as {consumer}')
+
+        # poll id -> when its stream last had something, to release the ones that stay empty
+        last_consumed = {}
+        next_discovery = 0
+        while True:
+            now = time.monotonic()
+            if REDIS_CLUSTER and now >= next_discovery:
+                for poll_id in discover_streams(redis_conn):
+                    logger.warning('Registered ballots stream of poll %s, its enqueue did not', poll_id)
+                next_discovery = now + INGEST_DISCOVER_SECONDS
+
+            consumed = 0
+            poll_ids = [poll_id.decode('utf-8') for poll_id in redis_conn.smembers(STREAMS_KEY)]
+            for poll_id in poll_ids:
+                poll_consumed = self.ingest(redis_conn, poll_id, consumer, options['batch'])
+                consumed += poll_consumed
+                if poll_consumed:
+                    last_consumed[poll_id] = now
+                elif now - last_consumed.setdefault(poll_id, now) >= INGEST_IDLE_SECONDS:
+                    if release_stream(redis_conn, poll_id):
+                        del last_consumed[poll_id]
+            for poll_id in last_consumed.keys() - set(poll_ids):
+                # released by another worker
+                del last_consumed[poll_id]
+
+            if not consumed:
+                if options['once']:
+                    return
+                time.sleep(options['idle'])
+
+    def ingest(self, redis_conn, poll_id, consumer, batch):
+        poll = get_cached_poll(redis_conn, poll_id)
+        if poll is None:
+            # expired or archived, the stream went with the other keys
+            redis_conn.srem(STREAMS_KEY, poll_id)
+            return 0
+
+        try:
+            consumed, applied = ingest_poll(redis_conn, poll_id, poll['options'], consumer, batch)
+        except Exception:
+            logger.exception('Failed to ingest ballots of poll %s', poll_id)
+            return 0
+
+        if not consumed and poll['revealed'] == '1' and redis_conn.xlen(ballots_stream_key(poll_id)) == 0:
+            # drained on reveal, nothing can be added any more
+            redis_conn.srem(STREAMS_KEY, poll_id)
+
+        if applied:
+            try:
+                async_to_sync(publish)(poll_id, applied)
+            except Exception as e:
+                logger.warning('Failed to publish votes to poll admins: %s', e)
+        # superseded entries are progress too, only an empty batch means the stream is drained
+        return consumed
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ._bench import install_jwks, make_signing_key, mint_token, summarize
+
+
+class HttpClient:
+    """Minimal keep-alive HTTP/1.1 client so the harness has no extra dependencies"""
+
+    def __init__(self, host, port, cookie):
+        self.host = host
+        self.port = port
+        self.cookie = cookie
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=None, cookie=None, headers=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        payload = json.dumps(body).encode() if body is not None else b''
+        self.writer.write((
+            f'{method} {path} HTTP/1.1\r\n'
+            f'Host: localhost\r\n'
+            f'Cookie: {cookie or self.cookie}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(payload)}\r\n'
+            + ''.join(f'{name}: {value}\r\n' for name, value in (headers or {}).items())
+            + '\r\n'
+        ).encode() + payload)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while (line := await self.reader.readline()) not in (b'\r\n', b''):
+            name, _, value = line.decode().partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+        return status, await self.reader.readexactly(length)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+
+class Command(BaseCommand):
+    help = 'Start one Uvicorn worker per view mode and compare requests/sec for the vote endpoints'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=['sync', 'async', 'both'], default='both')
+        parser.add_argument('--requests', type=int, default=5000)
+        parser.add_argument('--concurrency', type=int, default=200)
+        parser.add_argument('--get-ratio', type=float, default=0.5, help='share of GET /<poll_id> among requests')
+        parser.add_argument('--port', type=int, default=8765)
+
+    def handle(self, *args, **options):
+        private_key, jwks = make_signing_key()
+        cookie = f'auth_token={mint_token(private_key)}; access_token=loadtest'
+
+        # the verifier reads the JWKS from its Redis cache before going to Entra ID
+        restore_jwks = install_jwks(jwks)
+        try:
+            modes = ['sync', 'async'] if options['mode'] == 'both' else [options['mode']]
+            for mode in modes:
+                result = self.run_mode(mode, cookie, options)
+                self.stdout.write(
+                    f"{mode:>5} views: {result['rps']:,.0f} req/s per worker | "
+                    f"p50 {result['p50']:.1f} ms | p95 {result['p95']:.1f} ms | p99 {result['p99']:.1f} ms | "
+                    f"{result['errors']} errors"
+                )
+        finally:
+            restore_jwks()
+
+    def run_mode(self, mode, cookie, options):
+        env = {**os.environ, 'ASYNC_VIEWS': '1' if mode == 'async' else '0'}
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'rocketVoteAPI.asgi:application',
+             '--port', str(options['port']), '--workers', '1', '--log-level', 'warning'],
+            env=env,
+        )
+        try:
+            self.wait_for_port(options['port'])
+            return asyncio.run(self.drive(cookie, options))
+        finally:
+            server.terminate()
+            server.wait()
+
+    def wait_for_port(self, port, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(('127.0.0.1', port), timeout=1):
+                    return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError(f'Server did not start listening on port {port}')
+
+    async def drive(self, cookie, options):
+        setup = HttpClient('127.0.0.1', options['port'], cookie)
+        status, body = await setup.request('POST', '/create', {
+            'type': 'loadtest', 'description': 'loadtest', 'revealed': '0',
+            'multi_selection': '0', 'options': ['a', 'b', 'c', 'd'],
+        })
+        await setup.close()
+        if status != 201:
+            raise CommandError(f'Could not create the load-test poll: {status} {body[:200]}')
+        poll_id = json.loads(body)['poll_id']
+
+        latencies = []
+        errors = 0
+        remaining = iter(range(options['requests']))
+        get_every = round(1 / options['get_ratio']) if options['get_ratio'] else 0
+
+        async def worker():
+            nonlocal errors
+            client = HttpClient('127.0.0.1', options['port'], cookie)
+            try:
+                for i in remaining:
+                    start = time.perf_counter()
+                    if get_every and i % get_every == 0:
+                        status, _ = await client.request('GET', f'/{poll_id}')
+                    else:
+                        status, _ = await client.request('PATCH', f'/{poll_id}', {'votes': ['abcd'[i % 4]]})
+                    latencies.append(time.perf_counter() - start)
+                    errors += status != 200
+            finally:
+                await client.close()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(options['concurrency'])))
+        return {**summarize(latencies, time.perf_counter() - started), 'errors': errors}
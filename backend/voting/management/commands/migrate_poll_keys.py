@@ -0,0 +1,83 @@
+import re
+
+import redis
+from django.core.management.base import BaseCommand
+
+from voting.keys import tagged_key
+from voting.redis_pool import get_redis_connection
+
+# '<id>:<suffix>' keys written before the poll id became a hash tag
+LEGACY_KEY = re.compile(rb'^[A-Za-z0-9_-]+:(metadata|votes|count|version|changes|opt:.*|poll_id)$', re.DOTALL)
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy poll keys from the untagged "<id>:<suffix>" layout to "{<id>}:<suffix>" with DUMP/RESTORE, '
+        'keeping TTLs. Run it after deploying the tagged layout, nothing writes the old keys from then on. '
+        'Without --source the keys are rewritten in place on the app Redis; with --source they are copied '
+        'from an old standalone Redis into the app Redis, e.g. a new cluster.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default=None, help='redis:// URL of the standalone Redis holding the old keys')
+        parser.add_argument('--delete-source', action='store_true', help='also delete the old keys from --source')
+        parser.add_argument('--batch', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        target = get_redis_connection()
+        source = redis.Redis.from_url(options['source']) if options['source'] else target
+        delete_old = options['delete_source'] or options['source'] is None
+
+        copied = skipped = 0
+        batch = []
+        for key in source.scan_iter(count=options['batch']):
+            if LEGACY_KEY.match(key):
+                batch.append(key)
+            if len(batch) >= options['batch']:
+                done, busy = self.copy(source, target, batch, delete_old, options['dry_run'])
+                copied, skipped = copied + done, skipped + busy
+                batch = []
+        if batch:
+            done, busy = self.copy(source, target, batch, delete_old, options['dry_run'])
+            copied, skipped = copied + done, skipped + busy
+
+        verb = 'Would copy' if options['dry_run'] else 'Copied'
+        self.stdout.write(f'{verb} {copied} keys, {skipped} skipped because the tagged key already exists')
+
+    def copy(self, source, target, keys, delete_old, dry_run):
+        if dry_run:
+            for key in keys:
+                self.stdout.write(f"{key.decode('utf-8', 'replace')} -> {tagged_key(key.decode('utf-8', 'replace'))}")
+            return len(keys), 0
+
+        pipe = source.pipeline(transaction=False)
+        for key in keys:
+            pipe.dump(key)
+            pipe.pttl(key)
+        dumped = pipe.execute()
+
+        pipe = target.pipeline(transaction=False)
+        restored = []
+        for key, payload, ttl in zip(keys, dumped[::2], dumped[1::2]):
+            if payload is None:  # expired or deleted since the scan
+                continue
+            # no REPLACE: a tagged key that exists already was written by the new code and wins
+            pipe.restore(tagged_key(key.decode('utf-8')), ttl if ttl > 0 else 0, payload)
+            restored.append(key)
+        results = pipe.execute(raise_on_error=False)
+
+        busy = 0
+        for result in results:
+            if isinstance(result, redis.ResponseError):
+                if 'BUSYKEY' not in str(result):
+                    raise result
+                busy += 1
+
+        if delete_old and restored:
+            pipe = source.pipeline(transaction=False)
+            for key in restored:
+                pipe.unlink(key)
+            pipe.execute()
+
+        return len(restored) - busy, busy
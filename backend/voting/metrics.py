@@ -0,0 +1,190 @@
+import bisect
+import logging
+import os
+import socket
+import threading
+import time
+
+from .redis_pool import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# In-process counters and histograms, flushed to Redis every
+# METRICS_FLUSH_SECONDS as increments (HINCRBYFLOAT), so /metrics on any
+# worker reports the sum over every Gunicorn, ingest and Celery process.
+# Recording only touches a dict under a lock. Gauges are per process: each
+# one overwrites its own values and heartbeat, and the values of processes
+# that stopped heartbeating are dropped.
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '5'))
+# /metrics wants "Authorization: Bearer <METRICS_TOKEN>", and answers 404 while it is unset
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+COUNTERS_KEY = 'metrics:counters'
+GAUGES_KEY = 'metrics:gauges'
+WORKERS_KEY = 'metrics:workers'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 32)
+TASK_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+# name -> (type, help)
+FAMILIES = {
+    'rocketvote_view_seconds': ('histogram', 'Time spent in each view, middleware included'),
+    'rocketvote_view_responses_total': ('counter', 'Responses by view, method and status'),
+    'rocketvote_view_redis_round_trips': ('histogram', 'Redis round trips (commands, pipelines, scripts) per request'),
+    'rocketvote_token_verify_seconds': ('histogram', 'ID token signature and claim verification, cache misses only'),
+    'rocketvote_token_cache_total': ('counter', 'Verified token cache lookups by result (hit, miss)'),
+    'rocketvote_websockets': ('gauge', 'Open WebSocket connections by worker and consumer'),
+    'rocketvote_celery_task_seconds': ('histogram', 'Celery task run time by task and state'),
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _series(name, labels):
+    """name{label="value",...}, the series as it appears in the exposition and as its Redis field"""
+    if not labels:
+        return name
+    rendered = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return f'{name}{{{rendered}}}'
+
+
+def worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class Metrics:
+    def __init__(self):
+        self._counters = {}
+        # (name, labels) -> [count per bucket .., count above the last bucket, sum]
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._pid = None
+
+    def inc(self, name, labels=(), value=1):
+        self._ensure_flusher()
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        self._ensure_flusher()
+        index = bisect.bisect_left(buckets, value)
+        with self._lock:
+            histogram = self._histograms.get((name, labels, buckets))
+            if histogram is None:
+                histogram = self._histograms[(name, labels, buckets)] = [0] * (len(buckets) + 2)
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def gauge_add(self, name, labels=(), delta=1):
+        self._ensure_flusher()
+        with self._lock:
+            self._gauges[(name, labels)] = self._gauges.get((name, labels), 0) + delta
+
+    def flush(self, redis_conn):
+        """Send the increments recorded since the last flush, and this process's gauges"""
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            histograms, self._histograms = self._histograms, {}
+            gauges = dict(self._gauges)
+
+        increments = {_series(name, labels): value for (name, labels), value in counters.items()}
+        for (name, labels, buckets), histogram in histograms.items():
+            cumulative = 0
+            for le, count in zip([*buckets, '+Inf'], histogram):
+                cumulative += count
+                increments[_series(f'{name}_bucket', (*labels, ('le', le)))] = cumulative
+            increments[_series(f'{name}_count', labels)] = cumulative
+            increments[_series(f'{name}_sum', labels)] = histogram[-1]
+
+        worker = worker_id()
+        pipe = redis_conn.pipeline(transaction=False)
+        for field, value in increments.items():
+            pipe.hincrbyfloat(COUNTERS_KEY, field, value)
+        for (name, labels), value in gauges.items():
+            pipe.hset(GAUGES_KEY, f'{worker} {_series(name, (("worker", worker), *labels))}', value)
+        pipe.zadd(WORKERS_KEY, {worker: time.time()})
+        try:
+            pipe.execute()
+        except Exception as e:
+            logger.warning('Metrics flush failed: %s', e)
+            with self._lock:
+                for key, value in counters.items():
+                    self._counters[key] = self._counters.get(key, 0) + value
+                for key, histogram in histograms.items():
+                    merged = self._histograms.setdefault(key, [0] * len(histogram))
+                    for i, count in enumerate(histogram):
+                        merged[i] += count
+
+    def render(self, redis_conn):
+        """Prometheus text exposition of everything flushed so far, from every process"""
+        self.flush(redis_conn)
+        stale = time.time() - 3 * METRICS_FLUSH_SECONDS
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.hgetall(COUNTERS_KEY)
+        pipe.hgetall(GAUGES_KEY)
+        pipe.zrangebyscore(WORKERS_KEY, stale, '+inf')
+        counters, gauges, live = pipe.execute()
+
+        live = {worker.decode('utf-8') for worker in live}
+        series = {field.decode('utf-8'): value.decode('utf-8') for field, value in counters.items()}
+        dead = []
+        for field, value in gauges.items():
+            worker, _, gauge = field.decode('utf-8').partition(' ')
+            if worker in live:
+                series[gauge] = value.decode('utf-8')
+            else:
+                dead.append(field)
+        if dead:
+            pipe = redis_conn.pipeline(transaction=False)
+            pipe.hdel(GAUGES_KEY, *dead)
+            pipe.zremrangebyscore(WORKERS_KEY, '-inf', stale)
+            pipe.execute()
+
+        lines = []
+        for family, (kind, help_text) in FAMILIES.items():
+            members = sorted(
+                (field for field in series if field.partition('{')[0] in (family, f'{family}_bucket', f'{family}_sum', f'{family}_count')),
+                key=_sort_key,
+            )
+            if not members:
+                continue
+            lines.append(f'# HELP {family} {help_text}')
+            lines.append(f'# TYPE {family} {kind}')
+            lines.extend(f'{field} {series[field]}' for field in members)
+        return '\n'.join(lines) + '\n'
+
+    def _ensure_flusher(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # a fresh process (Celery forks its pool after import): nothing recorded by the parent is ours
+            self._counters, self._histograms, self._gauges = {}, {}, {}
+            self._pid = os.getpid()
+            self._flusher = threading.Thread(target=self._flush_forever, name='metrics-flush', daemon=True)
+            self._flusher.start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(METRICS_FLUSH_SECONDS)
+            self.flush(get_redis_connection())
+
+
+def _sort_key(field):
+    """Series of one histogram together: buckets in le order, then sum and count"""
+    name, _, labels = field.partition('{')
+    labels = labels.rstrip('}')
+    le = float('inf')
+    if 'le="' in labels:
+        labels, _, rest = labels.partition('le="')
+        labels = labels.rstrip(',')
+        le = float(rest.partition('"')[0])
+    return (labels, name.endswith('_sum') + 2 * name.endswith('_count'), le)
+
+
+metrics = Metrics()
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.1 on 2026-10-17 23:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voting', '0002_polltemplate_created_by'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedPoll',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('poll_id', models.CharField(max_length=21, unique=True)),
+                ('creation_id', models.CharField(max_length=21, unique=True)),
+                ('metadata', models.JSONField()),
+                ('counts', models.JSONField()),
+                ('version', models.BigIntegerField(default=0)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedBallot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('voter', models.TextField()),
+                ('votes', models.JSONField()),
+                ('version', models.BigIntegerField(default=0)),
+                ('poll', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ballots', to='voting.archivedpoll')),
+            ],
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.1.1 on 2026-10-17 23:10
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def delete_duplicate_templates(apps, schema_editor):
+    """Keep the latest template of every (created_by, title), so the constraint can be added"""
+    PollTemplate = apps.get_model('voting', 'PollTemplate')
+    duplicates = (
+        PollTemplate.objects.values('created_by', 'title')
+        .annotate(latest=Max('id'), copies=Count('id'))
+        .filter(copies__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        PollTemplate.objects.filter(
+            created_by=duplicate['created_by'], title=duplicate['title']
+        ).exclude(id=duplicate['latest']).delete()
+
+
+# title__icontains compiles to UPPER("title"::text) LIKE UPPER(%s) on Postgres,
+# so the trigram index is on that expression. SQLite has no equivalent, there
+# the search stays a scan of the user's rows found through the unique index.
+def create_title_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS voting_polltemplate_title_trgm '
+        'ON voting_polltemplate USING gin (UPPER(title) gin_trgm_ops)'
+    )
+
+
+def drop_title_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS voting_polltemplate_title_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voting', '0003_archivedpoll_archivedballot'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_templates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='polltemplate',
+            constraint=models.UniqueConstraint(fields=('created_by', 'title'), name='unique_template_title_per_user'),
+        ),
+        migrations.RunPython(create_title_trigram_index, drop_title_trigram_index),
+    ]
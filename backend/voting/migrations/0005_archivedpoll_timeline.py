@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-17 23:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voting', '0004_polltemplate_unique_title'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedpoll',
+            name='timeline',
+            field=models.JSONField(default=dict),
+        ),
+    ]
@@ -4,4 +4,32 @@ from django.db import models
 class PollTemplate(models.Model):
     title = models.TextField()
     template = models.TextField()
-    created_by = models.TextField(null=True)
\ No newline at end of file
+    created_by = models.TextField(null=True)
+
+    class Meta:
+        # one template per title and user; its (created_by, title) index also
+        # serves the per-user listing. Title search on Postgres has a trigram
+        # index too, see migration 0004.
+        constraints = [
+            models.UniqueConstraint(fields=['created_by', 'title'], name='unique_template_title_per_user'),
+        ]
+
+# Revealed polls are moved here from Redis shortly after reveal (see archive.py)
+# and kept until their deadline, like they would have been in Redis.
+class ArchivedPoll(models.Model):
+    poll_id = models.CharField(max_length=21, unique=True)
+    creation_id = models.CharField(max_length=21, unique=True)
+    metadata = models.JSONField()
+    counts = models.JSONField()
+    version = models.BigIntegerField(default=0)
+    # {resolution: [[bucket start, ballots cast in it]]}, see get_vote_timeline
+    timeline = models.JSONField(default=dict)
+    archived_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+class ArchivedBallot(models.Model):
+    poll = models.ForeignKey(ArchivedPoll, on_delete=models.CASCADE, related_name='ballots')
+    voter = models.TextField()
+    votes = models.JSONField()
+    # the poll version of the voter's last vote, for ?since=
+    version = models.BigIntegerField(default=0)
@@ -0,0 +1,181 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .keys import creation_key
+from .redis_pool import get_redis_connection
+from .utils import aget_poll, get_poll
+
+logger = logging.getLogger(__name__)
+
+POLL_CACHE_SIZE = int(os.getenv('POLL_CACHE_SIZE', '1000'))
+POLL_CACHE_SECONDS = int(os.getenv('POLL_CACHE_SECONDS', '60'))
+INVALIDATION_CHANNEL = 'poll_invalidations'
+
+
+class PollCache:
+    """
+    Worker-local LRU of parsed poll metadata. Metadata never changes except for
+    the revealed flag, so entries live until they age out, get evicted, or a
+    message on INVALIDATION_CHANNEL (sent on reveal and delete) drops them.
+    The TTL only bounds staleness while the invalidation listener is down.
+    Result snapshots of revealed polls and the poll ids of creation ids are
+    kept alongside, on the same terms.
+    """
+
+    def __init__(self, max_size=POLL_CACHE_SIZE, ttl=POLL_CACHE_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._polls = OrderedDict()
+        self._snapshots = OrderedDict()
+        self._poll_ids = OrderedDict()
+        self._lock = threading.Lock()
+        self._listener = None
+        # bumped by every invalidation, see set()
+        self.generation = 0
+
+    def get(self, poll_id):
+        self._ensure_listener()
+        with self._lock:
+            entry = self._polls.get(poll_id)
+            if entry is None:
+                return None
+            poll, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._polls[poll_id]
+                return None
+            self._polls.move_to_end(poll_id)
+            # callers tweak the dict they get (e.g. revealed on reveal)
+            return dict(poll)
+
+    def set(self, poll_id, poll, generation):
+        """Store a poll read while self.generation was `generation`, unless an invalidation has arrived since"""
+        self._store(self._polls, poll_id, dict(poll), generation)
+
+    def get_snapshot(self, poll_id):
+        """(json, gzip, version) of a revealed poll, or None"""
+        return self._fetch(self._snapshots, poll_id)
+
+    def set_snapshot(self, poll_id, snapshot, generation):
+        self._store(self._snapshots, poll_id, snapshot, generation)
+
+    def get_poll_id(self, creation_id):
+        # the mapping never changes; once the poll is gone, reads by its id find nothing
+        return self._fetch(self._poll_ids, creation_id)
+
+    def set_poll_id(self, creation_id, poll_id, generation):
+        self._store(self._poll_ids, creation_id, poll_id, generation)
+
+    def _fetch(self, entries, key):
+        self._ensure_listener()
+        with self._lock:
+            entry = entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del entries[key]
+                return None
+            entries.move_to_end(key)
+            return value
+
+    def _store(self, entries, key, value, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            entries[key] = (value, time.monotonic() + self.ttl)
+            entries.move_to_end(key)
+            if len(entries) > self.max_size:
+                entries.popitem(last=False)
+
+    def invalidate(self, poll_id):
+        with self._lock:
+            self.generation += 1
+            self._polls.pop(poll_id, None)
+            self._snapshots.pop(poll_id, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._polls.clear()
+            self._snapshots.clear()
+            self._poll_ids.clear()
+
+    def _ensure_listener(self):
+        if self._listener is None or not self._listener.is_alive():
+            with self._lock:
+                if self._listener is None or not self._listener.is_alive():
+                    self._listener = threading.Thread(target=self._listen, name='poll-cache-invalidation', daemon=True)
+                    self._listener.start()
+
+    def _listen(self):
+        while True:
+            pubsub = get_redis_connection().pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # anything cached before subscribing may have missed its message
+                self.clear()
+                for message in pubsub.listen():
+                    self.invalidate(message['data'].decode('utf-8'))
+            except Exception as e:
+                logger.warning('Poll cache invalidation listener failed: %s', e)
+                self.clear()
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
+
+poll_cache = PollCache()
+
+
+def get_cached_poll(redis_conn, poll_id):
+    poll = poll_cache.get(poll_id)
+    if poll is None:
+        generation = poll_cache.generation
+        poll = get_poll(redis_conn, poll_id)
+        if poll is not None:
+            poll_cache.set(poll_id, poll, generation)
+    return poll
+
+
+async def aget_cached_poll(redis_conn, poll_id):
+    poll = poll_cache.get(poll_id)
+    if poll is None:
+        generation = poll_cache.generation
+        poll = await aget_poll(redis_conn, poll_id)
+        if poll is not None:
+            poll_cache.set(poll_id, poll, generation)
+    return poll
+
+
+def get_cached_poll_id(redis_conn, creation_id):
+    poll_id = poll_cache.get_poll_id(creation_id)
+    if poll_id is None:
+        generation = poll_cache.generation
+        poll_id = redis_conn.get(creation_key(creation_id))
+        if poll_id is None:
+            return None
+        poll_id = poll_id.decode('utf-8')
+        poll_cache.set_poll_id(creation_id, poll_id, generation)
+    return poll_id
+
+
+async def aget_cached_poll_id(redis_conn, creation_id):
+    poll_id = poll_cache.get_poll_id(creation_id)
+    if poll_id is None:
+        generation = poll_cache.generation
+        poll_id = await redis_conn.get(creation_key(creation_id))
+        if poll_id is None:
+            return None
+        poll_id = poll_id.decode('utf-8')
+        poll_cache.set_poll_id(creation_id, poll_id, generation)
+    return poll_id
+
+
+def publish_poll_invalidation(redis_conn, poll_id):
+    """Drop poll_id from every worker's cache, including this one. Works with sync and async clients."""
+    poll_cache.invalidate(poll_id)
+    # PUBLISH by name: the async cluster client has no publish(). Any node relays it to the whole cluster.
+    return redis_conn.execute_command('PUBLISH', INVALIDATION_CHANNEL, poll_id)
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from .keys import presence_key, votes_key
+from .redis_pool import get_async_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# Participant sockets are counted per worker process, in memory, so a connect
+# or disconnect costs no Redis command. Every PRESENCE_HEARTBEAT_SECONDS the
+# worker writes its count of each poll it holds sockets of into
+# {poll_id}:presence (worker id -> 'count:unix time'), one pipeline for all of
+# them. Readers sum the fields written within the last PRESENCE_TTL_HEARTBEATS
+# heartbeats, so the counts of a worker that died drop out without anyone
+# cleaning up after it, and the key expires once no worker writes to it.
+PRESENCE_HEARTBEAT_SECONDS = float(os.getenv('PRESENCE_HEARTBEAT_SECONDS', '5'))
+PRESENCE_TTL_HEARTBEATS = 3
+PRESENCE_TTL_SECONDS = int(PRESENCE_HEARTBEAT_SECONDS * PRESENCE_TTL_HEARTBEATS) + 1
+
+
+class Presence:
+    """
+    Participant sockets of this worker process by poll. Lives in the event loop
+    of the ASGI server, all methods must be called from there.
+    """
+
+    def __init__(self):
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self._counts = {}
+        self._heartbeat = None
+
+    def add(self, poll_id):
+        self._counts[poll_id] = self._counts.get(poll_id, 0) + 1
+        if self._heartbeat is None:
+            self._heartbeat = asyncio.create_task(self._beat())
+
+    def discard(self, poll_id):
+        if poll_id in self._counts:
+            self._counts[poll_id] -= 1
+
+    async def _beat(self):
+        while True:
+            await asyncio.sleep(PRESENCE_HEARTBEAT_SECONDS)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # the next heartbeat writes every count again
+                logger.warning('Presence heartbeat failed: %s', e)
+                continue
+            if not self._counts:
+                self._heartbeat = None
+                return
+
+    async def flush(self):
+        """Write the count of every poll this worker holds sockets of, and remove the polls it no longer does"""
+        counts = dict(self._counts)
+        if not counts:
+            return
+        now = int(time.time())
+        async with get_async_redis_connection().pipeline(transaction=False) as pipe:
+            for poll_id, count in counts.items():
+                key = presence_key(poll_id)
+                if count > 0:
+                    pipe.hset(key, self.worker_id, f'{count}:{now}')
+                    pipe.expire(key, PRESENCE_TTL_SECONDS)
+                else:
+                    pipe.hdel(key, self.worker_id)
+            await pipe.execute()
+        for poll_id, count in counts.items():
+            if count <= 0 and self._counts.get(poll_id) == count:
+                del self._counts[poll_id]
+
+
+def _connected(workers):
+    """Sum of the live worker counts of a {poll_id}:presence hash"""
+    oldest = time.time() - PRESENCE_TTL_SECONDS
+    connected = 0
+    for value in workers.values():
+        count, _, written = value.decode('utf-8').partition(':')
+        if int(written) >= oldest:
+            connected += int(count)
+    return connected
+
+
+def get_presence(redis_conn, poll_id):
+    """{'connected': participant sockets, 'voted': voters with a ballot}, one pipelined round trip"""
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.hgetall(presence_key(poll_id))
+    pipe.hlen(votes_key(poll_id))
+    workers, voted = pipe.execute()
+    return {'connected': _connected(workers), 'voted': voted}
+
+
+presence = Presence()
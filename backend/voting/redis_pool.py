@@ -1,6 +1,79 @@
+import contextvars
+import os
+import threading
+
 import redis
+import redis.asyncio
+import redis.asyncio.cluster
+import redis.cluster
+
+# Poll data lives at REDIS_URL. With REDIS_CLUSTER=1 that is any node of a
+# Redis Cluster and the connections below are cluster clients, which route
+# every command to the node owning its key's slot (see keys.py).
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+REDIS_CLUSTER = os.getenv('REDIS_CLUSTER', '0') == '1'
+
+# [count] of the commands and pipelines sent during the current request, set by
+# the metrics middleware. Counted per write to the socket, so a pipeline or a
+# script is one round trip. Not counted for the async cluster client, which
+# has no pluggable connection class.
+round_trips = contextvars.ContextVar('redis_round_trips', default=None)
+
+class CountingConnection(redis.Connection):
+    def send_packed_command(self, command, check_health=True):
+        counter = round_trips.get()
+        if counter is not None:
+            counter[0] += 1
+        return super().send_packed_command(command, check_health)
+
+class AsyncCountingConnection(redis.asyncio.Connection):
+    async def send_packed_command(self, command, check_health=True):
+        counter = round_trips.get()
+        if counter is not None:
+            counter[0] += 1
+        return await super().send_packed_command(command, check_health)
+
+pool = None if REDIS_CLUSTER else redis.ConnectionPool.from_url(REDIS_URL, connection_class=CountingConnection)
+async_pool = None if REDIS_CLUSTER else redis.asyncio.ConnectionPool.from_url(REDIS_URL, connection_class=AsyncCountingConnection)
 
-pool = redis.ConnectionPool(host='redis', port=6379, db=0)
+_cluster = None
+_async_cluster = None
+_cluster_lock = threading.Lock()
 
 def get_redis_connection():
-    return redis.Redis(connection_pool=pool)
+    if not REDIS_CLUSTER:
+        return redis.Redis(connection_pool=pool)
+
+    global _cluster
+    if _cluster is None:
+        with _cluster_lock:
+            if _cluster is None:
+                # reads the slot map from the cluster, so only done once per process
+                _cluster = redis.cluster.RedisCluster.from_url(REDIS_URL, connection_class=CountingConnection)
+    return _cluster
+
+def get_async_redis_connection():
+    if not REDIS_CLUSTER:
+        return redis.asyncio.Redis(connection_pool=async_pool)
+
+    global _async_cluster
+    if _async_cluster is None:
+        # connects lazily, on the first command
+        _async_cluster = redis.asyncio.cluster.RedisCluster.from_url(REDIS_URL)
+    return _async_cluster
+
+class LazyScript:
+    """
+    A Lua script registered on the client of its first call rather than at import,
+    so importing a module doesn't build the cluster client, which connects to read
+    the slot map. Called like redis-py's Script, with client= always given: one
+    instance per script for sync clients and one for async ones.
+    """
+    def __init__(self, source):
+        self.source = source
+        self._script = None
+
+    def __call__(self, keys=(), args=(), client=None):
+        if self._script is None:
+            self._script = client.register_script(self.source)
+        return self._script(keys=keys, args=args, client=client)
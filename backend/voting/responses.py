@@ -0,0 +1,110 @@
+import json
+
+from django.http import JsonResponse
+
+from .archive import archived_results
+from .ingest import STREAM_INGESTION
+from .utils import OPEN_POLL_ETAG, ballot_error, fast_json_response, not_modified, version_etag
+from .vote_engine import VOTE_OK
+
+# Request parsing and response building of cast_vote and poll_admin, shared by
+# views.py and async_views.py so the two only differ in how they call Redis.
+
+
+def poll_closed_response():
+    return JsonResponse({'error': 'Poll Expired/Ended'}, status=400)
+
+
+def tagged_response(request, etag, make_body):
+    """A 304 if the request already has etag, otherwise make_body() as JSON. Both carry the ETag."""
+    response = not_modified(request, etag) or fast_json_response(make_body())
+    response['ETag'] = etag
+    return response
+
+
+def open_poll_response(request, poll):
+    """Participant GET of an unrevealed poll, whose metadata only changes by revealing it"""
+    return tagged_response(request, OPEN_POLL_ETAG, lambda: {'metadata': poll})
+
+
+def revealed_poll_response(poll, counts):
+    """Participant GET of a revealed poll whose snapshot is missing"""
+    return fast_json_response({'metadata': poll, 'counts': counts})
+
+
+def archived_poll_response(request, archived):
+    """Participant GET of a poll moved to Postgres"""
+    return tagged_response(request, version_etag(archived.version),
+                           lambda: {'metadata': archived.metadata, 'counts': archived.counts})
+
+
+def archived_admin_response(request, archived, query):
+    """poll_admin GET of a poll moved to Postgres. Queries the ballots unless it answers 304."""
+    return tagged_response(request, version_etag(archived.version), lambda: archived_results(archived, query))
+
+
+def parse_ballot(request, poll):
+    """(ballot, None) if the request body is a valid ballot for poll, (None, error response) otherwise"""
+    if poll is None or poll['revealed'] == '1':
+        return None, poll_closed_response()
+
+    try:
+        ballot = json.loads(request.body)
+    except json.JSONDecodeError:
+        return None, JsonResponse({'error': 'Invalid JSON payload'}, status=400)
+
+    error = ballot_error(poll, ballot)
+    if error:
+        return None, JsonResponse({'error': error}, status=400)
+    return ballot, None
+
+
+def cast_response(status):
+    """Answer a ballot that cast_ballot or enqueue_ballot returned status for"""
+    if status != VOTE_OK:
+        return poll_closed_response()
+    if STREAM_INGESTION:
+        # counted and sent to the admins by the ingest_votes worker
+        return JsonResponse({'message': 'Vote/s cast successfully'}, status=202)
+    return JsonResponse({'message': 'Vote/s cast successfully'}, status=200)
+
+
+def checks_version_first(request):
+    """
+    The admin page polls every second: with If-None-Match, an unchanged poll
+    costs one pipelined read of its version. Not with STREAM_INGESTION, whose
+    ingestion lag moves without the version.
+    """
+    return 'If-None-Match' in request.headers and not STREAM_INGESTION
+
+
+def version_not_modified(request, version):
+    """A 304 if version is the one the request already has, otherwise None"""
+    return None if version is None else not_modified(request, version_etag(version))
+
+
+def admin_response(query, poll, version, counts, votes, cursor, ingestion):
+    """
+    poll_admin GET of a live poll, from what the view read for query. Tagged
+    with the version, unless it carries the ingestion lag.
+    """
+    response = {
+        'metadata': poll,
+        'version': version,
+        'counts': counts,
+    }
+    if query['mode'] == 'page':
+        response['cursor'] = cursor
+    if query['mode'] != 'counts':
+        response['votes'] = votes
+    if ingestion is not None:
+        response['ingestion'] = ingestion
+        return fast_json_response(response)
+    response = fast_json_response(response)
+    response['ETag'] = version_etag(version)
+    return response
+
+
+def undrained_reveal_response():
+    # revealed already, so a retry only has the rest of the stream to apply
+    return JsonResponse({'error': 'Ballots are still being counted, try again'}, status=503)
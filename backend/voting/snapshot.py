@@ -0,0 +1,74 @@
+import gzip
+import re
+
+import orjson
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from .keys import snapshot_key
+from .poll_cache import poll_cache
+from .utils import not_modified, version_etag
+
+# Counts can't change once a poll is revealed, so reveal serializes the
+# participant GET body once, plain and gzipped, into {poll_id}:snapshot.
+# Workers keep the bytes they read in the poll cache, so the refetch burst
+# after a reveal is answered without touching Redis or encoding anything.
+_accepts_gzip = re.compile(r'\bgzip\b')
+
+
+def make_snapshot(poll, counts):
+    body = orjson.dumps({'metadata': poll, 'counts': counts})
+    return body, gzip.compress(body, compresslevel=9)
+
+
+def store_snapshot(redis_conn, poll_id, poll, counts, version):
+    """
+    Write the snapshot of a revealed poll, with the version its reveal set, before
+    its expiry is scheduled. Works with sync and async clients.
+    """
+    body, compressed = make_snapshot(poll, counts)
+    return redis_conn.hset(snapshot_key(poll_id), mapping={'json': body, 'gzip': compressed, 'version': version})
+
+
+def get_snapshot(redis_conn, poll_id):
+    """(json, gzip, version) of a revealed poll from the poll cache or Redis, None if it has none (revealed before snapshots)"""
+    snapshot = poll_cache.get_snapshot(poll_id)
+    if snapshot is None:
+        generation = poll_cache.generation
+        snapshot = redis_conn.hmget(snapshot_key(poll_id), 'json', 'gzip', 'version')
+        if snapshot[0] is None:
+            return None
+        snapshot = tuple(snapshot)
+        poll_cache.set_snapshot(poll_id, snapshot, generation)
+    return snapshot
+
+
+async def aget_snapshot(redis_conn, poll_id):
+    snapshot = poll_cache.get_snapshot(poll_id)
+    if snapshot is None:
+        generation = poll_cache.generation
+        snapshot = await redis_conn.hmget(snapshot_key(poll_id), 'json', 'gzip', 'version')
+        if snapshot[0] is None:
+            return None
+        snapshot = tuple(snapshot)
+        poll_cache.set_snapshot(poll_id, snapshot, generation)
+    return snapshot
+
+
+def snapshot_response(request, snapshot):
+    body, compressed, version = snapshot
+    # snapshots written before they carried the version go without an ETag
+    etag = version_etag(version.decode('utf-8')) if version is not None else None
+    if etag:
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+    if _accepts_gzip.search(request.headers.get('Accept-Encoding', '')) and len(compressed) < len(body):
+        response = HttpResponse(compressed, content_type='application/json')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if etag:
+        response['ETag'] = etag
+    return response
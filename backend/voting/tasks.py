@@ -1,26 +1,49 @@
+import logging
+import time
+
 from celery import shared_task
+from celery.signals import task_postrun, task_prerun
+
+from .archive import archive_due_polls, delete_expired_archives
+from .expiry import delete_polls, sweep_expired_polls
+from .metrics import TASK_BUCKETS, metrics
 from .redis_pool import get_redis_connection
 
+logger = logging.getLogger(__name__)
+
+# task id -> perf_counter at start, for rocketvote_celery_task_seconds
+_task_started = {}
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+@task_postrun.connect
+def record_task_duration(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        metrics.observe(
+            'rocketvote_celery_task_seconds', time.perf_counter() - started,
+            (('task', task.name), ('state', state)), TASK_BUCKETS,
+        )
+
 @shared_task
 def delete_poll(creation_id):
-    print("IN DELETE TASK")
-    redis_conn = get_redis_connection()
-    poll_id = redis_conn.get(f'{creation_id}:poll_id')
-    if poll_id is None:
-        print("Poll not found for given creation_id.")
+    # only still scheduled by reveals from before the deadline sweeper, which now does this
+    deleted = delete_polls(get_redis_connection(), [creation_id])
+    if not deleted:
+        logger.info('Poll not found for creation_id %s', creation_id)
         return False
 
-    poll_id = poll_id.decode('utf-8')
-    
-    keys_to_delete = [
-        f'{poll_id}:metadata',
-        f'{poll_id}:votes',
-        f'{poll_id}:count',
-        f'{creation_id}:poll_id'
-    ]
-
-    for key in keys_to_delete:
-        redis_conn.delete(key)
-    
-    print(f"All keys related to poll_id {poll_id} have been deleted.")
-    return True
\ No newline at end of file
+    logger.info('All keys related to poll_id %s have been deleted', deleted[0])
+    return True
+
+@shared_task
+def sweep_polls():
+    """Run by celery beat, see CELERY_BEAT_SCHEDULE"""
+    redis_conn = get_redis_connection()
+    archived = archive_due_polls(redis_conn)
+    swept = sweep_expired_polls(redis_conn) + delete_expired_archives()
+    if archived or swept:
+        logger.info('Archived %d revealed polls, deleted %d expired polls', archived, swept)
+    return archived, swept
@@ -0,0 +1,61 @@
+import json
+import os
+
+from .keys import templates_cache_key, templates_generation_key
+from .models import PollTemplate
+from .redis_pool import LazyScript
+
+TEMPLATE_RESULT_LIMIT = 12
+TEMPLATE_CACHE_SECONDS = int(os.getenv('TEMPLATE_CACHE_SECONDS', '600'))
+
+# The templates GET body of every user is cached in Redis per search query, in
+# one hash per user, so a hit is a single HGET. POST and DELETE bump the user's
+# generation and delete the hash. A reader that missed reads the generation
+# along with the HGET, and fills the hash only if it is still the same once the
+# database has answered: a write that lands in between can't be overwritten
+# with the templates from before it.
+
+# KEYS: generation, cache. ARGV: generation read with the miss, query, body, ttl
+FILL_TEMPLATES_LUA = """
+if (redis.call('GET', KEYS[1]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return 1
+"""
+_fill_script = LazyScript(FILL_TEMPLATES_LUA)
+
+
+def search_templates(user_id, query):
+    """title -> template of up to TEMPLATE_RESULT_LIMIT of the user's templates whose title contains query"""
+    templates = PollTemplate.objects.filter(created_by=user_id)
+    if query:
+        templates = templates.filter(title__icontains=query)
+    return {
+        title: json.loads(template)
+        for title, template in templates.order_by('title').values_list('title', 'template')[:TEMPLATE_RESULT_LIMIT]
+    }
+
+
+def get_cached_templates(redis_conn, user_id, query):
+    """search_templates, JSON encoded, from the cache when possible. One round trip on a hit."""
+    generation_key, cache_key = templates_generation_key(user_id), templates_cache_key(user_id)
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.hget(cache_key, query)
+    pipe.get(generation_key)
+    body, generation = pipe.execute()
+    if body is not None:
+        return body
+
+    body = json.dumps(search_templates(user_id, query)).encode('utf-8')
+    _fill_script(keys=[generation_key, cache_key], args=[generation or b'0', query, body, TEMPLATE_CACHE_SECONDS], client=redis_conn)
+    return body
+
+
+def invalidate_templates(redis_conn, user_id):
+    """Call after any change to the user's templates"""
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.incr(templates_generation_key(user_id))
+    pipe.delete(templates_cache_key(user_id))
+    pipe.execute()
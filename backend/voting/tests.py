@@ -1,3 +1,687 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import json
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+import jwt
+import requests
+from channels.testing import WebsocketCommunicator
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.conf import settings
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from . import auth, consumers, views
+from .archive import ARCHIVE_AFTER_SECONDS, archive_due_polls
+from .ingest import INGEST_GROUP, STREAMS_KEY, apply_entries, discover_streams, drain_poll, enqueue_ballot, ingest_poll, release_stream
+from .keys import ballots_stream_key, count_key, creation_key, legacy_option_voters_key, metadata_key, option_voters_key, templates_cache_key, templates_generation_key, votes_key
+from .models import ArchivedPoll, PollTemplate
+from .snapshot import make_snapshot, snapshot_response
+from .template_cache import _fill_script, get_cached_templates
+from .utils import HASH_METADATA_VERSION, OPEN_POLL_ETAG, POLL_METADATA_VERSION, get_poll, make_poll_metadata, not_modified, parse_page_query, parse_results_query, version_etag
+from .vote_engine import POLL_CLOSED, VOTE_OK, cast_ballot, read_changes
+
+OPTIONS = ['red', 'green', 'blue']
+
+
+def make_poll(redis_conn, poll_id='poll', revealed='0', options=OPTIONS):
+    redis_conn.hset(metadata_key(poll_id), mapping=make_poll_metadata({
+        'description': 'colours', 'type': 'test', 'revealed': revealed,
+        'multi_selection': '1', 'anonymous': '0', 'options': options,
+    }))
+    return poll_id
+
+
+class CastBallotTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.poll_id = make_poll(self.redis)
+
+    def test_cast_counts_the_ballot(self):
+        status, previous = cast_ballot(self.redis, self.poll_id, 'ann', ['red', 'blue'], OPTIONS)
+
+        self.assertEqual(status, VOTE_OK)
+        self.assertEqual(previous, [])
+        self.assertEqual(self.redis.hget(votes_key(self.poll_id), 'ann'), b'0,2')
+        self.assertEqual(read_changes(self.redis, self.poll_id, OPTIONS)[1], {'red': 1, 'blue': 1})
+        self.assertEqual(self.redis.smembers(option_voters_key(self.poll_id, 2)), {b'ann'})
+
+    def test_recast_replaces_the_ballot(self):
+        cast_ballot(self.redis, self.poll_id, 'ann', ['red', 'blue'], OPTIONS)
+        cast_ballot(self.redis, self.poll_id, 'bob', ['red'], OPTIONS)
+        status, previous = cast_ballot(self.redis, self.poll_id, 'ann', ['green'], OPTIONS)
+
+        self.assertEqual(status, VOTE_OK)
+        self.assertEqual(previous, ['red', 'blue'])
+        _, counts, _ = read_changes(self.redis, self.poll_id, OPTIONS)
+        self.assertEqual({option: count for option, count in counts.items() if count}, {'red': 1, 'green': 1})
+        self.assertEqual(self.redis.smembers(option_voters_key(self.poll_id, 0)), {b'bob'})
+        self.assertEqual(self.redis.smembers(option_voters_key(self.poll_id, 1)), {b'ann'})
+        self.assertEqual(self.redis.smembers(option_voters_key(self.poll_id, 2)), set())
+
+    def test_revealed_poll_refuses_ballots(self):
+        poll_id = make_poll(self.redis, 'revealed', revealed='1')
+
+        self.assertEqual(cast_ballot(self.redis, poll_id, 'ann', ['red'], OPTIONS), (POLL_CLOSED, []))
+        self.assertFalse(self.redis.exists(votes_key(poll_id)))
+
+    def test_missing_poll_refuses_ballots(self):
+        self.assertEqual(cast_ballot(self.redis, 'missing', 'ann', ['red'], OPTIONS), (POLL_CLOSED, []))
+        self.assertFalse(self.redis.exists(votes_key('missing')))
+
+    def test_created_keys_inherit_the_poll_ttl(self):
+        self.redis.expire(metadata_key(self.poll_id), 600)
+        cast_ballot(self.redis, self.poll_id, 'ann', ['green'], OPTIONS)
+
+        for key in (votes_key(self.poll_id), count_key(self.poll_id), option_voters_key(self.poll_id, 1)):
+            self.assertEqual(self.redis.pexpiretime(key), self.redis.pexpiretime(metadata_key(self.poll_id)), key)
+
+
+class ReadChangesTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.poll_id = make_poll(self.redis)
+
+    def test_counts_only_without_since(self):
+        cast_ballot(self.redis, self.poll_id, 'ann', ['red'], OPTIONS)
+
+        self.assertEqual(read_changes(self.redis, self.poll_id, OPTIONS), (1, {'red': 1}, {}))
+
+    def test_since_returns_the_ballots_changed_after_it(self):
+        cast_ballot(self.redis, self.poll_id, 'ann', ['red'], OPTIONS)
+        cast_ballot(self.redis, self.poll_id, 'bob', ['green'], OPTIONS)
+        version, _, votes = read_changes(self.redis, self.poll_id, OPTIONS, since=0)
+        self.assertEqual((version, votes), (2, {'ann': ['red'], 'bob': ['green']}))
+
+        cast_ballot(self.redis, self.poll_id, 'ann', ['blue'], OPTIONS)
+        cast_ballot(self.redis, self.poll_id, 'cat', ['blue'], OPTIONS)
+        version, counts, votes = read_changes(self.redis, self.poll_id, OPTIONS, since=2)
+
+        self.assertEqual(version, 4)
+        self.assertEqual(votes, {'ann': ['blue'], 'cat': ['blue']})
+        self.assertEqual(counts['blue'], 2)
+        self.assertEqual(read_changes(self.redis, self.poll_id, OPTIONS, since=4)[2], {})
+
+
+class IngestTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.poll_id = make_poll(self.redis)
+        self.stream = ballots_stream_key(self.poll_id)
+        # fakeredis doesn't know XGROUP inside scripts, the first enqueue would create the group
+        self.redis.xgroup_create(self.stream, INGEST_GROUP, mkstream=True)
+
+    def test_enqueue_registers_the_stream_until_it_stays_empty(self):
+        self.assertEqual(enqueue_ballot(self.redis, self.poll_id, 'ann', ['red'], OPTIONS), VOTE_OK)
+        self.assertEqual(self.redis.smembers(STREAMS_KEY), {self.poll_id.encode()})
+        self.assertFalse(release_stream(self.redis, self.poll_id))
+
+        ingest_poll(self.redis, self.poll_id, OPTIONS, 'worker')
+        self.assertTrue(release_stream(self.redis, self.poll_id))
+        self.assertEqual(self.redis.smembers(STREAMS_KEY), set())
+
+        enqueue_ballot(self.redis, self.poll_id, 'bob', ['green'], OPTIONS)
+        self.assertEqual(self.redis.smembers(STREAMS_KEY), {self.poll_id.encode()})
+
+    def test_cluster_discovers_streams_its_enqueue_did_not_register(self):
+        with mock.patch('voting.ingest.REDIS_CLUSTER', True):
+            enqueue_ballot(self.redis, self.poll_id, 'ann', ['red'], OPTIONS)
+            self.assertEqual(self.redis.smembers(STREAMS_KEY), {self.poll_id.encode()})
+            self.redis.srem(STREAMS_KEY, self.poll_id)
+
+            self.assertEqual(discover_streams(self.redis), [self.poll_id])
+            self.assertEqual(self.redis.smembers(STREAMS_KEY), {self.poll_id.encode()})
+            self.assertEqual(discover_streams(self.redis), [])
+
+    def test_drain_takes_over_batches_a_worker_holds(self):
+        enqueue_ballot(self.redis, self.poll_id, 'ann', ['red'], OPTIONS)
+        enqueue_ballot(self.redis, self.poll_id, 'bob', ['green'], OPTIONS)
+        # a worker read the batch and hangs before applying it
+        self.redis.xreadgroup(INGEST_GROUP, 'worker', {self.stream: '>'})
+
+        self.assertTrue(drain_poll(self.redis, self.poll_id, OPTIONS, timeout=0))
+
+        self.assertEqual(self.redis.xlen(self.stream), 0)
+        self.assertEqual(read_changes(self.redis, self.poll_id, OPTIONS)[1], {'red': 1, 'green': 1})
+        consumers = [consumer['name'] for consumer in self.redis.xinfo_consumers(self.stream, INGEST_GROUP)]
+        self.assertEqual(consumers, [b'worker'])
+
+    def test_batch_applied_after_the_drain_is_skipped(self):
+        enqueue_ballot(self.redis, self.poll_id, 'ann', ['red'], OPTIONS)
+        [(_, entries)] = self.redis.xreadgroup(INGEST_GROUP, 'worker', {self.stream: '>'})
+        drain_poll(self.redis, self.poll_id, OPTIONS, timeout=0)
+
+        self.assertEqual(apply_entries(self.redis, self.poll_id, OPTIONS, entries), [])
+        self.assertEqual(read_changes(self.redis, self.poll_id, OPTIONS)[1], {'red': 1})
+
+
+class PollMigrationTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+
+    def test_string_metadata_is_rewritten_as_a_hash(self):
+        self.redis.set(metadata_key('old'), '-;-'.join(['colours', 'test', '0', '1', '0', '-:-'.join(OPTIONS)]))
+
+        poll = get_poll(self.redis, 'old')
+
+        self.assertEqual(poll['options'], OPTIONS)
+        self.assertEqual(poll['revealed'], '0')
+        self.assertEqual(self.redis.type(metadata_key('old')), b'hash')
+        # no ballots to re-encode, but it ends up on the current version all the same
+        self.assertEqual(self.redis.hget(metadata_key('old'), 'v'), POLL_METADATA_VERSION.encode())
+
+    def test_text_ballots_are_index_encoded(self):
+        poll_id = make_poll(self.redis, 'v2')
+        self.redis.hset(metadata_key(poll_id), 'v', HASH_METADATA_VERSION)
+        self.redis.hset(votes_key(poll_id), mapping={'ann': 'red-:-blue', 'bob': 'green'})
+        self.redis.zadd(count_key(poll_id), {'red': 1, 'green': 1, 'blue': 1})
+        self.redis.sadd(legacy_option_voters_key(poll_id, 'blue'), 'ann')
+
+        get_poll(self.redis, poll_id)
+
+        self.assertEqual(self.redis.hget(metadata_key(poll_id), 'v'), POLL_METADATA_VERSION.encode())
+        self.assertEqual(self.redis.hgetall(votes_key(poll_id)), {b'ann': b'0,2', b'bob': b'1'})
+        self.assertEqual(read_changes(self.redis, poll_id, OPTIONS)[1], {'red': 1, 'green': 1, 'blue': 1})
+        self.assertEqual(self.redis.smembers(option_voters_key(poll_id, 2)), {b'ann'})
+        self.assertFalse(self.redis.exists(legacy_option_voters_key(poll_id, 'blue')))
+
+        # a second read finds the current version and leaves the ballots alone
+        get_poll(self.redis, poll_id)
+        self.assertEqual(self.redis.hget(votes_key(poll_id), 'ann'), b'0,2')
+
+    def test_option_sets_are_built_from_the_ballots(self):
+        # created before the option sets existed: ballots, but no sets
+        poll_id = make_poll(self.redis, 'no-sets')
+        self.redis.hset(metadata_key(poll_id), 'v', HASH_METADATA_VERSION)
+        self.redis.expire(metadata_key(poll_id), 600)
+        self.redis.hset(votes_key(poll_id), mapping={'ann': 'red-:-blue', 'bob': 'blue'})
+
+        get_poll(self.redis, poll_id)
+
+        self.assertEqual(self.redis.smembers(option_voters_key(poll_id, 0)), {b'ann'})
+        self.assertEqual(self.redis.smembers(option_voters_key(poll_id, 2)), {b'ann', b'bob'})
+        self.assertFalse(self.redis.exists(option_voters_key(poll_id, 1)))
+        self.assertEqual(self.redis.pexpiretime(option_voters_key(poll_id, 2)), self.redis.pexpiretime(metadata_key(poll_id)))
+
+
+class ResultsQueryTests(SimpleTestCase):
+    def test_page_count_is_capped(self):
+        query, error = parse_results_query({'cursor': '0', 'count': '100000'})
+        self.assertIsNone(error)
+        self.assertEqual((query['mode'], query['count']), ('page', 5000))
+
+    def test_page_count_below_one_is_refused(self):
+        for count in ('0', '-5', 'x'):
+            self.assertIsNone(parse_results_query({'cursor': '0', 'count': count})[0], count)
+
+    def test_scan_page_count_below_one_is_refused(self):
+        self.assertEqual(parse_page_query({'count': '20'}), ((0, 20), None))
+        for count in ('0', '-1'):
+            self.assertIsNone(parse_page_query({'count': count})[0], count)
+
+
+def make_jwks(*kids):
+    keys = []
+    for kid in kids:
+        public_key = rsa.generate_private_key(public_exponent=65537, key_size=2048).public_key()
+        keys.append({**json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(public_key)), 'kid': kid, 'use': 'sig'})
+    return {'keys': keys}
+
+
+class EtagTests(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_version_etag_is_weak(self):
+        self.assertEqual(version_etag(7), 'W/"7"')
+
+    def test_not_modified_needs_a_matching_tag(self):
+        self.assertIsNone(not_modified(self.factory.get('/'), 'W/"7"'))
+        self.assertIsNone(not_modified(self.factory.get('/', HTTP_IF_NONE_MATCH='W/"6"'), 'W/"7"'))
+
+        for header in ('W/"7"', '"7"', 'W/"6", W/"7"', '*'):
+            response = not_modified(self.factory.get('/', HTTP_IF_NONE_MATCH=header), 'W/"7"')
+            self.assertEqual(response.status_code, 304, header)
+            self.assertEqual(response['ETag'], 'W/"7"')
+
+
+class SnapshotResponseTests(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        options = [f'option {n}' for n in range(50)]
+        poll = {'description': 'colours', 'revealed': '1', 'options': options}
+        self.body, self.compressed = make_snapshot(poll, {option: 1 for option in options})
+
+    def test_plain_without_accept_encoding(self):
+        response = snapshot_response(self.factory.get('/'), (self.body, self.compressed, b'4'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.body)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response['ETag'], 'W/"4"')
+
+    def test_gzipped_when_accepted(self):
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='br, gzip;q=0.8')
+        response = snapshot_response(request, (self.body, self.compressed, b'4'))
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), self.body)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response['ETag'], 'W/"4"')
+
+    def test_not_modified_for_its_version(self):
+        request = self.factory.get('/', HTTP_IF_NONE_MATCH='W/"4"', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(snapshot_response(request, (self.body, self.compressed, b'4')).status_code, 304)
+
+    def test_snapshot_without_version_has_no_etag(self):
+        request = self.factory.get('/', HTTP_IF_NONE_MATCH='*')
+        response = snapshot_response(request, (self.body, self.compressed, None))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+
+class StubJwksEndpoint:
+    """Stands in for requests.get on Entra ID's JWKS endpoint: counts fetches, can hold them back or fail them"""
+
+    def __init__(self, jwks):
+        self.jwks = jwks
+        self.fetches = 0
+        self.failing = False
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, url, timeout=None):
+        self.fetches += 1
+        self.release.wait(5)
+        if self.failing:
+            raise requests.ConnectionError('JWKS endpoint down')
+        response = mock.Mock()
+        response.json.return_value = self.jwks
+        return response
+
+
+class JwksRefreshTests(SimpleTestCase):
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.endpoint = StubJwksEndpoint(make_jwks('kid-1'))
+        patcher = mock.patch.object(auth.requests, 'get', self.endpoint)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_verifier(self, name='worker'):
+        # a worker process of its own, sharing Redis with the others
+        verifier = auth.AzureADTokenVerifier()
+        verifier._redis_client = fakeredis.FakeRedis(server=self.server)
+        verifier._release_lock = verifier._redis_client.register_script(auth.RELEASE_LOCK_LUA)
+        verifier.local_jwks_file = f'{self.workdir.name}/{name}.json'
+        return verifier
+
+    def test_concurrent_callers_share_one_fetch(self):
+        verifiers = [self.make_verifier(f'worker-{n}') for n in range(3)]
+        self.endpoint.release.clear()
+        keys = []
+
+        def get_key(verifier):
+            keys.append(verifier.get_key('kid-1'))
+
+        threads = [threading.Thread(target=get_key, args=(verifier,)) for verifier in verifiers for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        self.endpoint.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.endpoint.fetches, 1)
+        self.assertEqual(len(keys), 24)
+        self.assertTrue(all(key is not None for key in keys))
+
+    def test_stale_keys_are_served_while_refreshing(self):
+        verifier = self.make_verifier()
+        verifier.cache_keys(make_jwks('kid-1'), fresh_for=-1)
+        stale_key = verifier._keys['kid-1']
+        self.endpoint.jwks = make_jwks('kid-1', 'kid-2')
+        self.endpoint.release.clear()
+
+        # answered from memory while the refresh waits on the endpoint
+        self.assertIs(verifier.get_key('kid-1'), stale_key)
+        self.assertIs(verifier.get_key('kid-1'), stale_key)
+
+        self.endpoint.release.set()
+        verifier._background_refresh.join()
+        self.assertEqual(self.endpoint.fetches, 1)
+        self.assertIn('kid-2', verifier._keys)
+        self.assertGreater(verifier._keys_fresh_until, time.monotonic())
+
+    def test_failed_refresh_keeps_the_old_keys(self):
+        verifier = self.make_verifier()
+        verifier.get_key('kid-1')
+        verifier._redis_client.delete(auth.JWKS_FRESH_KEY)
+        verifier._keys_fresh_until = 0
+        old_keys = verifier._keys
+        self.endpoint.failing = True
+
+        with self.assertLogs('voting.auth', 'WARNING'):
+            verifier.refresh()
+
+        self.assertEqual(self.endpoint.fetches, 2)
+        self.assertEqual(verifier._keys.keys(), old_keys.keys())
+        self.assertIsNotNone(verifier.get_key('kid-1'))
+        # retried after JWKS_RETRY_SECONDS, not on every request
+        self.assertGreater(verifier._keys_fresh_until, time.monotonic())
+        self.assertLessEqual(verifier._keys_fresh_until, time.monotonic() + auth.JWKS_RETRY_SECONDS)
+        self.assertEqual(verifier._redis_client.get(auth.JWKS_CACHE_KEY), json.dumps(self.endpoint.jwks).encode())
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ViewTestCase(TestCase):
+    """Views against fakeredis and the test database. The auth_token cookie is the user's email, and is taken as valid."""
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.factory = RequestFactory()
+        for patcher in (
+            mock.patch.object(views, 'get_redis_connection', return_value=self.redis),
+            mock.patch.object(auth.verifier, 'verify_token', side_effect=self.claims),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def claims(self, token):
+        return True, {
+            'name': token, 'preferred_username': token, 'oid': f'{token}-oid',
+            'roles': [settings.ENTRA_APP_ACCESS_IDENTIFIER],
+        }
+
+    def request(self, method, path, body=None, user='ann@x', **headers):
+        """body is the query of a GET and the JSON payload of anything else"""
+        if method == 'get':
+            request = self.factory.get(path, body, **headers)
+        else:
+            data = json.dumps(body) if body is not None else None
+            request = getattr(self.factory, method)(path, data=data, content_type='application/json', **headers)
+        request.COOKIES.update({'auth_token': user, 'access_token': 'access'})
+        return request
+
+    def create_poll(self):
+        """(poll_id, creation_id) of a new multiple choice poll of OPTIONS"""
+        body = {'type': 'test', 'description': 'colours', 'options': OPTIONS, 'revealed': 0, 'multi_selection': 1}
+        created = json.loads(views.create(self.request('post', '/create', body)).content)
+        return created['poll_id'], created['redirect_url'].rpartition('/')[2]
+
+    def reveal(self, creation_id):
+        self.assertEqual(views.poll_admin(self.request('patch', f'/create/{creation_id}'), creation_id).status_code, 200)
+
+
+class PollFlagTests(ViewTestCase):
+    def test_anonymous_template_hashes_voters(self):
+        # saved by CreatePoll.jsx, whose anonymous checkbox state is a JSON boolean
+        PollTemplate.objects.create(title='standup', created_by='ann@x-oid', template=json.dumps({
+            'type': 'standup', 'description': 'colours', 'options': OPTIONS,
+            'revealed': 0, 'multi_selection': 0, 'anonymous': True,
+        }))
+
+        response = views.bulk_create(self.request('post', '/create/bulk', {'polls': [{'template': 'standup'}]}))
+        self.assertEqual(response.status_code, 201)
+        poll_id = json.loads(response.content)['polls'][0]['poll_id']
+        self.assertEqual(self.redis.hget(metadata_key(poll_id), 'anonymous'), b'1')
+
+        response = views.cast_vote(self.request('patch', f'/{poll_id}', {'votes': ['red']}, user='bob@x'), poll_id)
+        self.assertEqual(response.status_code, 200)
+        voter_id = hashlib.sha256(f'bob@x:{poll_id}'.encode()).hexdigest()
+        self.assertEqual(self.redis.hkeys(votes_key(poll_id)), [voter_id.encode()])
+
+    def test_boolean_flags_are_stored_as_0_or_1(self):
+        body = {'type': 'test', 'description': 'colours', 'options': OPTIONS, 'revealed': False, 'multi_selection': True, 'anonymous': True}
+
+        response = views.create(self.request('post', '/create', body))
+
+        poll_id = json.loads(response.content)['poll_id']
+        self.assertEqual(
+            self.redis.hmget(metadata_key(poll_id), ['revealed', 'multi_selection', 'anonymous']),
+            [b'0', b'1', b'1'],
+        )
+
+    def test_other_flag_values_are_refused(self):
+        for value in ('true', 2, None, []):
+            body = {'type': 'test', 'description': 'colours', 'options': OPTIONS, 'revealed': 0, 'multi_selection': 0, 'anonymous': value}
+            self.assertEqual(views.create(self.request('post', '/create', body)).status_code, 400, value)
+
+
+class PollReadTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        self.poll_id, self.creation_id = self.create_poll()
+        self.admin = f'/create/{self.creation_id}'
+        cast_ballot(self.redis, self.poll_id, 'ann@x', ['red'], OPTIONS)
+        cast_ballot(self.redis, self.poll_id, 'bob@x', ['green', 'blue'], OPTIONS)
+
+    def admin_get(self, params=None, **headers):
+        return views.poll_admin(self.request('get', self.admin, params, **headers), self.creation_id)
+
+    def participant_get(self, **headers):
+        return views.cast_vote(self.request('get', f'/{self.poll_id}', **headers), self.poll_id)
+
+    def test_since_returns_the_ballots_changed_after_it(self):
+        version = json.loads(self.admin_get().content)['version']
+        cast_ballot(self.redis, self.poll_id, 'ann@x', ['blue'], OPTIONS)
+        cast_ballot(self.redis, self.poll_id, 'cat@x', ['red'], OPTIONS)
+
+        body = json.loads(self.admin_get({'since': version}).content)
+
+        self.assertEqual(body['version'], version + 2)
+        self.assertEqual(body['votes'], {'ann@x': ['blue'], 'cat@x': ['red']})
+        self.assertEqual(body['counts'], {'red': 1, 'green': 1, 'blue': 2})
+        self.assertEqual(json.loads(self.admin_get({'since': body['version']}).content)['votes'], {})
+
+    def test_pages_add_up_to_every_ballot(self):
+        cursor, votes, pages = 0, {}, 0
+        while True:
+            body = json.loads(self.admin_get({'cursor': cursor, 'count': 1}).content)
+            votes.update(body['votes'])
+            cursor, pages = body['cursor'], pages + 1
+            if not cursor:
+                break
+
+        self.assertEqual(votes, json.loads(self.admin_get().content)['votes'])
+        self.assertNotIn('votes', json.loads(self.admin_get({'mode': 'counts'}).content))
+        self.assertEqual(self.admin_get({'cursor': 'x'}).status_code, 400)
+
+    def test_admin_answers_304_until_a_ballot_changes(self):
+        response = self.admin_get()
+        etag = response['ETag']
+        self.assertEqual(etag, version_etag(json.loads(response.content)['version']))
+
+        self.assertEqual(self.admin_get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        cast_ballot(self.redis, self.poll_id, 'cat@x', ['red'], OPTIONS)
+        response = self.admin_get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_open_poll_answers_304(self):
+        response = self.participant_get()
+        self.assertEqual(response['ETag'], OPEN_POLL_ETAG)
+        self.assertNotIn('counts', json.loads(response.content))
+
+        self.assertEqual(self.participant_get(HTTP_IF_NONE_MATCH=OPEN_POLL_ETAG).status_code, 304)
+
+    def test_revealed_poll_serves_its_snapshot(self):
+        self.reveal(self.creation_id)
+
+        response = self.participant_get(HTTP_IF_NONE_MATCH=OPEN_POLL_ETAG)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        body = json.loads(response.content)
+        self.assertEqual(body['counts'], {'red': 1, 'green': 1, 'blue': 1})
+        self.assertEqual(body['metadata']['revealed'], '1')
+
+        self.assertEqual(self.participant_get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+
+class ArchiveTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        self.poll_id, self.creation_id = self.create_poll()
+        for n, votes in enumerate([['red'], ['red', 'blue'], ['green'], ['blue']]):
+            cast_ballot(self.redis, self.poll_id, f'voter{n}@x', votes, OPTIONS)
+        # recast, so the ballot versions differ from the insertion order
+        cast_ballot(self.redis, self.poll_id, 'voter0@x', ['green', 'blue'], OPTIONS)
+
+    def archive(self, limit=20):
+        return archive_due_polls(self.redis, now=time.time() + ARCHIVE_AFTER_SECONDS + 1, limit=limit)
+
+    def get(self, view, path, *args, **params):
+        response = view(self.request('get', path, params or None), *args)
+        self.assertEqual(response.status_code, 200, response.content)
+        return json.loads(response.content)
+
+    def responses(self):
+        """The body of every read of the poll"""
+        admin = f'/create/{self.creation_id}'
+        return {
+            'full': self.get(views.poll_admin, admin, self.creation_id),
+            'since': self.get(views.poll_admin, admin, self.creation_id, since=3),
+            'participant': self.get(views.cast_vote, f'/{self.poll_id}', self.poll_id),
+            'voters': {option: self.get(views.option_voters, f'{admin}/voters', self.creation_id, option=option)['voters'] for option in OPTIONS},
+            'overlap': self.get(views.option_overlap, f'{admin}/overlap', self.creation_id),
+            'timeline': {resolution: self.get(views.vote_timeline, f'{admin}/timeline', self.creation_id, resolution=resolution) for resolution in ('second', 'minute')},
+        }
+
+    def pages(self, count):
+        cursor, votes = 0, {}
+        while True:
+            page = self.get(views.poll_admin, f'/create/{self.creation_id}', self.creation_id, cursor=cursor, count=count)
+            votes.update(page['votes'])
+            cursor = page['cursor']
+            if not cursor:
+                return votes
+
+    def test_archive_moves_the_poll_to_the_database(self):
+        self.reveal(self.creation_id)
+
+        self.assertEqual(self.archive(), 1)
+
+        archived = ArchivedPoll.objects.get(creation_id=self.creation_id)
+        self.assertEqual(archived.poll_id, self.poll_id)
+        self.assertEqual(archived.counts, {'red': 1, 'green': 2, 'blue': 3})
+        # the reveal bumps it too
+        self.assertEqual(archived.version, 6)
+        self.assertEqual(dict(archived.ballots.values_list('voter', 'version')), {'voter0@x': 5, 'voter1@x': 2, 'voter2@x': 3, 'voter3@x': 4})
+        self.assertEqual(sum(count for _, count in archived.timeline['minute']), 5)
+        self.assertFalse(self.redis.exists(votes_key(self.poll_id), metadata_key(self.poll_id), creation_key(self.creation_id)))
+
+    def test_unrevealed_polls_are_not_archived(self):
+        self.assertEqual(self.archive(), 0)
+        self.assertTrue(self.redis.exists(votes_key(self.poll_id)))
+
+    def test_archived_poll_reads_like_the_live_one(self):
+        self.reveal(self.creation_id)
+        live, live_pages = self.responses(), self.pages(count=1)
+
+        self.archive()
+
+        archived = self.responses()
+        self.assertEqual(archived, live)
+        self.assertEqual(archived['since']['votes'], {'voter0@x': ['green', 'blue'], 'voter3@x': ['blue']})
+        self.assertEqual(self.pages(count=1), live_pages)
+        self.assertEqual(self.get(views.poll_presence, '/presence', self.creation_id), {'connected': 0, 'voted': 4})
+
+    def test_archived_poll_answers_304(self):
+        self.reveal(self.creation_id)
+        self.archive()
+
+        for view, path, arg in ((views.poll_admin, f'/create/{self.creation_id}', self.creation_id), (views.cast_vote, f'/{self.poll_id}', self.poll_id)):
+            etag = view(self.request('get', path), arg)['ETag']
+            self.assertEqual(etag, version_etag(6))
+            self.assertEqual(view(self.request('get', path, HTTP_IF_NONE_MATCH=etag), arg).status_code, 304)
+
+    def test_sweep_archives_a_limited_number_of_polls(self):
+        creation_ids = [self.creation_id] + [self.create_poll()[1] for _ in range(2)]
+        for creation_id in creation_ids:
+            self.reveal(creation_id)
+
+        self.assertEqual(self.archive(limit=2), 2)
+        self.assertEqual(self.archive(limit=2), 1)
+        self.assertEqual(self.archive(limit=2), 0)
+        self.assertEqual(ArchivedPoll.objects.count(), 3)
+
+
+class TemplateCacheTests(ViewTestCase):
+    def save(self, title):
+        body = {'type': title, 'description': 'colours', 'options': OPTIONS, 'revealed': 0, 'multi_selection': 0}
+        self.assertEqual(views.templates(self.request('post', '/templates', body)).status_code, 201)
+
+    def titles(self, search=''):
+        return sorted(json.loads(views.templates(self.request('get', '/templates', {'search': search})).content))
+
+    def test_hits_skip_the_database(self):
+        self.save('retro')
+        self.assertEqual(self.titles(), ['retro'])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.titles(), ['retro'])
+
+    def test_writes_drop_the_cached_responses(self):
+        self.save('retro')
+        self.assertEqual(self.titles('re'), ['retro'])
+
+        self.save('review')
+        self.assertEqual(self.titles('re'), ['retro', 'review'])
+        views.templates(self.request('delete', '/templates', {'title': 'retro'}))
+        self.assertEqual(self.titles('re'), ['review'])
+
+    def test_fill_from_before_a_write_is_dropped(self):
+        user_id = 'ann@x-oid'
+        generation = self.redis.get(templates_generation_key(user_id)) or b'0'
+        # a write lands while the reader waits on the database
+        self.save('retro')
+
+        _fill_script(keys=[templates_generation_key(user_id), templates_cache_key(user_id)], args=[generation, '', b'{}', 60], client=self.redis)
+
+        self.assertFalse(self.redis.exists(templates_cache_key(user_id)))
+        self.assertEqual(json.loads(get_cached_templates(self.redis, user_id, '')).keys(), {'retro'})
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class PollAdminSocketTests(SimpleTestCase):
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=server)
+        make_poll(self.redis)
+        self.redis.set(creation_key('creation'), 'poll')
+        cast_ballot(self.redis, 'poll', 'ann', ['red'], OPTIONS)
+        for patcher in (
+            mock.patch.object(consumers, 'get_async_redis_connection', return_value=fakeredis.FakeAsyncRedis(server=server)),
+            mock.patch.object(auth.verifier, 'verify_token', return_value=(True, {'roles': [settings.ENTRA_APP_ACCESS_IDENTIFIER]})),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def connect(self, cookie):
+        communicator = WebsocketCommunicator(
+            consumers.PollAdminConsumer.as_asgi(), '/ws/poll_admin/creation/', headers=[(b'cookie', cookie)]
+        )
+        communicator.scope['url_route'] = {'kwargs': {'creation_id': 'creation'}}
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_snapshot_after_the_http_credentials(self):
+        communicator, connected = await self.connect(b'auth_token=id; access_token=access')
+
+        self.assertTrue(connected)
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual((snapshot['type'], snapshot['votes'], snapshot['counts']), ('snapshot', {'ann': ['red']}, {'red': 1}))
+        await communicator.disconnect()
+
+    async def test_id_token_alone_is_refused(self):
+        communicator, connected = await self.connect(b'auth_token=id')
+
+        self.assertFalse(connected)
@@ -1,13 +1,27 @@
+from django.conf import settings
 from django.urls import include, path
 
+from . import async_views
 from . import auth
 from . import views
 
+if settings.ASYNC_VIEWS:
+    vote_views = async_views
+else:
+    vote_views = views
+
 urlpatterns = [
     path("templates", views.templates, name="index"),
-    path("create", views.create, name="create_poll"),
-    path("create/<str:creation_id>", views.poll_admin, name="poll_admin"),
-    path("<str:poll_id>", views.cast_vote, name="participant_functions"),
+    path("metrics", views.prometheus_metrics, name="metrics"),
+    path("create", vote_views.create, name="create_poll"),
+    path("create/bulk", views.bulk_create, name="bulk_create"),
+    path("create/<str:creation_id>", vote_views.poll_admin, name="poll_admin"),
+    path("create/<str:creation_id>/voters", views.option_voters, name="option_voters"),
+    path("create/<str:creation_id>/overlap", views.option_overlap, name="option_overlap"),
+    path("create/<str:creation_id>/presence", views.poll_presence, name="poll_presence"),
+    path("create/<str:creation_id>/timeline", views.vote_timeline, name="vote_timeline"),
+    path("create/<str:creation_id>/export", async_views.export_results, name="export_results"),
+    path("<str:poll_id>", vote_views.cast_vote, name="participant_functions"),
 
     path('oauth2/callback', auth.oauth_callback, name='oauth_callback'),
     path('auth/verify', auth.verify_auth, name='verify-active-session'),
@@ -1,59 +1,448 @@
-from .redis_pool import get_redis_connection
+import hashlib
+import json
 
-def get_poll(redis_conn, poll_id):
-        poll_string = redis_conn.get(f'{poll_id}:metadata')
+import orjson
+import redis
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
 
-        if poll_string is None:
-            return None
+from .fanout import poll_revealed_frame
+from .keys import count_key, creation_key, legacy_option_voters_key, metadata_key, option_voters_key, version_key, votes_key
+from .redis_pool import LazyScript
+from .vote_engine import decode_ballot, decode_counts
 
-        poll = parse_poll_metadata_string(poll_string.decode('utf-8'))
-        return poll
+required_fields = ['type', 'revealed', 'multi_selection', 'options', 'description']
+
+# 2: metadata hash, ballots stored as option texts. 3: ballots index encoded (vote_engine.py)
+POLL_METADATA_VERSION = '3'
+HASH_METADATA_VERSION = '2'
+poll_fields = ['description', 'type', 'revealed', 'multi_selection', 'anonymous', 'options']
+# the fields cast_vote needs to validate a ballot
+vote_fields = ['revealed', 'multi_selection', 'anonymous', 'options']
+# stored as '0' / '1', and compared to '1' everywhere they are read. Poll bodies
+# may send them as 0/1, '0'/'1' or JSON booleans (saved templates do).
+flag_fields = ['revealed', 'multi_selection', 'anonymous']
+
+# Rewrites a pre-v2 '-;-' / '-:-' delimited metadata string in place as a hash.
+# Runs server side so a concurrent reveal can't be lost between read and rewrite.
+MIGRATE_POLL_METADATA_LUA = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'string' then
+    return 0
+end
+
+local function split(s, sep)
+    local parts = {}
+    local start = 1
+    while true do
+        local first, last = string.find(s, sep, start, true)
+        if not first then
+            table.insert(parts, string.sub(s, start))
+            return parts
+        end
+        table.insert(parts, string.sub(s, start, first - 1))
+        start = last + 1
+    end
+end
+
+local params = split(redis.call('GET', KEYS[1]), '-;-')
+if #params ~= 6 then
+    return 0
+end
+
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1],
+    'v', ARGV[1],
+    'description', params[1],
+    'type', params[2],
+    'revealed', params[3],
+    'multi_selection', params[4],
+    'anonymous', params[5],
+    'options', cjson.encode(split(params[6], '-:-')))
+return 1
+"""
+
+# KEYS: metadata, votes, count, option sets by text (N), option sets by index (N)
+# ARGV: target version, option 1 .. option N
+#
+# Rewrites a v2 poll's ballots, counts and option sets in the index encoding.
+# The option sets are built from the ballots, with the metadata's TTL.
+# One script, so no ballot can land in between; it's a single pass over the
+# poll's ballots, paid once by the first reader after the upgrade.
+MIGRATE_POLL_BALLOTS_LUA = """
+if redis.call('HGET', KEYS[1], 'v') == ARGV[1] then
+    return 0
+end
+
+local option_count = #ARGV - 1
+local positions = {}
+for i = 1, option_count do
+    positions[ARGV[1 + i]] = tostring(i - 1)
+end
+
+local function encode(ballot)
+    local encoded = {}
+    local start = 1
+    while start <= #ballot do
+        local first, last = string.find(ballot, '-:-', start, true)
+        local option = string.sub(ballot, start, (first or #ballot + 1) - 1)
+        if positions[option] then
+            table.insert(encoded, positions[option])
+        end
+        if not first then
+            break
+        end
+        start = last + 1
+    end
+    return table.concat(encoded, ',')
+end
+
+-- voters by option index, for the option sets
+local voters = {}
+for i = 1, option_count do
+    voters[i] = {}
+end
+
+local ballots = redis.call('HGETALL', KEYS[2])
+for start = 1, #ballots, 2000 do
+    local chunk = {}
+    for i = start, math.min(start + 1999, #ballots), 2 do
+        local encoded = encode(ballots[i + 1])
+        table.insert(chunk, ballots[i])
+        table.insert(chunk, encoded)
+        for index in string.gmatch(encoded, '[^,]+') do
+            table.insert(voters[tonumber(index) + 1], ballots[i])
+        end
+    end
+    redis.call('HSET', KEYS[2], unpack(chunk))
+end
+
+local counts = redis.call('ZRANGE', KEYS[3], 0, -1, 'WITHSCORES')
+if #counts > 0 then
+    local expire_at = redis.call('PEXPIRETIME', KEYS[3])
+    redis.call('DEL', KEYS[3])
+    for i = 1, #counts, 2 do
+        if positions[counts[i]] then
+            redis.call('ZADD', KEYS[3], counts[i + 1], positions[counts[i]])
+        end
+    end
+    if expire_at > 0 then
+        redis.call('PEXPIREAT', KEYS[3], expire_at)
+    end
+end
+
+-- rebuilt from the ballots rather than renamed: polls created before the
+-- option sets existed have none, and they can't miss a voter either way
+local expire_at = redis.call('PEXPIRETIME', KEYS[1])
+for i = 1, option_count do
+    local key = KEYS[3 + option_count + i]
+    redis.call('DEL', KEYS[3 + i], key)
+    for start = 1, #voters[i], 2000 do
+        redis.call('SADD', key, unpack(voters[i], start, math.min(start + 1999, #voters[i])))
+    end
+    if expire_at > 0 and #voters[i] > 0 then
+        redis.call('PEXPIREAT', key, expire_at)
+    end
+end
+
+redis.call('HSET', KEYS[1], 'v', ARGV[1])
+return 1
+"""
+
+# KEYS: metadata, version
+# A script rather than MULTI/EXEC, which Redis Cluster clients don't offer.
+REVEAL_POLL_LUA = """
+redis.call('HSET', KEYS[1], 'revealed', '1')
+return redis.call('INCR', KEYS[2])
+"""
+
+_migrate_script = LazyScript(MIGRATE_POLL_METADATA_LUA)
+_async_migrate_script = LazyScript(MIGRATE_POLL_METADATA_LUA)
+_migrate_ballots_script = LazyScript(MIGRATE_POLL_BALLOTS_LUA)
+_async_migrate_ballots_script = LazyScript(MIGRATE_POLL_BALLOTS_LUA)
+_reveal_script = LazyScript(REVEAL_POLL_LUA)
+_async_reveal_script = LazyScript(REVEAL_POLL_LUA)
+
+def get_poll(redis_conn, poll_id, fields=None):
+    """
+    Read a poll's metadata hash, or only the given fields of it.
+    Old string encoded polls are migrated to the hash layout on first read,
+    and polls with text ballots to the index encoding.
+    """
+    key = metadata_key(poll_id)
+    fields = fields or poll_fields
+    try:
+        *values, version = redis_conn.hmget(key, [*fields, 'v'])
+    except redis.ResponseError as e:
+        if 'WRONGTYPE' not in str(e):
+            raise
+        _migrate_script(keys=[key], args=[HASH_METADATA_VERSION], client=redis_conn)
+        *values, version = redis_conn.hmget(key, [*fields, 'v'])
+    if version is not None and version.decode('utf-8') != POLL_METADATA_VERSION:
+        options = json.loads(redis_conn.hget(key, 'options'))
+        _migrate_ballots_script(
+            keys=_ballot_migration_keys(poll_id, options), args=[POLL_METADATA_VERSION, *options], client=redis_conn
+        )
+    return decode_poll_metadata(fields, values)
 
 def get_poll_from_creation_id(redis_conn, creation_id):
-    poll_id = redis_conn.get(f'{creation_id}:poll_id')
+    poll_id = redis_conn.get(creation_key(creation_id))
     if poll_id is None:
-        return None
+        return None, None
     return poll_id.decode('utf-8'), get_poll(redis_conn, poll_id.decode('utf-8'))
 
-def parse_poll_metadata_string(poll_string):
-    if not poll_string or not isinstance(poll_string, str):
-        print("Invalid poll string format")
-        return None 
-
+async def aget_poll(redis_conn, poll_id, fields=None):
+    key = metadata_key(poll_id)
+    fields = fields or poll_fields
     try:
-        params = poll_string.split('-;-')
-        if len(params) < 6:
-            print("Incomplete poll string")
-            return None
-
-        description, poll_type, revealed, multi_selection, anonymous, options = params
-        options_list = options.split("-:-")
-
-        return {
-            'description': description,
-            'type': poll_type,
-            'revealed': revealed,
-            'multi_selection': multi_selection,
-            'anonymous': anonymous,
-            'options': options_list
-        }
-
-    except Exception as e:
-        print(f"Error while parsing poll string: {str(e)}")
+        *values, version = await redis_conn.hmget(key, [*fields, 'v'])
+    except redis.ResponseError as e:
+        if 'WRONGTYPE' not in str(e):
+            raise
+        await _async_migrate_script(keys=[key], args=[HASH_METADATA_VERSION], client=redis_conn)
+        *values, version = await redis_conn.hmget(key, [*fields, 'v'])
+    if version is not None and version.decode('utf-8') != POLL_METADATA_VERSION:
+        options = json.loads(await redis_conn.hget(key, 'options'))
+        await _async_migrate_ballots_script(
+            keys=_ballot_migration_keys(poll_id, options), args=[POLL_METADATA_VERSION, *options], client=redis_conn
+        )
+    return decode_poll_metadata(fields, values)
+
+async def aget_poll_from_creation_id(redis_conn, creation_id):
+    poll_id = await redis_conn.get(creation_key(creation_id))
+    if poll_id is None:
+        return None, None
+    return poll_id.decode('utf-8'), await aget_poll(redis_conn, poll_id.decode('utf-8'))
+
+def _ballot_migration_keys(poll_id, options):
+    return [
+        metadata_key(poll_id), votes_key(poll_id), count_key(poll_id),
+        *(legacy_option_voters_key(poll_id, option) for option in options),
+        *(option_voters_key(poll_id, index) for index in range(len(options))),
+    ]
+
+def make_poll_metadata(poll):
+    """Poll dict -> mapping stored in the poll's metadata hash"""
+    metadata = {field: str(poll[field]) for field in poll_fields if field != 'options'}
+    for field in flag_fields:
+        metadata[field] = '1' if poll[field] in (1, '1') else '0'
+    metadata['options'] = json.dumps(poll['options'])
+    metadata['v'] = POLL_METADATA_VERSION
+    return metadata
+
+def decode_poll_metadata(fields, values):
+    if all(value is None for value in values):
         return None
-    
-def make_poll_metadata_string(poll):
-    options = "-:-".join(poll['options'])
-    poll_string = f"{poll['description']}-;-{poll['type']}-;-{poll['revealed']}-;-{poll['multi_selection']}-;-{poll['anonymous']}-;-{options}"
-    return poll_string
-
-def get_poll_results(redis_conn, poll_id):
-    votes = redis_conn.hgetall(f'{poll_id}:votes')
+
+    poll = {}
+    for field, value in zip(fields, values):
+        value = value.decode('utf-8') if value is not None else None
+        poll[field] = json.loads(value) if field == 'options' and value else value
+    return poll
+
+def set_poll_revealed(redis_conn, poll_id):
+    """Flip revealed and bump the poll version, atomically"""
+    return _reveal_script(keys=[metadata_key(poll_id), version_key(poll_id)], client=redis_conn)
+
+async def aset_poll_revealed(redis_conn, poll_id):
+    return await _async_reveal_script(keys=[metadata_key(poll_id), version_key(poll_id)], client=redis_conn)
+
+def get_poll_results(redis_conn, poll_id, options):
+    votes = redis_conn.hgetall(votes_key(poll_id))
+    counts = redis_conn.zrevrange(count_key(poll_id), 0, -1, withscores=True)
+    return decode_poll_results(votes, counts, options)
+
+async def aget_poll_results(redis_conn, poll_id, options):
+    votes = await redis_conn.hgetall(votes_key(poll_id))
+    counts = await redis_conn.zrevrange(count_key(poll_id), 0, -1, withscores=True)
+    return decode_poll_results(votes, counts, options)
+
+def get_poll_counts(redis_conn, poll_id, options):
+    counts = redis_conn.zrevrange(count_key(poll_id), 0, -1, withscores=True)
+    return decode_poll_results(None, counts, options)[1]
+
+async def aget_poll_counts(redis_conn, poll_id, options):
+    counts = await redis_conn.zrevrange(count_key(poll_id), 0, -1, withscores=True)
+    return decode_poll_results(None, counts, options)[1]
+
+def get_poll_votes_page(redis_conn, poll_id, options, cursor, count):
+    cursor, votes = redis_conn.hscan(votes_key(poll_id), cursor, count=count)
+    return cursor, decode_poll_results(votes, None, options)[0]
+
+async def aget_poll_votes_page(redis_conn, poll_id, options, cursor, count):
+    cursor, votes = await redis_conn.hscan(votes_key(poll_id), cursor, count=count)
+    return cursor, decode_poll_results(votes, None, options)[0]
+
+def get_option_voters_page(redis_conn, poll_id, options, option, cursor, count):
+    key = option_voters_key(poll_id, options.index(option))
+    cursor, voters = redis_conn.sscan(key, cursor, count=count)
+    return cursor, sorted(voter.decode('utf-8') for voter in voters)
+
+def get_option_overlap(redis_conn, poll_id, options):
+    """
+    Voter count per option and, for every pair of options, how many voters picked
+    both (SINTERCARD, so no intersection is sent back) and the Jaccard index.
+    One pipelined round trip.
+    """
+    pairs = [(a, b) for a in range(len(options)) for b in range(a + 1, len(options))]
+    pipe = redis_conn.pipeline(transaction=False)
+    for index in range(len(options)):
+        pipe.scard(option_voters_key(poll_id, index))
+    for a, b in pairs:
+        pipe.sintercard(2, [option_voters_key(poll_id, a), option_voters_key(poll_id, b)])
+    results = pipe.execute()
+    return option_overlap_report(options, results[:len(options)], dict(zip(pairs, results[len(options):])))
+
+def option_overlap_report(options, voters, both_counts):
+    """The get_option_overlap body from the voter count per option index and the voters of both per index pair (a < b)"""
+    overlap = []
+    for (a, b), both in both_counts.items():
+        either = voters[a] + voters[b] - both
+        overlap.append({
+            'options': [options[a], options[b]],
+            'both': both,
+            'jaccard': round(both / either, 4) if either else 0.0,
+        })
+    return {'voters': dict(zip(options, voters)), 'overlap': overlap}
+
+def decode_poll_results(votes, counts, options):
     if votes:
-        votes = {key.decode('utf-8'): value.decode('utf-8').split("-:-") for key, value in votes.items()}
+        votes = {key.decode('utf-8'): decode_ballot(value, options) for key, value in votes.items()}
 
-    counts = redis_conn.zrevrange(f'{poll_id}:count', 0, -1, withscores=True)
     if counts:
-        counts = {option.decode('utf-8'): int(score) for option, score in counts}
+        counts = decode_counts(counts, options)
 
     return [votes, counts]
+
+def get_poll_version(redis_conn, poll_id):
+    """The poll's version, or None if the poll is gone. One pipelined round trip."""
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.get(version_key(poll_id))
+    pipe.exists(metadata_key(poll_id))
+    version, exists = pipe.execute()
+    return int(version or 0) if exists else None
+
+async def aget_poll_version(redis_conn, poll_id):
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        pipe.get(version_key(poll_id))
+        pipe.exists(metadata_key(poll_id))
+        version, exists = await pipe.execute()
+    return int(version or 0) if exists else None
+
+# Participants of an open poll see its metadata only, which can't change
+# before the reveal, and that bumps the version
+OPEN_POLL_ETAG = 'W/"open"'
+
+def version_etag(version):
+    """Weak, as the plain and gzipped bodies of a version share it"""
+    return f'W/"{version}"'
+
+def not_modified(request, etag):
+    """A 304 if the request's If-None-Match holds etag, otherwise None"""
+    tags = parse_etags(request.headers.get('If-None-Match', ''))
+    if '*' not in tags and etag.removeprefix('W/') not in (tag.removeprefix('W/') for tag in tags):
+        return None
+    response = HttpResponseNotModified()
+    response['ETag'] = etag
+    return response
+
+def fast_json_response(data, status=200):
+    """JsonResponse for the hot read paths, encoded with orjson"""
+    return HttpResponse(orjson.dumps(data), content_type='application/json', status=status)
+
+def poll_body_error(poll_body):
+    """Return an error message if a poll body from the UI can't be turned into a poll"""
+    if not all(field in poll_body for field in required_fields):
+        return 'Missing required fields'
+
+    if not isinstance(poll_body['options'], list) or len(poll_body['options']) == 0:
+        return 'Options must be a non-empty list'
+
+    if len(poll_body['options']) != len(set(poll_body['options'])):
+        return 'Duplicate options are not allowed'
+
+    # True == 1 and False == 0, so JSON booleans pass
+    if any(field in poll_body and poll_body[field] not in (0, 1, '0', '1') for field in flag_fields):
+        return f'{", ".join(flag_fields)} must be 0 or 1'
+
+    return None
+
+def ballot_error(poll, ballot):
+    """Return an error message if a ballot is not valid for the poll"""
+    if poll['multi_selection'] == '0' and len(ballot['votes'])>1:
+        return 'Only one option can be chosen for this poll'
+
+    if not all(field in poll['options'] for field in ballot['votes']):
+        return 'Invalid option'
+
+    if len(ballot['votes']) != len(set(ballot['votes'])):
+        return 'Duplicate votes are not allowed'
+
+    return None
+
+def get_voter_id(poll, poll_id, user_email):
+    # 'True': stored from a JSON boolean before make_poll_metadata normalized the flags
+    if poll['anonymous'] in ('1', 'True'):
+        return hashlib.sha256(f"{user_email}:{poll_id}".encode()).hexdigest()
+    return user_email
+
+def vote_cast_event(voter_id, votes, previous):
+    """Channel layer event sent to the poll admin group after a successful vote"""
+    return {
+        'type': 'vote_cast',
+        'voter': voter_id,
+        'votes': votes,
+        'previous': previous,
+    }
+
+def poll_revealed_event(poll_id, poll, counts):
+    """
+    Channel layer event sent to the participants of a poll on reveal. Carries the
+    text frame for the sockets, with the same results as GET /<poll_id>, serialized
+    here once rather than by every consumer in the group.
+    """
+    return {
+        'type': 'poll_revealed',
+        'frame': poll_revealed_frame(poll_id, {
+            'metadata': poll,
+            'counts': counts,
+        }),
+    }
+
+def parse_results_query(params):
+    """
+    Read the admin results query string into (query, error_message).
+      (none)              every ballot, as before
+      ?mode=counts        counts only
+      ?since=<version>    only the ballots that changed after that version
+      ?cursor=<c>&count=n one HSCAN page of ballots, follow the returned cursor until it is 0
+    Every mode also returns the counts and the current version.
+    """
+    query = {'mode': 'full', 'since': None, 'cursor': 0, 'count': 500}
+    try:
+        if params.get('mode') == 'counts':
+            query['mode'] = 'counts'
+        elif 'since' in params:
+            query['mode'] = 'since'
+            query['since'] = int(params['since'])
+        elif 'cursor' in params:
+            query['mode'] = 'page'
+            query['cursor'] = int(params['cursor'])
+            query['count'] = parse_page_count(params, query['count'])
+    except ValueError:
+        return None, 'since, cursor and count must be integers, count at least 1'
+    return query, None
+
+def parse_page_count(params, default):
+    """?count=, capped at 5000. ValueError unless it is an integer of at least 1, SCAN refuses 0 and less."""
+    count = int(params.get('count', default))
+    if count < 1:
+        raise ValueError(count)
+    return min(count, 5000)
+
+def parse_page_query(params):
+    """Read ?cursor=<c>&count=n for SSCAN/HSCAN pages into ((cursor, count), error_message)"""
+    try:
+        return (int(params.get('cursor', 0)), parse_page_count(params, 500)), None
+    except ValueError:
+        return None, 'cursor and count must be integers, count at least 1'
+
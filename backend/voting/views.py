@@ -1,4 +1,5 @@
-import hashlib
+import hmac
+import logging
 import os
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
@@ -11,18 +12,26 @@ from nanoid import generate
 from voting.auth import AzureADTokenVerifier, is_authenticated
 from rocketVoteAPI import settings
 
-from .tasks import delete_poll
-from .utils import get_poll, get_poll_from_creation_id, get_poll_results, make_poll_metadata_string
-from .models import PollTemplate
+from .archive import archived_option_overlap, archived_option_voters, queue_poll_archive
+from .consumers import admin_group_name
+from .expiry import delete_seconds, queue_poll_expiry, schedule_poll_expiry, unrevealed_delete_seconds
+from .fanout import LOCAL_FANOUT, publish_reveal
+from .ingest import STREAM_INGESTION, drain_poll, enqueue_ballot, get_ingestion_lag
+from .keys import creation_key, metadata_key
+from .metrics import METRICS_TOKEN, metrics
+from .utils import get_option_overlap, get_option_voters_page, get_poll_counts, get_poll_from_creation_id, get_poll_results, get_poll_version, get_poll_votes_page, get_voter_id, make_poll_metadata, parse_page_query, parse_results_query, poll_body_error, poll_revealed_event, required_fields, set_poll_revealed, vote_cast_event
+from .models import ArchivedPoll, PollTemplate
+from .poll_cache import get_cached_poll, get_cached_poll_id, poll_cache, publish_poll_invalidation
+from .presence import get_presence
+from .responses import admin_response, archived_admin_response, archived_poll_response, cast_response, checks_version_first, open_poll_response, parse_ballot, poll_closed_response, revealed_poll_response, undrained_reveal_response, version_not_modified
 from .redis_pool import get_redis_connection
+from .snapshot import get_snapshot, snapshot_response, store_snapshot
+from .template_cache import get_cached_templates, invalidate_templates
+from .vote_engine import TIMELINE_RESOLUTIONS, VOTE_OK, cast_ballot, get_vote_timeline, read_changes
 
 import msal
 
-# required_fields = ['type', 'options', 'revealed', 'multi_selection']
-required_fields = ['type', 'revealed', 'multi_selection', 'options', 'description']
-result_limit = 12
-
-delete_seconds = int(os.getenv('AUTO_DELETE_DAYS', '10'))*24*60*60
+logger = logging.getLogger(__name__)
 
 @csrf_exempt
 @is_authenticated
@@ -30,9 +39,8 @@ def templates(request):
     if request.method == 'GET':
         try:
             query = request.GET.get('search', '')
-            results = PollTemplate.objects.filter(title__icontains=query, created_by=request.user['object_id']) if query else PollTemplate.objects.filter(created_by=request.user['object_id'])
-            response = {result.title: json.loads(result.template) for result in results[:12]}
-            return JsonResponse(response, status=200)
+            body = get_cached_templates(get_redis_connection(), request.user['object_id'], query)
+            return HttpResponse(body, content_type='application/json', status=200)
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
 
@@ -43,12 +51,13 @@ def templates(request):
             if not all(field in input_template for field in required_fields):
                 return JsonResponse({'error': 'Missing required fields'}, status=400)
             
-            new_template = PollTemplate(
+            # saving under an existing title replaces that template
+            PollTemplate.objects.update_or_create(
                 title=input_template['type'],
-                template=json.dumps(input_template),
-                created_by = request.user['object_id']
+                created_by=request.user['object_id'],
+                defaults={'template': json.dumps(input_template)},
             )
-            new_template.save()
+            invalidate_templates(get_redis_connection(), request.user['object_id'])
 
             return JsonResponse({'message': 'Template created successfully!'}, status=201)
 
@@ -68,6 +77,7 @@ def templates(request):
             try:
                 template = PollTemplate.objects.get(title=template_title, created_by=request.user['object_id'])
                 template.delete()
+                invalidate_templates(get_redis_connection(), request.user['object_id'])
                 return JsonResponse({'message': f'Template with title "{template_title}" deleted successfully!'}, status=200)
 
             except PollTemplate.DoesNotExist:
@@ -95,29 +105,22 @@ def create(request):
     except json.JSONDecodeError:
         return JsonResponse({'error': 'Invalid JSON payload'}, status=400)
 
-    if not all(field in poll_body for field in required_fields):
-        return JsonResponse({'error': 'Missing required fields'}, status=400)
-
-    if not isinstance(poll_body['options'], list) or len(poll_body['options']) == 0:
-        return JsonResponse({'error': 'Options must be a non-empty list'}, status=400)
-    
-    if len(poll_body['options']) != len(set(poll_body['options'])):
-        return JsonResponse({'error': 'Duplicate options are not allowed'}, status=400)
-    
-    anonymous = poll_body.get('anonymous', 0)
+    error = poll_body_error(poll_body)
+    if error:
+        return JsonResponse({'error': error}, status=400)
 
     creation_id = generate()
     new_poll_id = generate(size=8)  # for shareable URL
 
-    poll_metadata_key = f'{new_poll_id}:metadata'
-    options = "-:-".join(poll_body['options'])
-    poll_metadata = f"{poll_body['description']}-;-{poll_body['type']}-;-{poll_body['revealed']}-;-{poll_body['multi_selection']}-;-{anonymous}-;-{options}"
+    poll_metadata_key = metadata_key(new_poll_id)
+    poll_metadata = make_poll_metadata({**poll_body, 'anonymous': poll_body.get('anonymous', 0)})
 
     try:
         redis_conn = get_redis_connection()
-        redis_conn.set(poll_metadata_key, poll_metadata)
-        creation_to_poll_key = f'{creation_id}:poll_id'
+        redis_conn.hset(poll_metadata_key, mapping=poll_metadata)
+        creation_to_poll_key = creation_key(creation_id)
         redis_conn.set(creation_to_poll_key, new_poll_id)
+        schedule_poll_expiry(redis_conn, creation_id, new_poll_id, unrevealed_delete_seconds)
     except Exception as e:
         return JsonResponse({'error': f'Failed to save poll data: {str(e)}'}, status=500)
 
@@ -129,9 +132,69 @@ def create(request):
         status=201
     )
 
+# most polls one bulk create may hold
+bulk_create_limit = int(os.getenv('BULK_CREATE_LIMIT', '100'))
+
 @csrf_exempt
 @is_authenticated
-@csrf_exempt 
+def bulk_create(request):
+    """
+    Create several polls at once from {"polls": [...]}, each entry a poll body
+    like create takes, or {"template": "<title>"} to use one of the user's
+    templates (other keys of the entry override the template's). Nothing is
+    created unless every entry is valid, and all polls are written in one
+    pipelined round trip.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+    try:
+        entries = json.loads(request.body).get('polls')
+    except (json.JSONDecodeError, AttributeError):
+        return JsonResponse({'error': 'Invalid JSON payload'}, status=400)
+
+    if not isinstance(entries, list) or not entries:
+        return JsonResponse({'error': 'polls must be a non-empty list'}, status=400)
+    if len(entries) > bulk_create_limit:
+        return JsonResponse({'error': f'At most {bulk_create_limit} polls per request'}, status=400)
+    if not all(isinstance(entry, dict) and isinstance(entry.get('template', ''), str) for entry in entries):
+        return JsonResponse({'error': 'Every poll must be an object, with a title string as template'}, status=400)
+
+    titles = {entry['template'] for entry in entries if 'template' in entry}
+    saved = dict(
+        PollTemplate.objects.filter(created_by=request.user['object_id'], title__in=titles).values_list('title', 'template')
+    ) if titles else {}
+
+    poll_bodies = []
+    for index, entry in enumerate(entries):
+        if 'template' in entry:
+            title = entry['template']
+            if title not in saved:
+                return JsonResponse({'error': f'Template with title "{title}" not found', 'index': index}, status=400)
+            entry = {**json.loads(saved[title]), **{key: value for key, value in entry.items() if key != 'template'}}
+        error = poll_body_error(entry)
+        if error:
+            return JsonResponse({'error': error, 'index': index}, status=400)
+        poll_bodies.append(entry)
+
+    created = []
+    try:
+        redis_conn = get_redis_connection()
+        pipe = redis_conn.pipeline(transaction=False)
+        for poll_body in poll_bodies:
+            creation_id = generate()
+            new_poll_id = generate(size=8)
+            pipe.hset(metadata_key(new_poll_id), mapping=make_poll_metadata({**poll_body, 'anonymous': poll_body.get('anonymous', 0)}))
+            pipe.set(creation_key(creation_id), new_poll_id)
+            queue_poll_expiry(pipe, creation_id, new_poll_id, unrevealed_delete_seconds)
+            created.append({'poll_id': new_poll_id, 'redirect_url': f'/create/{creation_id}'})
+        pipe.execute()
+    except Exception as e:
+        return JsonResponse({'error': f'Failed to save poll data: {str(e)}'}, status=500)
+
+    return JsonResponse({'polls': created}, status=201)
+
+@csrf_exempt
 @is_authenticated
 def cast_vote(request, poll_id):
     if request.method not in ['PATCH', 'GET']:
@@ -140,113 +203,113 @@ def cast_vote(request, poll_id):
     redis_conn = get_redis_connection()
     
     if request.method == 'GET':
-        poll = get_poll(redis_conn, poll_id)
+        # revealed polls are answered with their snapshot, from this worker's memory after the first read
+        snapshot = poll_cache.get_snapshot(poll_id)
+        if snapshot is not None:
+            return snapshot_response(request, snapshot)
+        poll = get_cached_poll(redis_conn, poll_id)
         if poll is None:
-            return JsonResponse({'error': 'Poll Expired/Ended'}, status=400)
+            archived = ArchivedPoll.objects.filter(poll_id=poll_id).first()
+            if archived is None:
+                return poll_closed_response()
+            return archived_poll_response(request, archived)
         if poll['revealed'] == '1':
-            poll_results = get_poll_results(redis_conn, poll_id)
-            response = {
-                'metadata': poll,
-                'counts': poll_results[1]
-            }
-            return JsonResponse(response, status=200)
+            snapshot = get_snapshot(redis_conn, poll_id)
+            if snapshot is not None:
+                return snapshot_response(request, snapshot)
+            return revealed_poll_response(poll, get_poll_counts(redis_conn, poll_id, poll['options']))
         else:
-            response = {
-                'metadata': poll,
-            }
-            return JsonResponse(response, status=200)
+            return open_poll_response(request, poll)
 
     elif request.method == 'PATCH':
         try:
-            poll = get_poll(redis_conn, poll_id)
-            if poll is None or poll['revealed'] == '1':
-                return JsonResponse({'error': 'Poll Expired/Ended'}, status=400)
+            poll = get_cached_poll(redis_conn, poll_id)
         except:
             return JsonResponse({'error':'An unexpected error has occurred'}, status=500)
         
-        try:
-            ballot = json.loads(request.body)
-        except json.JSONDecodeError:
-            return JsonResponse({'error': 'Invalid JSON payload'}, status=400)
-        
-        if poll['multi_selection'] == '0' and len(ballot['votes'])>1:
-            return JsonResponse({'error': 'Only one option can be chosen for this poll'}, status=400)
-        
-        if not all(field in poll['options'] for field in ballot['votes']):
-            return JsonResponse({'error': 'Invalid option'}, status=400)
-        
-        if len(ballot['votes']) != len(set(ballot['votes'])):
-            return JsonResponse({'error': 'Duplicate votes are not allowed'}, status=400)
+        ballot, error_response = parse_ballot(request, poll)
+        if error_response:
+            return error_response
 
-        poll_votes_key = f'{poll_id}:votes'
-        poll_count_key = f'{poll_id}:count'
-        
-        if poll['anonymous'] == '1':
-            user_email = request.user['email']
-            voter_id = hashlib.sha256(f"{user_email}:{poll_id}".encode()).hexdigest()
-        else:
-            voter_id = request.user['email']
+        voter_id = get_voter_id(poll, poll_id, request.user['email'])
 
-        new_votes = '-:-'.join(ballot['votes'])
-        
         try:
-            prev_votes = redis_conn.hget(poll_votes_key, voter_id)
-            if prev_votes:
-                prev_votes = prev_votes.decode('utf-8').split('-:-')
-                for option in prev_votes:
-                    redis_conn.zincrby(poll_count_key, -1, option)
-            
-            redis_conn.hset(poll_votes_key, voter_id, new_votes)
-            
-            for option in ballot['votes']:
-                redis_conn.zincrby(poll_count_key, 1, option)
+            if STREAM_INGESTION:
+                status = enqueue_ballot(redis_conn, poll_id, voter_id, ballot['votes'], poll['options'])
+            else:
+                status, previous = cast_ballot(redis_conn, poll_id, voter_id, ballot['votes'], poll['options'])
         except Exception as e:
             return JsonResponse({'error': f'Failed to save poll data: {str(e)}'}, status=500)
+
+        if status == VOTE_OK and not STREAM_INGESTION:
+            # live delta for the admin page, the vote itself is already stored
+            try:
+                async_to_sync(get_channel_layer().group_send)(
+                    admin_group_name(poll_id),
+                    vote_cast_event(voter_id, ballot['votes'], previous)
+                )
+            except Exception as e:
+                logger.warning('Failed to publish vote to poll admins: %s', e)
         
-        return JsonResponse({'message': 'Vote/s cast successfully'}, status=200)
+        return cast_response(status)
 
 @csrf_exempt
 @is_authenticated
 def poll_admin(request, creation_id):
     redis_conn = get_redis_connection()
     if request.method == "GET":
+        query, error = parse_results_query(request.GET)
+        if error:
+            return JsonResponse({'error': error}, status=400)
+
+        if checks_version_first(request):
+            poll_id = get_cached_poll_id(redis_conn, creation_id)
+            response = version_not_modified(request, get_poll_version(redis_conn, poll_id) if poll_id else None)
+            if response is not None:
+                return response
+
         poll_id, poll = get_poll_from_creation_id(redis_conn, creation_id)
         if poll is None:
-            return JsonResponse({'error': 'Invalid creation ID'}, status=400)
-        
-        poll_results = get_poll_results(redis_conn, poll_id)
-        
-        response = {
-            'metadata': poll,
-            'votes' : poll_results[0],
-            'counts' : poll_results[1]
-        }
-        print("Response : ", response)
-        return JsonResponse(response, status=200)
+            archived = ArchivedPoll.objects.filter(creation_id=creation_id).first()
+            if archived is None:
+                return JsonResponse({'error': 'Invalid creation ID'}, status=400)
+            return archived_admin_response(request, archived, query)
+
+        version, counts, votes = read_changes(redis_conn, poll_id, poll['options'], query['since'])
+        cursor = None
+        if query['mode'] == 'full':
+            votes = get_poll_results(redis_conn, poll_id, poll['options'])[0]
+        elif query['mode'] == 'page':
+            cursor, votes = get_poll_votes_page(redis_conn, poll_id, poll['options'], query['cursor'], query['count'])
+        ingestion = get_ingestion_lag(redis_conn, poll_id) if STREAM_INGESTION else None
+        return admin_response(query, poll, version, counts, votes, cursor, ingestion)
     elif request.method == "PATCH":
         poll_id, poll = get_poll_from_creation_id(redis_conn, creation_id)
         if poll is None:
             return JsonResponse({'error': 'Invalid creation ID'}, status=400)
         
-        poll['revealed'] = 1
-        poll_metadata = make_poll_metadata_string(poll)
-        poll_metadata_key = f'{poll_id}:metadata'
+        poll['revealed'] = '1'
         
         try:
-            redis_conn.set(poll_metadata_key, poll_metadata)
-
-            #schedule auto delete
-            task = delete_poll.apply_async((creation_id,), countdown=delete_seconds)
-            print(f"Scheduled delete task with ID: {task.id}")
+            set_poll_revealed(redis_conn, poll_id)
+            publish_poll_invalidation(redis_conn, poll_id)
+            if STREAM_INGESTION and not drain_poll(redis_conn, poll_id, poll['options']):
+                return undrained_reveal_response()
+            # counts are final once revealed is set, votes are refused from here on
+            version, counts, _ = read_changes(redis_conn, poll_id, poll['options'])
+            store_snapshot(redis_conn, poll_id, poll, counts, version)
+
+            #schedule auto delete, replaces the unrevealed deadline
+            schedule_poll_expiry(redis_conn, creation_id, poll_id, delete_seconds, poll['options'])
+            queue_poll_archive(redis_conn, creation_id)
             
-            # send revealed event to participants
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                f'poll_{poll_id}',
-                {
-                    'type': 'poll_revealed',
-                }
-            )
+            # send revealed event with the results to participants, so they don't all refetch
+            event = poll_revealed_event(poll_id, poll, counts)
+            if LOCAL_FANOUT:
+                publish_reveal(redis_conn, poll_id, event['frame'])
+            else:
+                channel_layer = get_channel_layer()
+                async_to_sync(channel_layer.group_send)(f'poll_{poll_id}', event)
         except Exception as e:
             return JsonResponse({'error': f'Failed to update poll data: {str(e)}'}, status=500)
 
@@ -254,6 +317,91 @@ def poll_admin(request, creation_id):
 
     return JsonResponse({'error': 'Invalid request method'}, status=400)
 
+@csrf_exempt
+@is_authenticated
+def option_voters(request, creation_id):
+    """One SSCAN page of the voters whose ballot includes ?option=, follow the returned cursor until it is 0"""
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+    redis_conn = get_redis_connection()
+    poll_id, poll = get_poll_from_creation_id(redis_conn, creation_id)
+    archived = None
+    if poll is None:
+        archived = ArchivedPoll.objects.filter(creation_id=creation_id).first()
+        if archived is None:
+            return JsonResponse({'error': 'Invalid creation ID'}, status=400)
+        poll = archived.metadata
+
+    option = request.GET.get('option')
+    if option not in poll['options']:
+        return JsonResponse({'error': 'Invalid option'}, status=400)
+
+    page, error = parse_page_query(request.GET)
+    if error:
+        return JsonResponse({'error': error}, status=400)
+
+    if archived is not None:
+        cursor, voters = archived_option_voters(archived, option, *page)
+    else:
+        cursor, voters = get_option_voters_page(redis_conn, poll_id, poll['options'], option, *page)
+    return JsonResponse({'option': option, 'cursor': cursor, 'voters': voters}, status=200)
+
+@csrf_exempt
+@is_authenticated
+def option_overlap(request, creation_id):
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+    redis_conn = get_redis_connection()
+    poll_id, poll = get_poll_from_creation_id(redis_conn, creation_id)
+    if poll is None:
+        archived = ArchivedPoll.objects.filter(creation_id=creation_id).first()
+        if archived is None:
+            return JsonResponse({'error': 'Invalid creation ID'}, status=400)
+        return JsonResponse(archived_option_overlap(archived), status=200)
+
+    return JsonResponse(get_option_overlap(redis_conn, poll_id, poll['options']), status=200)
+
+@csrf_exempt
+@is_authenticated
+def poll_presence(request, creation_id):
+    """Participants connected to the poll's socket and how many of them have voted, see presence.py"""
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+    redis_conn = get_redis_connection()
+    poll_id, poll = get_poll_from_creation_id(redis_conn, creation_id)
+    if poll is None:
+        # archived polls are long revealed and their presence hash is gone: nobody connected
+        archived = ArchivedPoll.objects.filter(creation_id=creation_id).first()
+        if archived is None:
+            return JsonResponse({'error': 'Invalid creation ID'}, status=400)
+        return JsonResponse({'connected': 0, 'voted': archived.ballots.count()}, status=200)
+
+    return JsonResponse(get_presence(redis_conn, poll_id), status=200)
+
+@csrf_exempt
+@is_authenticated
+def vote_timeline(request, creation_id):
+    """Ballots cast per ?resolution=second or minute (the default), from the buckets cast_vote keeps"""
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+    resolution = request.GET.get('resolution', 'minute')
+    if resolution not in TIMELINE_RESOLUTIONS:
+        return JsonResponse({'error': 'Invalid resolution'}, status=400)
+
+    redis_conn = get_redis_connection()
+    poll_id, poll = get_poll_from_creation_id(redis_conn, creation_id)
+    if poll is None:
+        archived = ArchivedPoll.objects.filter(creation_id=creation_id).first()
+        if archived is None:
+            return JsonResponse({'error': 'Invalid creation ID'}, status=400)
+        return JsonResponse({'resolution': resolution, 'buckets': archived.timeline.get(resolution, [])}, status=200)
+
+    return JsonResponse({'resolution': resolution, 'buckets': get_vote_timeline(redis_conn, poll_id, resolution)}, status=200)
+
 @is_authenticated
 def get_user_details(request):
     user_details = {
@@ -263,3 +411,11 @@ def get_user_details(request):
     }
     return JsonResponse(user_details)
 
+
+def prometheus_metrics(request):
+    """Prometheus text format, summed over every worker (see metrics.py). Not served without a METRICS_TOKEN."""
+    if not METRICS_TOKEN:
+        return HttpResponse(status=404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.render(get_redis_connection()), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,229 @@
+from .redis_pool import LazyScript
+from .keys import changes_key, count_key, poll_keys, timeline_key, version_key, votes_key
+
+VOTE_OK = 1
+POLL_CLOSED = 0
+
+# Ballots are stored index encoded: a ballot is the comma joined positions of
+# its options in the metadata's option list ('0,3'), the count zset is scored
+# by position and the option sets are keyed by it. Option texts are only
+# stored once, in the metadata, and translated back on read (decode_ballot).
+#
+# Shared by the scripts that store ballots (CAST_VOTE_LUA here, APPLY_BALLOTS_LUA
+# in ingest.py). They all take
+# KEYS: metadata, votes, count, version, changes, voters of option 0 .. voters of option N-1,
+#       ballots stream, applied, snapshot, presence, timeline by second, timeline by minute (keys.poll_keys)
+# ARGV: N, ...
+#
+# apply_ballot swaps a voter's ballot and moves the counts and the per-option
+# voter sets. Every ballot bumps the poll version and records it as the voter's
+# score in the changes set, so admins can ask for "everything since version X",
+# and is counted in the second and the minute it was cast in, so the admin
+# timeline is read from those buckets rather than rebuilt from ballots.
+# Keys created by a ballot inherit the metadata's TTL, see expiry.py.
+BALLOT_LUA = """
+local option_count = tonumber(ARGV[1])
+local voters_keys = {}
+for i = 1, option_count do
+    voters_keys[tostring(i - 1)] = KEYS[5 + i]
+end
+local timeline_keys = {KEYS[10 + option_count], KEYS[11 + option_count]}
+
+local expire_at = redis.call('PEXPIRETIME', KEYS[1])
+
+local function split(ballot)
+    local options = {}
+    for option in string.gmatch(ballot, '[^,]+') do
+        table.insert(options, option)
+    end
+    return options
+end
+
+local function apply_ballot(voter, ballot, cast_at)
+    local prev = redis.call('HGET', KEYS[2], voter)
+    for _, option in ipairs(split(prev or '')) do
+        redis.call('ZINCRBY', KEYS[3], -1, option)
+        if voters_keys[option] then
+            redis.call('SREM', voters_keys[option], voter)
+        end
+    end
+
+    local created = {}
+    redis.call('HSET', KEYS[2], voter, ballot)
+    for _, option in ipairs(split(ballot)) do
+        redis.call('ZINCRBY', KEYS[3], 1, option)
+        local voters_key = voters_keys[option]
+        if redis.call('SADD', voters_key, voter) == 1 and redis.call('SCARD', voters_key) == 1 then
+            table.insert(created, voters_key)
+        end
+    end
+
+    local version = redis.call('INCR', KEYS[4])
+    redis.call('ZADD', KEYS[5], version, voter)
+
+    redis.call('HINCRBY', timeline_keys[2], cast_at - cast_at % 60, 1)
+    -- a new second is the only time a timeline key can have been created
+    if redis.call('HINCRBY', timeline_keys[1], cast_at, 1) == 1 and expire_at > 0 then
+        for _, key in ipairs(timeline_keys) do
+            if redis.call('PTTL', key) == -1 then
+                table.insert(created, key)
+            end
+        end
+    end
+
+    if expire_at > 0 then
+        if version == 1 then
+            for i = 2, 5 do
+                table.insert(created, KEYS[i])
+            end
+        end
+        for _, key in ipairs(created) do
+            redis.call('PEXPIREAT', key, expire_at)
+        end
+    end
+
+    return prev or ''
+end
+"""
+
+# ARGV after N: voter_id, encoded ballot
+#
+# Checks that the poll still exists and is not revealed and stores the ballot,
+# in a single atomic round trip. The ballot is timed by the Redis server clock.
+CAST_VOTE_LUA = BALLOT_LUA + """
+local revealed = redis.call('HGET', KEYS[1], 'revealed')
+if not revealed or revealed == '1' then
+    return {0, ''}
+end
+
+return {1, apply_ballot(ARGV[2], ARGV[3], tonumber(redis.call('TIME')[1]))}
+"""
+
+# KEYS: version, changes, votes, count
+# ARGV: version to diff from, or '' for counts only
+#
+# Consistent read of the version, the counts and the ballots of every voter
+# whose last vote is newer than ARGV[1].
+READ_CHANGES_LUA = """
+local version = tonumber(redis.call('GET', KEYS[1]) or '0')
+local counts = redis.call('ZREVRANGE', KEYS[4], 0, -1, 'WITHSCORES')
+local changed = {}
+
+if ARGV[1] ~= '' then
+    local voters = redis.call('ZRANGEBYSCORE', KEYS[2], '(' .. ARGV[1], '+inf')
+    for start = 1, #voters, 1000 do
+        local chunk = {unpack(voters, start, math.min(start + 999, #voters))}
+        local ballots = redis.call('HMGET', KEYS[3], unpack(chunk))
+        for i, voter in ipairs(chunk) do
+            table.insert(changed, voter)
+            table.insert(changed, ballots[i] or '')
+        end
+    end
+end
+
+return {version, counts, changed}
+"""
+
+_cast_vote_script = LazyScript(CAST_VOTE_LUA)
+_async_cast_vote_script = LazyScript(CAST_VOTE_LUA)
+_read_changes_script = LazyScript(READ_CHANGES_LUA)
+_async_read_changes_script = LazyScript(READ_CHANGES_LUA)
+
+
+def encode_ballot(votes, options):
+    """Option texts -> the stored ballot, e.g. '0,3'. Every vote must be one of options."""
+    positions = {option: str(index) for index, option in enumerate(options)}
+    return ','.join(positions[vote] for vote in votes)
+
+
+def decode_ballot(ballot, options):
+    """Stored ballot (bytes or str) -> option texts"""
+    if isinstance(ballot, bytes):
+        ballot = ballot.decode('utf-8')
+    return [options[int(index)] for index in ballot.split(',')] if ballot else []
+
+
+def decode_counts(counts, options):
+    """[(index, score)] from the count zset -> {option: count}"""
+    return {options[int(index)]: int(score) for index, score in counts}
+
+
+def _ballot_keys(poll_id, options):
+    return poll_keys(poll_id, options)
+
+
+def _ballot_args(voter_id, votes, options):
+    return [len(options), voter_id, encode_ballot(votes, options)]
+
+
+def _ballot_result(result, options):
+    status, prev = result
+    return status, decode_ballot(prev, options)
+
+
+def cast_ballot(redis_conn, poll_id, voter_id, votes, options):
+    """
+    Atomically replace voter_id's ballot with votes, options being all of the poll's options.
+    Returns (status, previous_votes) where status is VOTE_OK or POLL_CLOSED.
+    """
+    return _ballot_result(_cast_vote_script(
+        keys=_ballot_keys(poll_id, options),
+        args=_ballot_args(voter_id, votes, options),
+        client=redis_conn,
+    ), options)
+
+
+async def acast_ballot(redis_conn, poll_id, voter_id, votes, options):
+    """Async version of cast_ballot for a redis.asyncio connection."""
+    return _ballot_result(await _async_cast_vote_script(
+        keys=_ballot_keys(poll_id, options),
+        args=_ballot_args(voter_id, votes, options),
+        client=redis_conn,
+    ), options)
+
+
+def _changes_keys(poll_id):
+    return [version_key(poll_id), changes_key(poll_id), votes_key(poll_id), count_key(poll_id)]
+
+
+def _changes_result(result, options):
+    version, counts, changed = result
+    counts = decode_counts(((counts[i], float(counts[i + 1])) for i in range(0, len(counts), 2)), options)
+    votes = {
+        changed[i].decode('utf-8'): decode_ballot(changed[i + 1], options)
+        for i in range(0, len(changed), 2)
+    }
+    return version, counts, votes
+
+
+def read_changes(redis_conn, poll_id, options, since=None):
+    """
+    Returns (version, counts, votes) where votes only holds the ballots that
+    changed after version `since`. With since=None no ballots are read.
+    """
+    return _changes_result(_read_changes_script(
+        keys=_changes_keys(poll_id),
+        args=['' if since is None else since],
+        client=redis_conn,
+    ), options)
+
+
+async def aread_changes(redis_conn, poll_id, options, since=None):
+    return _changes_result(await _async_read_changes_script(
+        keys=_changes_keys(poll_id),
+        args=['' if since is None else since],
+        client=redis_conn,
+    ), options)
+
+
+TIMELINE_RESOLUTIONS = ('second', 'minute')
+
+
+def get_vote_timeline(redis_conn, poll_id, resolution):
+    """[[bucket start (unix seconds), ballots cast in it]] of the buckets with ballots, oldest first"""
+    return decode_timeline(redis_conn.hgetall(timeline_key(poll_id, resolution)))
+
+
+def decode_timeline(buckets):
+    """get_vote_timeline's list from the HGETALL of a timeline hash"""
+    return sorted([int(start), int(count)] for start, count in buckets.items())
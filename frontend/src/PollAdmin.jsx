@@ -13,6 +13,11 @@ import {
     wsDomain
 } from "./Config"
 
+const RECONNECT_BASE_MS = 1000;
+const RECONNECT_MAX_MS = 30000;
+const POLL_AFTER_FAILED_RECONNECTS = 2;
+const POLL_INTERVAL_MS = 1000;
+
 const PollAdmin = () => {
     const { isAuthenticated, redirectToLogin } = useAuth();
 
@@ -59,10 +64,123 @@ const PollAdmin = () => {
             });
     };
 
+    const applyDelta = (delta) => {
+        setPollData(prev => {
+            if (!prev) return prev;
+            return {
+                ...prev,
+                counts: delta.counts,
+                votes: { ...(prev.votes || {}), ...delta.votes }
+            };
+        });
+    };
+
     useEffect(() => {
-        fetchPollData();
-        const intervalId = setInterval(fetchPollData, 1000);
-        return () => clearInterval(intervalId);
+        if (!redirect_url) {
+            fetchPollData();
+            return;
+        }
+
+        const creationId = redirect_url.split('/').pop();
+        let ws = null;
+        let stopped = false;
+        let failedReconnects = 0;
+        let reconnectTimer = null;
+        let pollTimer = null;
+        // what the page holds, for ?since= and If-None-Match while the socket is down
+        let version = null;
+        let etag = null;
+
+        // one catch-up read: the ballots changed since `version`, or 304 if nothing did
+        const refetch = () => {
+            const url = version === null ? `${apiDomain}${redirect_url}` : `${apiDomain}${redirect_url}?since=${version}`;
+            fetch(url, { headers: etag ? { 'If-None-Match': etag } : {} })
+                .then(res => {
+                    if (res.status === 304) return null;
+                    if (!res.ok) throw new Error("Failed to fetch poll data");
+                    etag = res.headers.get('ETag');
+                    return res.json();
+                })
+                .then(data => {
+                    if (!data || stopped) return;
+                    if (version === null) {
+                        setPollData(data);
+                    } else {
+                        applyDelta(data);
+                    }
+                    version = data.version;
+                    setIsPending(false);
+                    setError(null);
+                })
+                .catch(err => {
+                    // keep showing what we have, the next read or the socket catches up
+                    if (version === null) {
+                        setError(err.message);
+                        setIsPending(false);
+                    }
+                    console.error(err);
+                });
+        };
+
+        const startPolling = () => {
+            if (pollTimer === null) {
+                pollTimer = setInterval(refetch, POLL_INTERVAL_MS);
+            }
+        };
+
+        const stopPolling = () => {
+            clearInterval(pollTimer);
+            pollTimer = null;
+        };
+
+        const connect = () => {
+            ws = new WebSocket(`${wsDomain}/admin/${creationId}/`);
+
+            ws.onopen = () => {
+                failedReconnects = 0;
+                stopPolling();
+            };
+
+            ws.onmessage = (event) => {
+                const data = JSON.parse(event.data);
+                if (data.type === 'snapshot') {
+                    setPollData(data);
+                    setIsPending(false);
+                    setError(null);
+                    // the snapshot carries no version, the next catch-up read is a full one
+                    version = null;
+                    etag = null;
+                } else if (data.type === 'delta') {
+                    applyDelta(data);
+                }
+            };
+
+            ws.onerror = (error) => {
+                console.error('WebSocket Error:', error);
+            };
+
+            // deploys, network drops and the proxy's idle timeout all end up here:
+            // catch up over HTTP, reconnect with backoff, and poll if that keeps failing
+            ws.onclose = () => {
+                console.log('WebSocket Disconnected');
+                if (stopped) return;
+                refetch();
+                if (failedReconnects >= POLL_AFTER_FAILED_RECONNECTS) startPolling();
+                const delay = Math.min(RECONNECT_BASE_MS * 2 ** failedReconnects, RECONNECT_MAX_MS);
+                failedReconnects += 1;
+                reconnectTimer = setTimeout(connect, delay);
+            };
+        };
+
+        connect();
+
+        return () => {
+            stopped = true;
+            clearTimeout(reconnectTimer);
+            stopPolling();
+            ws.onclose = null;
+            ws.close();
+        };
     }, [redirect_url]);
 
     const handleCopy = async () => {
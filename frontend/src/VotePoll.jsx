@@ -65,7 +65,12 @@ const VotePoll = () => {
             const data = JSON.parse(event.data);
             if (data.results_revealed) {
                 setRevealed(true);
-                fetchPollData();
+                if (data.results) {
+                    setPollData(data.results);
+                    setIsPending(false);
+                } else {
+                    fetchPollData();
+                }
             }
         };
 